@@ -0,0 +1,58 @@
+"""Measures the cost of `CurrentASRText.append` over a simulated 3-hour lecture.
+
+Run from `backend/api` with `python -m benchmarks.append_benchmark`.
+"""
+import os
+import random
+import tempfile
+import time
+
+from src.common import Timespan
+from src.persistence import get_writer
+from src.text_handlers import CurrentASRText
+
+LECTURE_SECONDS = 3 * 60 * 60
+COMMITS_PER_SECOND = 1  # OnlineASRProcessor commits roughly once per processed chunk
+REPORT_EVERY_SECONDS = 15 * 60
+
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from at which "
+    "but have an they you were her she there been one all we their has would when if so no will "
+    "lecture theorem proof function matrix vector derivative integral probability distribution"
+).split()
+
+
+def random_fragment(rng: random.Random) -> str:
+    return "".join(" " + rng.choice(WORDS) for _ in range(rng.randint(1, 6)))
+
+
+def main() -> None:
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as save_path:
+        os.mkdir(os.path.join(save_path, "en"))
+        text = CurrentASRText(save_path, "en")
+
+        print(f"{'lecture time':>12} {'chunks':>8} {'us/append':>10}")
+        block_start = time.perf_counter()
+        block_appends = 0
+        for second in range(LECTURE_SECONDS * COMMITS_PER_SECOND):
+            lecture_time = second / COMMITS_PER_SECOND
+            text.append(random_fragment(rng), Timespan(lecture_time, lecture_time + 1))
+            block_appends += 1
+
+            if (second + 1) % (REPORT_EVERY_SECONDS * COMMITS_PER_SECOND) == 0:
+                elapsed = time.perf_counter() - block_start
+                minutes = int(lecture_time + 1) // 60
+                print(
+                    f"{minutes // 60:>9d}h{minutes % 60:02d} {len(text.text_chunks):>8d} "
+                    f"{elapsed / block_appends * 1e6:>10.1f}"
+                )
+                block_start = time.perf_counter()
+                block_appends = 0
+
+        text.journal.close()
+        get_writer().flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Compares the explicit `to_dict`/`encode_json` codec with the former jsonpickle encoding.
+
+Run from `backend/api` with `python -m benchmarks.codec_benchmark`, jsonpickle has to be installed.
+"""
+import random
+import tempfile
+import time
+from typing import Callable
+
+import jsonpickle
+
+from src.common import Timespan, encode_json
+from src.text_handlers import ASRTextUnit, CurrentASRText
+
+CHUNKS = 2000
+VERSIONS_PER_CHUNK = 3
+AUDIO_SECONDS = 30
+SAMPLING_RATE = 16000
+
+
+def measure(function: Callable[[], str], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name: str, old: Callable[[], str], new: Callable[[], str], repeat: int) -> None:
+    old_time, new_time = measure(old, repeat), measure(new, repeat)
+    print(
+        f"{name:<22} {old_time * 1e3:>12.3f} {new_time * 1e3:>12.3f} {old_time / new_time:>8.1f}x"
+        f" {len(old()):>12d} {len(new()):>12d}"
+    )
+
+
+def main() -> None:
+    rng = random.Random(0)
+    text_unit = ASRTextUnit(
+        text="This is some transcribed text of a lecture.",
+        timestamp=42,
+        timespan=Timespan(120.5, 124.25),
+        version=2,
+    )
+
+    with tempfile.TemporaryDirectory() as save_path:
+        text = CurrentASRText(save_path, "en")
+        # the former representation of the text chunks, a list of ASRTextUnits per timestamp
+        legacy_text_chunks = {}
+        for timestamp in range(CHUNKS):
+            for version in range(VERSIONS_PER_CHUNK):
+                text_unit_version = ASRTextUnit(
+                    text="word " * (10 + version),
+                    timestamp=timestamp,
+                    timespan=Timespan(timestamp, timestamp + 1),
+                    version=version,
+                )
+                legacy_text_chunks.setdefault(timestamp, []).append(text_unit_version)
+                text._store_version(text_unit_version)
+
+        audio = [rng.uniform(-1, 1) for _ in range(AUDIO_SECONDS * SAMPLING_RATE)]
+        offload_response = {"session_id": "default", "timestamp": 0, "audio": audio}
+
+        print(
+            f"{'':<22} {'jsonpickle ms':>12} {'codec ms':>12} {'speedup':>9}"
+            f" {'old bytes':>12} {'new bytes':>12}"
+        )
+        report(
+            "ASRTextUnit",
+            lambda: jsonpickle.encode(text_unit, unpicklable=True, indent=4),
+            text_unit.to_json,
+            2000,
+        )
+        report(
+            "TranslatePacket span",
+            lambda: jsonpickle.encode(text_unit.timespan, unpicklable=True, indent=4),
+            lambda: encode_json(text_unit.timespan.to_dict()),
+            2000,
+        )
+        report(
+            f"CurrentASRText {CHUNKS}",
+            lambda: jsonpickle.encode(legacy_text_chunks, unpicklable=True, indent=4),
+            text.to_json,
+            3,
+        )
+        report(
+            f"offload {AUDIO_SECONDS}s audio",
+            lambda: jsonpickle.encode(offload_response, unpicklable=True, indent=4),
+            lambda: encode_json(offload_response),
+            3,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""Benchmarks of the text and buffer hot paths, compared with a saved baseline.
+
+Run from `backend/api`:
+
+    python -m benchmarks.suite --save-baseline   # on the last deployed version
+    python -m benchmarks.suite                   # on the new version, compares with the baseline
+    python -m benchmarks.suite --filter process_iter
+
+Every run is saved into `benchmarks/results/`. The exit code is 1 if a benchmark got slower than
+the baseline by more than `--tolerance`, so the suite can gate a deployment. Baselines are only
+comparable on the same machine, so save one on the machine that runs the comparison.
+
+The data is synthetic but shaped like a lecture: about 2.5 words per second, sentences of 8 to 20
+words, a transcript chunk per commit and a worker returning the words of the whole audio buffer.
+"""
+import argparse
+import bisect
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from src.buffer_common import HypothesisBuffer, OnlineASRProcessor, create_tokenizer
+from src.common import Timespan
+from src.persistence import get_writer
+from src.text_handlers import CorrectionRule, CurrentASRText, SourceString
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+BASELINE_PATH = os.path.join(RESULTS_DIR, "baseline.json")
+
+WORDS_PER_SECOND = 2.5
+SAMPLING_RATE = 16000
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are or his from at which "
+    "but have an they you were her she there been one all we their has would when if so no will "
+    "lecture theorem proof function matrix vector derivative integral probability distribution"
+).split()
+
+Word = Tuple[float, float, str]
+
+
+class Benchmark:
+    def __init__(self, name: str, setup: Callable[[], Callable[[], None]], number: int) -> None:
+        """
+        Benchmark measures `number` calls of the function returned by `setup`. Every round gets
+        a fresh setup, which is not measured, so benchmarks changing their state measure the
+        same work in every round.
+        """
+        self.name: str = name
+        self.setup: Callable[[], Callable[[], None]] = setup
+        self.number: int = number
+
+    def run(self, repeat: int) -> float:
+        """Returns the seconds per call of the fastest round"""
+        best = float("inf")
+        for _ in range(repeat):
+            function = self.setup()
+            start = time.perf_counter()
+            for _ in range(self.number):
+                function()
+            best = min(best, (time.perf_counter() - start) / self.number)
+        return best
+
+
+def lecture_words(seconds: float, rng: random.Random) -> List[Word]:
+    """Returns timestamped words of a lecture, with a full stop every 8 to 20 words"""
+    words: List[Word] = []
+    start = 0.0
+    until_full_stop = rng.randint(8, 20)
+    while start < seconds:
+        duration = rng.uniform(0.5, 1.5) / WORDS_PER_SECOND
+        word = " " + rng.choice(WORDS)
+        until_full_stop -= 1
+        if until_full_stop == 0:
+            word += "."
+            until_full_stop = rng.randint(8, 20)
+        words.append((start, start + duration * 0.9, word))
+        start += duration
+    return words
+
+
+class TranscribingWorker:
+    def __init__(self, words: List[Word]) -> None:
+        """TranscribingWorker answers like a worker that transcribes the audio buffer correctly,
+        with the words heard between the buffer's start and `now`, relative to the start"""
+        self.words: List[Word] = words
+        self.starts: List[float] = [start for start, _, _ in words]
+
+    def transcribe(self, offset: float, now: float) -> Tuple[List[Word], List[float]]:
+        first = bisect.bisect_left(self.starts, offset)
+        last = bisect.bisect_right(self.starts, now)
+        tsw = [
+            (start - offset, end - offset, word)
+            for start, end, word in self.words[first:last]
+            if end <= now
+        ]
+        return tsw, [now - offset]
+
+
+def hypothesis_buffer_setup(buffer_seconds: float) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        worker = TranscribingWorker(lecture_words(3600, random.Random(0)))
+        hypothesis_buffer = HypothesisBuffer()
+        now = [buffer_seconds]
+
+        def step() -> None:
+            # the buffer is never trimmed, the worker returns the last `buffer_seconds` of audio
+            now[0] += 0.5
+            offset = now[0] - buffer_seconds
+            tsw, _ = worker.transcribe(offset, now[0])
+            hypothesis_buffer.insert(tsw, offset)
+            hypothesis_buffer.flush()
+            hypothesis_buffer.pop_commited(offset)
+
+        return step
+
+    return setup
+
+
+def online_processor(session_seconds: float, rng: random.Random) -> OnlineASRProcessor:
+    """Returns a processor that has committed the words of `session_seconds` of a lecture"""
+    processor = OnlineASRProcessor(create_tokenizer("en"))
+    words = lecture_words(session_seconds, rng)
+    processor.commited.extend(words)
+    processor.commited_count = len(words)
+    for _, _, word in words:
+        processor.scroll_away(word)
+    if words:
+        end = words[-1][1]
+        processor.transcript_buffer.last_commited_time = end
+        processor.buffer_time_offset = end
+        processor.last_chunked_at = end
+    return processor
+
+
+def process_iter_setup(session_seconds: float) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        rng = random.Random(0)
+        processor = online_processor(session_seconds, rng)
+        start = processor.buffer_time_offset
+        worker = TranscribingWorker(
+            [(s + start, e + start, w) for s, e, w in lecture_words(600, rng)]
+        )
+        chunk = np.zeros(SAMPLING_RATE // 2, dtype=np.float32)
+        now = [start]
+
+        def step() -> None:
+            now[0] += 0.5
+            processor.insert_audio_chunk(chunk)
+            tsw, ends = worker.transcribe(processor.buffer_time_offset, now[0])
+            processor.process_iter(tsw, ends)
+
+        return step
+
+    return setup
+
+
+def prompt_setup(session_seconds: float) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        processor = online_processor(session_seconds, random.Random(0))
+        return lambda: processor.prompt()
+
+    return setup
+
+
+def words_to_sentences_setup(session_seconds: float) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        processor = OnlineASRProcessor(create_tokenizer("en"))
+        words = lecture_words(session_seconds, random.Random(0))
+        return lambda: processor.words_to_sentences(words)
+
+    return setup
+
+
+def text_with_chunks(save_path: str, chunks: int, rng: random.Random) -> CurrentASRText:
+    os.makedirs(os.path.join(save_path, "en"), exist_ok=True)
+    text = CurrentASRText(save_path, "en")
+    for i in range(chunks):
+        fragment = "".join(" " + rng.choice(WORDS) for _ in range(8))
+        text.append(fragment, Timespan(i * 3.0, i * 3.0 + 3.0))
+    return text
+
+
+def correction_rules_setup(rules: int) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        rng = random.Random(0)
+        text = CurrentASRText(tempfile.mkdtemp(), "en")
+        for i in range(rules):
+            rule = CorrectionRule()
+            # misheard names and terms, most of them never occur in the text
+            rule.source_strings = [
+                SourceString(f"{rng.choice(WORDS)} {rng.choice(WORDS)}x{i}", active=True),
+                SourceString(f"term{i}", active=i % 2 == 0),
+            ]
+            rule.to = f"Term{i}"
+            text.correction_rules.append(rule)
+        text.correction_rules[rules // 2].source_strings[0].string = "matrix vector"
+        fragment = "".join(" " + rng.choice(WORDS) for _ in range(40))
+        return lambda: text.apply_correction_rules(fragment)
+
+    return setup
+
+
+def append_setup(chunks: int) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        rng = random.Random(0)
+        text = text_with_chunks(tempfile.mkdtemp(), chunks, rng)
+        fragments = ["".join(" " + rng.choice(WORDS) for _ in range(4)) for _ in range(100)]
+        index = [0]
+
+        def append() -> None:
+            index[0] += 1
+            second = chunks * 3.0 + index[0]
+            text.append(fragments[index[0] % len(fragments)], Timespan(second, second + 1))
+
+        return append
+
+    return setup
+
+
+def get_latest_text_chunks_setup(chunks: int, known: bool) -> Callable[[], Callable[[], None]]:
+    """`known`: the viewer has all but the last 5 text chunks, otherwise it asks for all"""
+
+    def setup() -> Callable[[], None]:
+        text = text_with_chunks(tempfile.mkdtemp(), chunks, random.Random(0))
+        versions = text.get_latest_versions() if known else {}
+        for timestamp in text.timestamps[-5:]:
+            versions.pop(timestamp, None)
+        return lambda: text.get_latest_text_chunks(versions)
+
+    return setup
+
+
+def get_data_to_offload_setup(sessions: int) -> Callable[[], Callable[[], None]]:
+    def setup() -> Callable[[], None]:
+        from src import api
+        from src.networking_common import Session
+
+        for session_id in list(api.sessions.keys()):
+            api.sessions.pop(session_id)
+            api.processing_queue.remove_session(session_id)
+        audio = np.zeros(10 * SAMPLING_RATE, dtype=np.float32)
+        for i in range(sessions):
+            session = api.sessions.create(f"bench{i}", lambda: Session(f"bench{i}", api.CONFIG))
+            assert session is not None
+            session.online_asr_processor.insert_audio_chunk(audio)
+
+        def offload() -> None:
+            # every session got audio since the last call, like with live lectures
+            for session in api.sessions.values():
+                session.online_asr_processor.buffer_updated = True
+            api.get_data_to_offload()
+
+        return offload
+
+    return setup
+
+
+BENCHMARKS = [
+    Benchmark("hypothesis_buffer[buffer=10s]", hypothesis_buffer_setup(10), 1000),
+    Benchmark("hypothesis_buffer[buffer=30s]", hypothesis_buffer_setup(30), 1000),
+    Benchmark("process_iter[session=1min]", process_iter_setup(60), 300),
+    Benchmark("process_iter[session=30min]", process_iter_setup(30 * 60), 300),
+    Benchmark("process_iter[session=3h]", process_iter_setup(3 * 60 * 60), 100),
+    Benchmark("prompt[session=1min]", prompt_setup(60), 1000),
+    Benchmark("prompt[session=3h]", prompt_setup(3 * 60 * 60), 1000),
+    Benchmark("words_to_sentences[session=1min]", words_to_sentences_setup(60), 100),
+    Benchmark("words_to_sentences[session=30min]", words_to_sentences_setup(30 * 60), 10),
+    Benchmark("words_to_sentences[session=3h]", words_to_sentences_setup(3 * 60 * 60), 3),
+    Benchmark("apply_correction_rules[rules=10]", correction_rules_setup(10), 100),
+    Benchmark("apply_correction_rules[rules=100]", correction_rules_setup(100), 20),
+    Benchmark("apply_correction_rules[rules=1000]", correction_rules_setup(1000), 3),
+    Benchmark("append[chunks=1000]", append_setup(1000), 2000),
+    Benchmark("append[chunks=10000]", append_setup(10000), 2000),
+    Benchmark(
+        "get_latest_text_chunks[chunks=5000,new=5]", get_latest_text_chunks_setup(5000, True), 50
+    ),
+    Benchmark(
+        "get_latest_text_chunks[chunks=5000,all]", get_latest_text_chunks_setup(5000, False), 20
+    ),
+    Benchmark("get_data_to_offload[sessions=10]", get_data_to_offload_setup(10), 20),
+    Benchmark("get_data_to_offload[sessions=100]", get_data_to_offload_setup(100), 5),
+]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save_results(path: str, results: Dict[str, float], repeat: int) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "commit": git_commit(),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.node() + " " + platform.machine(),
+                "repeat": repeat,
+                "seconds_per_call": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+def compare(results: Dict[str, float], baseline: Dict, tolerance: float) -> List[str]:
+    """Prints the results next to the baseline, returns the names of the regressed benchmarks"""
+    print(f"\nbaseline: commit {baseline['commit']} of {baseline['time']} on {baseline['machine']}")
+    print(f"{'benchmark':<44} {'baseline us':>12} {'now us':>12} {'ratio':>7}")
+    regressed = []
+    for name, seconds in results.items():
+        baseline_seconds = baseline["seconds_per_call"].get(name)
+        if baseline_seconds is None:
+            print(f"{name:<44} {'-':>12} {seconds * 1e6:>12.1f}")
+            continue
+        ratio = seconds / baseline_seconds
+        verdict = ""
+        if ratio > 1 + tolerance:
+            verdict = "  SLOWER"
+            regressed.append(name)
+        elif ratio < 1 / (1 + tolerance):
+            verdict = "  faster"
+        print(
+            f"{name:<44} {baseline_seconds * 1e6:>12.1f} {seconds * 1e6:>12.1f} {ratio:>6.2f}x"
+            f"{verdict}"
+        )
+    return regressed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--filter", default="", help="run only benchmarks containing this")
+    parser.add_argument("--repeat", type=int, default=5, help="rounds, the fastest one counts")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument("--save-baseline", action="store_true", help="save as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file to compare with")
+    args = parser.parse_args()
+
+    # sessions of get_data_to_offload are saved into ./recordings
+    os.chdir(tempfile.mkdtemp())
+    results: Dict[str, float] = dict()
+    print(f"{'benchmark':<44} {'us/call':>12}")
+    for benchmark in BENCHMARKS:
+        if args.filter not in benchmark.name:
+            continue
+        results[benchmark.name] = benchmark.run(args.repeat)
+        print(f"{benchmark.name:<44} {results[benchmark.name] * 1e6:>12.1f}", flush=True)
+    get_writer().flush()
+
+    save_results(
+        os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S") + ".json"), results, args.repeat
+    )
+    if args.save_baseline:
+        save_results(args.baseline, results, args.repeat)
+        print(f"\nsaved as the baseline {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"\nno baseline {args.baseline}, save one with --save-baseline")
+        return
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressed = compare(results, baseline, args.tolerance)
+    if regressed:
+        print(f"\n{len(regressed)} benchmarks got slower by more than {args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
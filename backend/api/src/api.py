@@ -5,28 +5,142 @@ import os
 # create random session_id
 import random
 import string
-from typing import Dict, List, Tuple, Union
-
-import jsonpickle
+import sys
+import time
+from typing import Callable, Dict, List, Tuple, Union
 
 # for file upload
 import soundfile
-from flask import Flask, Response, make_response, request
+from flask import Flask, Response, g, make_response, redirect, request
 from flask_cors import CORS
 
-from .buffer_common import OnlineASRProcessor, create_tokenizer
-from .common import ASRConfig, Timespan
+from .buffer_common import TrimPolicy, warm_up_tokenizers
+from .common import ASRConfig, Timespan, encode_json
+from .metrics import (
+    BUFFER_TRIMMED_SECONDS,
+    BUFFER_TRIMS,
+    COMMIT_SECONDS,
+    INFERENCE_SECONDS,
+    PACKET_AUDIO_SECONDS,
+    REQUEST_SECONDS,
+    REQUESTS,
+    TRANSLATION_SECONDS,
+    WORKER_AUDIO_SECONDS,
+    WORKER_BUSY_SECONDS,
+    CallbackGauge,
+    render_metrics,
+)
 
 # modules for ASR manipulation
-from .networking_common import Session, TranscribePacket, TranslatePacket
-from .text_handlers import CorrectionRule
+from .networking_common import (
+    Session,
+    TranscribePacket,
+    TranslatePacket,
+    find_active_session_folders,
+)
+from .profiler import SamplingProfiler
+from .session_store import SessionStore, WorkQueue, create_state
+from .sharding import FORWARDED_HEADER, HashRing, proxy_request
+from .text_handlers import CurrentASRText
+from .worker_stats import WorkerStats
 
 app = Flask(__name__)
 CORS(app)
 CONFIG = ASRConfig()
-sessions: Dict[str, Session] = dict()
-processing_queue: List[TranscribePacket] = []
-processing_queue_translate: List[TranslatePacket] = []
+# requests are served by several threads, the sessions and queues are safe to share between them,
+# and with `CONFIG.STATE_BACKEND == "sqlite"` also between several API processes
+sessions: SessionStore
+processing_queue: WorkQueue
+processing_queue_translate: WorkQueue
+sessions, processing_queue, processing_queue_translate = create_state(CONFIG)
+
+SHARD_ROUTINGS = ["redirect", "proxy"]
+PROXY_TIMEOUT_SECONDS = 60.0  # longer than long-polls and the keep-alives of push streams
+# the API nodes sharing the sessions, None on a single node
+shard_ring: Union[HashRing, None] = None
+if CONFIG.SHARD_NODES:
+    assert CONFIG.SHARD_SELF in CONFIG.SHARD_NODES, "COLETRA_SHARD_SELF must be a shard node"
+    assert CONFIG.SHARD_ROUTING in SHARD_ROUTINGS, "shard routing must be one of " + str(
+        SHARD_ROUTINGS
+    )
+    shard_ring = HashRing(CONFIG.SHARD_NODES)
+
+# performance reports of the workers transcribing for this process
+worker_stats = WorkerStats()
+# length of the audio buffers of all sessions, follows the measured speed of the workers
+trim_policy = TrimPolicy(
+    CONFIG.TRIM_MAX_AUDIO_SECONDS, CONFIG.TRIM_MIN_AUDIO_SECONDS, CONFIG.TRIM_LATENCY_BUDGET_SECONDS
+)
+
+
+def record_trim(reason: str, seconds: float) -> None:
+    BUFFER_TRIMS.inc(reason=reason)
+    BUFFER_TRIMMED_SECONDS.inc(seconds, reason=reason)
+
+
+trim_policy.listener = record_trim
+
+
+def new_session(session_id: str) -> Session:
+    return Session(session_id=session_id, config=CONFIG, trim_policy=trim_policy)
+
+
+profiler = SamplingProfiler(CONFIG.PROFILE_DIR)
+
+
+def collect_queue_depths():
+    for queue in (processing_queue, processing_queue_translate):
+        yield (queue.name,), len(queue)
+
+
+def collect_queue_ages():
+    for queue in (processing_queue, processing_queue_translate):
+        yield (queue.name,), queue.oldest_age()
+
+
+def collect_audio_buffer_seconds():
+    for session in sessions.values():
+        buffer_size = len(session.online_asr_processor.audio_buffer)
+        yield (session.session_id,), buffer_size / CONFIG.SAMPLING_RATE
+
+
+def collect_viewers():
+    for session in sessions.values():
+        for language, text in session.texts.current_texts.items():
+            yield (session.session_id, language, "stream"), text.events.subscribers
+            yield (session.session_id, language, "long_poll"), text.events.long_polls
+
+
+CallbackGauge(
+    "coletra_queue_depth",
+    "Packets waiting in a work queue, handed out or not",
+    ("queue",),
+    collect_queue_depths,
+)
+CallbackGauge(
+    "coletra_queue_oldest_age_seconds",
+    "Time since the oldest packet of a work queue was queued",
+    ("queue",),
+    collect_queue_ages,
+)
+CallbackGauge(
+    "coletra_session_audio_buffer_seconds",
+    "Audio in the buffer of the ASR processor of a session, sent to the worker with every packet",
+    ("session_id",),
+    collect_audio_buffer_seconds,
+)
+CallbackGauge(
+    "coletra_audio_buffer_target_seconds",
+    "Length the audio buffers are trimmed to, lowered by the latency budget of the trim policy",
+    (),
+    lambda: [((), trim_policy.target_seconds())],
+)
+CallbackGauge(
+    "coletra_viewers",
+    "Clients connected to the push stream or waiting in a long-poll of a text",
+    ("session_id", "language", "kind"),
+    collect_viewers,
+)
 
 # TODO: subtitles to ~37 characters per chunk
 # TODO: edit chunks ~50 characters per chunk
@@ -40,6 +154,31 @@ def add_cors_headers(response: Response):
     return response
 
 
+@app.before_request
+def start_request_timer():
+    g.request_start_time = time.time()
+    # the only cost of the profiler while it is not profiling requests
+    if profiler.request_fraction > 0.0:
+        g.profiled = profiler.begin_request()
+
+
+@app.teardown_request
+def end_profiled_request(exception=None):
+    if g.get("profiled", False):
+        profiler.end_request()
+
+
+@app.after_request
+def record_request_metrics(response: Response):
+    # the rule, not the path, so that the labels do not grow with session IDs
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+    start_time = getattr(g, "request_start_time", None)
+    if start_time is not None:
+        REQUEST_SECONDS.observe(time.time() - start_time, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=str(response.status_code))
+    return response
+
+
 def session_not_found(session_id: Union[str, None]
  = None):
     response_data = {
@@ -67,125 +206,290 @@ def json_response(json_data):
     return response
 
 
+def cached_json_response(
+    current_text: CurrentASRText,
+    key: str,
+    build: Callable[[], object],
+    delivers_text: bool = True,
+):
+    """Serves the cached JSON response `key` of `current_text`, see `CurrentASRText.cached_response`.
+
+    Responds with 304 if the client already has the current revision of the text. Unless
+    `delivers_text` is False, the client is counted as a viewer having the text, see
+    `CurrentASRText.mark_delivered`.
+    """
+    # the tag has to be read before the body, so that it is never newer than the body
+    change_seq = current_text.change_seq
+    etag = current_text.etag()
+    if etag in request.if_none_match:
+        if delivers_text:
+            current_text.mark_delivered(change_seq)
+        response = make_response("")
+        response.set_etag(etag)
+        response = add_cors_headers(response)
+        return response, 304
+
+    body, compressed = current_text.cached_response(
+        key, build, compress="gzip" in request.accept_encodings
+    )
+    if delivers_text:
+        current_text.mark_delivered(change_seq)
+    response = make_response(body)
+    response.headers["Content-Type"] = "application/json"
+    if compressed:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.set_etag(etag)
+    response = add_cors_headers(response)
+    return response, 200
+
+
+def node_to_route_to(
+    session_id: Union[str, None], method: str, forwarded: bool
+) -> Union[str, None]:
+    """Returns the API node owning the session of a request if the request has to be sent
+    there, see `src.sharding`. Requests proxied by a node are never routed again."""
+    if (
+        shard_ring is None
+        or not session_id
+        or method == "OPTIONS"
+        or forwarded
+        or session_id in sessions
+    ):
+        return None
+
+    owner = shard_ring.owner(session_id)
+    if owner == CONFIG.SHARD_SELF:
+        return None
+    return owner
+
+
+@app.before_request
+def route_to_owner():
+    """Sends a request for a session of another API node to the node owning it. In the asgi
+    server mode, proxied requests do not reach Flask, see `asgi.proxy_to_owner`."""
+    session_id = request.args.get("session_id", default=None, type=str)
+    owner = node_to_route_to(session_id, request.method, FORWARDED_HEADER in request.headers)
+    if owner is None:
+        return None
+
+    if CONFIG.SHARD_ROUTING == "redirect":
+        # 307 keeps the method and the body of the request
+        response = redirect(owner + request.full_path, code=307)
+        response = add_cors_headers(response)
+        return response
+
+    proxied = proxy_request(
+        owner,
+        request.method,
+        request.full_path,
+        dict(request.headers),
+        request.get_data(),
+        PROXY_TIMEOUT_SECONDS,
+    )
+    if proxied is None:
+        response = json_response(
+            {"success": False, "session_id": session_id, "message": "Session node unreachable"}
+        )
+        return response, 502
+    return Response(proxied.body(), status=proxied.status, headers=proxied.headers)
+
+
+def active_sessions_of_other_nodes() -> List[str]:
+    assert shard_ring is not None
+    session_ids: List[str] = []
+    for node in shard_ring.nodes:
+        if node == CONFIG.SHARD_SELF:
+            continue
+        proxied = proxy_request(node, "GET", "/get_active_sessions", {}, b"", PROXY_TIMEOUT_SECONDS)
+        if proxied is None or proxied.status != 200:
+            continue
+        session_ids += json.loads(b"".join(proxied.body()))["active_sessions"]
+    return session_ids
+
+
 def get_data_to_offload():
     global processing_queue
 
     # create items in processing queue from sessins with enough audio data
-    for session_id in sessions:
-        session = sessions[session_id]
-        if session.online_asr_processor.buffer_updated:
+    for session in sessions.values():
+        with session.lock:
+            if not session.online_asr_processor.buffer_updated:
+                continue
             session.online_asr_processor.buffer_updated = False
-            processing_queue.append(
-                TranscribePacket(
-                    session_id=session_id,
-                    timestamp=session.online_asr_processor.last_timestamp,
-                    source_language=session.source_language,
-                    transcript_language=session.transcript_language,
-                    prompt=session.online_asr_processor.prompt()[0],
-                    audio=session.online_asr_processor.audio_buffer.tolist(),
-                )
+            processor = session.online_asr_processor
+            packet = TranscribePacket(
+                session_id=session.session_id,
+                timestamp=processor.last_timestamp,
+                source_language=session.source_language,
+                transcript_language=session.transcript_language,
+                prompt=processor.prompt()[0],
+                audio=processor.audio_buffer.tolist(),
+                audio_offset=processor.buffer_time_offset,
+            )
+            processing_queue.append(packet)
+            PACKET_AUDIO_SECONDS.observe(packet.audio_seconds)
+            session.tracer.packet_queued(
+                packet.timestamp, packet.audio_offset + packet.audio_seconds, packet.queued_time
             )
             session.untranscribed_timestamps.append(
                 session.online_asr_processor.last_timestamp
             )
             session.online_asr_processor.last_timestamp += 1
 
-    for item in processing_queue:
-        response_data = item.get_data_to_offload()
-        if response_data is not None:
-            return response_data
+    response_data = processing_queue.next_to_offload()
+    if response_data is not None:
+        return response_data
 
     response_data = {"success": True, "timestamp": None, "audio": []}
     return response_data
 
 
-def got_offloaded_data(session_id: str, timestamp: int, tsw, ends, language: str):
-    global processing_queue, processing_queue_translate
+def record_asr_result(
+    session: Session, packet: TranscribePacket, tsw, ends, language: str, worker_trace
+) -> None:
+    """Records the transcription of `packet` for replaying it, see `ASRConfig.RECORD_ASR`"""
+    inference_seconds = None
+    if worker_trace is not None:
+        inference_seconds = worker_trace["inference_end"] - worker_trace["inference_start"]
+    session.record_asr_result(
+        {
+            "timestamp": packet.timestamp,
+            "time": time.time(),
+            "audio_offset": packet.audio_offset,
+            "audio_seconds": packet.audio_seconds,
+            "prompt": packet.prompt,
+            "is_file": packet.is_file,
+            "language": language,
+            "tsw": tsw,
+            "ends": ends,
+            "inference_seconds": inference_seconds,
+        }
+    )
 
-    packet = None
-    # search for the TranscribePacket in the processing queue by session_id and timestamp
-    for item in processing_queue:
-        if item.session_id == session_id and item.timestamp == timestamp:
-            packet = item
-            break
 
+def got_offloaded_data(
+    session_id: str, timestamp: int, tsw, ends, language: str, worker_trace=None
+):
+    global processing_queue, processing_queue_translate
+
+    # taking the TranscribePacket out of the queue is atomic, a result sent twice is used once
+    packet = processing_queue.pop(session_id, timestamp)
     if packet is None:
-        # no such packet found
+        # no such packet found or data already received
         return
     assert isinstance(packet, TranscribePacket)
+    packet.transcript = "Recieved data"
+    received_time = time.time()
+    if packet.sent_out_time > 0:
+        INFERENCE_SECONDS.observe(received_time - packet.sent_out_time)
 
-    if packet.transcript is not None:
-        # data already received
+    session = sessions.get(session_id)
+    if session is None:
+        # the session has ended in the meantime
         return
-    packet.transcript = "Recieved data"
 
-    session = sessions[session_id]
-    session.untranscribed_timestamps.remove(timestamp)
-    session.transcribed_timestamps.append(timestamp)
+    times = {
+        "queued": packet.queued_time,
+        "first_sent": packet.first_sent_time or packet.sent_out_time,
+        "sent": packet.sent_out_time,
+        "received": received_time,
+    }
+    commit = None
+    with session.lock:
+        if CONFIG.RECORD_ASR:
+            record_asr_result(session, packet, tsw, ends, language, worker_trace)
+        session.untranscribed_timestamps.remove(timestamp)
+        session.transcribed_timestamps.append(timestamp)
+
+        commited = session.online_asr_processor.process_iter(tsw, ends)
+
+        if commited[0] is not None:
+            assert isinstance(commited[0], float)
+            assert isinstance(commited[1], float)
+            session.texts.current_texts[language].append(
+                commited[2], Timespan(commited[0], commited[1])
+            )
+            processing_queue_translate.append(
+                TranslatePacket(
+                    session_id=session_id,
+                    timestamp=timestamp,
+                    source_language=session.source_language,
+                    target_languages=session.supported_languages,
+                    source_text=commited[2],
+                    timespan=Timespan(commited[0], commited[1]),
+                )
+            )
+            times["committed"] = time.time()
+            COMMIT_SECONDS.observe(times["committed"] - received_time)
+            commit = (language, session.texts.current_texts[language].change_seq, commited[1])
 
-    processing_queue = [
-        x
-        for x in processing_queue
-        if not (x.session_id == session_id and x.timestamp == timestamp)
-    ]
-    commited = session.online_asr_processor.process_iter(tsw, ends)
-    if len(session.online_asr_processor.audio_buffer) / 16000 > 45:
-        session.online_asr_processor = OnlineASRProcessor(
-            create_tokenizer(session.transcript_language)
-        )
+        session.maybe_checkpoint()
 
-    if commited[0] is not None:
-        assert isinstance(commited[0], float)
-        assert isinstance(commited[1], float)
-        session.texts.current_texts[language].append(
-            commited[2], Timespan(commited[0], commited[1])
-        )
-        processing_queue_translate.append(
-            TranslatePacket(
-                session_id=session_id,
-                timestamp=timestamp,
-                source_language=session.source_language,
-                target_languages=session.supported_languages,
-                source_text=commited[2],
-                timespan=Timespan(commited[0], commited[1]),
-            )
-        )
+    session.tracer.transcribed(timestamp, times, worker_trace, commit)
 
 
-def got_offloaded_file(session_id: str, timestamp: int, tsw, ends, language: str):
+def got_offloaded_file(
+    session_id: str, timestamp: int, tsw, ends, language: str, worker_trace=None
+):
     global processing_queue, processing_queue_translate
 
-    packet = None
-    # search for the TranscribePacket in the processing queue by session_id and timestamp
-    for item in processing_queue:
-        if item.session_id == session_id and item.timestamp == timestamp:
-            packet = item
-            break
-
+    packet = processing_queue.pop(session_id, timestamp)
     if packet is None:
-        # no such packet found
+        # no such packet found or data already received
         return
     assert isinstance(packet, TranscribePacket)
+    packet.transcript = "Recieved data"
+    if packet.sent_out_time > 0:
+        INFERENCE_SECONDS.observe(time.time() - packet.sent_out_time)
 
-    if packet.transcript is not None:
-        # data already received
+    session = sessions.get(session_id)
+    if session is None:
         return
-    packet.transcript = "Recieved data"
 
-    session = sessions[session_id]
-    session.transcribed_timestamps.append(timestamp)
+    with session.lock:
+        if CONFIG.RECORD_ASR:
+            record_asr_result(session, packet, tsw, ends, language, worker_trace)
+        session.transcribed_timestamps.append(timestamp)
 
-    processing_queue = [
-        x
-        for x in processing_queue
-        if not (x.session_id == session_id and x.timestamp == timestamp)
-    ]
+        # tsw has format [(beg,end,"word1"), ...]
+        # we need to split it to text chunks with length ~40 characters
+        for i in range(len(tsw)):
+            session.texts.current_texts[language].append(
+                tsw[i][2], Timespan(tsw[i][0], tsw[i][1])
+            )
+
+        session.maybe_checkpoint()
+
+
+def record_worker_stats(stats: Dict) -> None:
+    """Adds the performance report a worker sent with its transcription, see `WorkerStats`"""
+    worker_stats.sample_sessions(len(sessions))
+    worker_stats.report(stats)
+    WORKER_AUDIO_SECONDS.inc(float(stats.get("audio_seconds") or 0.0), worker=stats["worker"])
+    WORKER_BUSY_SECONDS.inc(float(stats.get("wall_seconds") or 0.0), worker=stats["worker"])
+    trim_policy.real_time_factor = worker_stats.real_time_factor()
 
-    # tsw has format [(beg,end,"word1"), ...]
-    # we need to split it to text chunks with length ~40 characters
-    for i in range(len(tsw)):
-        session.texts.current_texts[language].append(
-            tsw[i][2], Timespan(tsw[i][0], tsw[i][1])
+
+def got_offloaded_result(request_data: Dict) -> None:
+    """Uses the result POSTed to `/offload_ASR`, the session has to be owned by this process"""
+    if request_data["is_file"]:
+        got_offloaded_file(
+            session_id=request_data["session_id"],
+            timestamp=int(request_data["timestamp"]),
+            tsw=request_data["tsw"],
+            ends=request_data["ends"],
+            language=request_data["language"],
+            worker_trace=request_data.get("trace"),
+        )
+    else:
+        got_offloaded_data(
+            session_id=request_data["session_id"],
+            timestamp=int(request_data["timestamp"]),
+            tsw=request_data["tsw"],
+            ends=request_data["ends"],
+            language=request_data["language"],
+            worker_trace=request_data.get("trace"),
         )
 
 
@@ -229,14 +533,14 @@ def submit_audio_chunk() -> Tuple[Response, int]:
     if session_id is None or session_id not in sessions or len(session_id) == 0:
         return session_not_found(session_id=session_id), 404
 
-    try:
-        session = sessions[session_id]
-    except KeyError:
+    session = sessions.get(session_id)
+    if session is None:
         return session_not_found(session_id=session_id), 404
 
-    session.save_audio_chunk(chunk=chunk, timestamp=timestamp)
     chunk_bytes: List[float] = [chunk[x] for x in chunk]
-    session.online_asr_processor.insert_audio_chunk(chunk_bytes)
+    with session.lock:
+        session.save_audio_chunk(chunk=chunk, timestamp=timestamp)
+        session.online_asr_processor.insert_audio_chunk(chunk_bytes)
 
     response_data = {"success": True, "session_id": session.session_id}
     response = make_response(json.dumps(response_data))
@@ -296,18 +600,34 @@ def get_latest_text_chunks():
     versions = {int(x): versions[x] for x in versions}
 
     session = sessions[session_id]
-    text_chunks = session.texts.current_texts[language].get_latest_text_chunks(versions)
-    new_versions = session.texts.current_texts[language].get_latest_versions()
+    current_text = session.texts.current_texts[language]
 
-    response_data = {
-        "success": True,
-        "session_id": session.session_id,
-        "text_chunks": text_chunks,
-        "versions": new_versions,
-    }
+    def build_response_data(versions: Dict[int, int]):
+        return {
+            "success": True,
+            "session_id": session.session_id,
+            "text_chunks": current_text.get_latest_text_chunks(versions),
+            "versions": current_text.get_latest_versions(),
+        }
 
-    response = make_response(json.dumps(response_data))
+    if len(versions) == 0:
+        # all the newly connected viewers ask for the same full snapshot
+        return cached_json_response(current_text, "snapshot", lambda: build_response_data({}))
+
+    change_seq = current_text.change_seq
+    etag = current_text.etag()
+    if etag in request.if_none_match:
+        # nothing changed since the client's last poll
+        current_text.mark_delivered(change_seq)
+        response = make_response("")
+        response.set_etag(etag)
+        response = add_cors_headers(response)
+        return response, 304
+
+    response = make_response(json.dumps(build_response_data(versions)))
+    current_text.mark_delivered(change_seq)
     response.headers["Content-Type"] = "application/json"
+    response.set_etag(etag)
     response = add_cors_headers(response)
     return response, 200
 
@@ -349,16 +669,279 @@ def get_latest_text_chunk_versions():
         return response, 404
 
     session = sessions[session_id]
-    versions = session.texts.current_texts[language].get_latest_versions()
+    current_text = session.texts.current_texts[language]
+    return cached_json_response(
+        current_text,
+        "versions",
+        lambda: {
+            "success": True,
+            "session_id": session.session_id,
+            "versions": current_text.get_latest_versions(),
+        },
+    )
 
-    response_data = {
-        "success": True,
-        "session_id": session.session_id,
-        "versions": versions,
-    }
 
-    response = make_response(json.dumps(response_data))
-    response.headers["Content-Type"] = "application/json"
+@app.route("/get_text_chunk_changes", methods=["GET"])
+def get_text_chunk_changes():
+    """Get the text chunks changed since the client's cursor.
+
+    Unlike `/get_latest_text_chunks`, the client does not send the versions of all the text chunks
+    it has, only the `cursor` it received in the previous response.
+
+    Args:
+        session_id (str): The session ID of the session.
+        language (str): The language of the text.
+        since (int): The cursor returned by the previous call, 0 on the first call.
+        wait (float): If there are no changes since `since`, wait up to this many seconds (at most
+            30) for one before responding, 0 by default.
+
+    Returns:
+        json: A JSON response with the following fields:
+        - success (`bool`): Whether the request was successful.
+        - session_id (`str`): The session ID of the session.
+        - text_chunks (`list[Dict[str, Union[int. str]]]`): The text chunks changed since `since`,
+          each with the fields `timestamp`, `version` and `text`.
+        - cursor (`int`): The value of `since` to use in the next call.
+        - snapshot (`bool`): True if `since` was too old and `text_chunks` contains all text chunks.
+
+        or a JSON response with the following fields:
+        - success (`bool=False`): The request was not successful.
+        - session_id (`str`): The session ID of the session.
+        - message (`str`): A message describing what went wrong if the request was not successful.
+
+    Example:
+        >>> requests.get("https://API_URL/get_text_chunk_changes?session_id=default&language=en&since=0")
+        {"success": true, "session_id": "default", "text_chunks": [{"timestamp": 0, "version": 1, "text": "Hello world!"}], "cursor": 2, "snapshot": false}
+        >>> requests.get("https://API_URL/get_text_chunk_changes?session_id=default&language=en&since=2")
+        {"success": true, "session_id": "default", "text_chunks": [], "cursor": 2, "snapshot": false}
+    """
+
+    global sessions
+    session_id = request.args.get("session_id", default=None, type=str)
+    language = request.args.get("language", default=None, type=str)
+    since = request.args.get("since", default=0, type=int)
+    wait = request.args.get("wait", default=0.0, type=float)
+
+    if session_id is None or session_id not in sessions or len(session_id) == 0:
+        return session_not_found(session_id=session_id), 404
+    if language is None or language not in sessions[session_id].texts.current_texts:
+        response = session_not_found(session_id=session_id)
+        response_data = json.loads(response.data)
+        response_data["message"] = "language not found"
+        response.data = json.dumps(response_data)
+        return response, 404
+
+    session = sessions[session_id]
+    current_text = session.texts.current_texts[language]
+    if wait > 0:
+        current_text.events.wait(since, min(wait, current_text.events.MAX_WAIT_SECONDS))
+
+    def build_response_data():
+        text_chunks, cursor, snapshot = current_text.get_changes_since(since)
+        return {
+            "success": True,
+            "session_id": session.session_id,
+            "text_chunks": text_chunks,
+            "cursor": cursor,
+            "snapshot": snapshot,
+        }
+
+    # viewers that are up to date poll with the same cursor, they share one cached response
+    return cached_json_response(current_text, f"changes_{since}", build_response_data)
+
+
+@app.route("/get_text_chunks_window", methods=["GET"])
+def get_text_chunks_window():
+    """Get a window of the text chunks, either the newest ones or a page of a timestamp range.
+
+    Args:
+        session_id (str): The session ID of the session.
+        language (str): The language of the text.
+        tail (int): If given, return the newest `tail` text chunks and ignore the other arguments.
+        start (int): The first timestamp of the range, 0 by default.
+        end (int): The timestamp after the end of the range, unbounded by default.
+        page_token (str): The `next_page_token` of the previous page, replaces `start`.
+        limit (int): The maximum number of text chunks on one page, 100 by default, clamped to
+            1 to 1000.
+
+    Returns:
+        json: A JSON response with the following fields:
+        - success (`bool`): Whether the request was successful.
+        - session_id (`str`): The session ID of the session.
+        - text_chunks (`list[Dict[str, Union[int. str]]]`): The text chunks of the window, each with
+          the fields `timestamp`, `version` and `text`.
+        - next_page_token (`Union[str, None]`): The token of the next page, null on the last page.
+        - cursor (`int`): The cursor to continue with in `/get_text_chunk_changes`.
+
+        or a JSON response with the following fields:
+        - success (`bool=False`): The request was not successful.
+        - session_id (`str`): The session ID of the session.
+        - message (`str`): A message describing what went wrong if the request was not successful.
+
+    Example:
+        >>> requests.get("https://API_URL/get_text_chunks_window?session_id=default&language=en&tail=1")
+        {"success": true, "session_id": "default", "text_chunks": [{"timestamp": 41, "version": 0, "text": "This is a new text!"}], "next_page_token": null, "cursor": 97}
+        >>> requests.get("https://API_URL/get_text_chunks_window?session_id=default&language=en&start=0&limit=2")
+        {"success": true, "session_id": "default", "text_chunks": [{"timestamp": 0, "version": 1, "text": "Hello world!"}, {"timestamp": 1, "version": 0, "text": "How are you?"}], "next_page_token": "2", "cursor": 97}
+    """
+
+    global sessions
+    session_id = request.args.get("session_id", default=None, type=str)
+    language = request.args.get("language", default=None, type=str)
+    tail = request.args.get("tail", default=None, type=int)
+    start = request.args.get("start", default=0, type=int)
+    end = request.args.get("end", default=None, type=int)
+    page_token = request.args.get("page_token", default=None, type=str)
+    limit = max(1, min(request.args.get("limit", default=100, type=int), 1000))
+
+    if session_id is None or session_id not in sessions or len(session_id) == 0:
+        return session_not_found(session_id=session_id), 404
+    if language is None or language not in sessions[session_id].texts.current_texts:
+        response = session_not_found(session_id=session_id)
+        response_data = json.loads(response.data)
+        response_data["message"] = "language not found"
+        response.data = json.dumps(response_data)
+        return response, 404
+
+    if page_token is not None:
+        if not page_token.isdigit():
+            response = json_response(
+                {"success": False, "session_id": session_id, "message": "Invalid page token"}
+            )
+            return response, 400
+        start = int(page_token)
+
+    session = sessions[session_id]
+    current_text = session.texts.current_texts[language]
+
+    def build_response_data():
+        cursor = current_text.change_seq
+        if tail is not None:
+            text_chunks, next_start = current_text.get_tail(tail), None
+        else:
+            text_chunks, next_start = current_text.get_range(start, end, limit)
+        return {
+            "success": True,
+            "session_id": session.session_id,
+            "text_chunks": text_chunks,
+            "next_page_token": None if next_start is None else str(next_start),
+            "cursor": cursor,
+        }
+
+    key = f"window_{tail}" if tail is not None else f"window_{start}_{end}_{limit}"
+    return cached_json_response(current_text, key, build_response_data)
+
+
+@app.route("/stream_text_chunks", methods=["GET"])
+def stream_text_chunks():
+    """Stream the changes of the text chunks and correction rules as Server-Sent Events.
+
+    The stream sends these events, each with the `cursor` of the change as its id:
+    - `sync`: sent when the client connects behind the recent history. Its data has the fields
+      `text_chunks`, `entries` (correction rules), `cursor` and `snapshot`, same as in
+      `/get_text_chunk_changes` and `/get_correction_rules`.
+    - `chunks`: a new version of a text chunk, the data has the fields `text_chunks` and `cursor`.
+    - `rules`: new correction rules, the data has the fields `entries` and `cursor`.
+
+    Args:
+        session_id (str): The session ID of the session.
+        language (str): The language of the text.
+        since (int): The cursor to resume from, 0 to get everything. The `Last-Event-ID` header
+            sent by reconnecting `EventSource`s takes precedence.
+
+    Example:
+        >>> new EventSource("https://API_URL/stream_text_chunks?session_id=default&language=en&since=0")
+    """
+
+    global sessions
+    session_id = request.args.get("session_id", default=None, type=str)
+    language = request.args.get("language", default=None, type=str)
+    since = request.args.get("since", default=0, type=int)
+    last_event_id = request.headers.get("Last-Event-ID", default=None, type=int)
+    if last_event_id is not None:
+        since = last_event_id
+
+    if session_id is None or session_id not in sessions or len(session_id) == 0:
+        return session_not_found(session_id=session_id), 404
+    if language is None or language not in sessions[session_id].texts.current_texts:
+        response = session_not_found(session_id=session_id)
+        response_data = json.loads(response.data)
+        response_data["message"] = "language not found"
+        response.data = json.dumps(response_data)
+        return response, 404
+
+    current_text = sessions[session_id].texts.current_texts[language]
+    response = Response(
+        current_text.events.subscribe(since, current_text.catch_up_event),
+        mimetype="text/event-stream",
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response = add_cors_headers(response)
+    return response, 200
+
+
+@app.route("/get_subtitles", methods=["GET"])
+def get_subtitles():
+    """Get the current subtitles of the text as a .srt or .vtt file, usable while the session is
+    still running.
+
+    Args:
+        session_id (str): The session ID of the session.
+        language (str): The language of the text.
+        format (str): "srt" (default) or "vtt".
+
+    Returns:
+        The subtitle file, one cue per text chunk. Responds with 304 if the `If-None-Match` header
+        has the current `ETag`.
+
+        or a JSON response with the following fields:
+        - success (`bool=False`): The request was not successful.
+        - session_id (`str`): The session ID of the session.
+        - message (`str`): A message describing what went wrong if the request was not successful.
+
+    Example:
+        >>> requests.get("https://API_URL/get_subtitles?session_id=default&language=en&format=vtt")
+        WEBVTT
+
+        0
+        00:00:00.000 --> 00:00:02.500
+        Hello world!
+    """
+
+    global sessions
+    session_id = request.args.get("session_id", default=None, type=str)
+    language = request.args.get("language", default=None, type=str)
+    subtitle_format = request.args.get("format", default="srt", type=str)
+
+    if session_id is None or session_id not in sessions or len(session_id) == 0:
+        return session_not_found(session_id=session_id), 404
+    if language is None or language not in sessions[session_id].texts.current_texts:
+        response = session_not_found(session_id=session_id)
+        response_data = json.loads(response.data)
+        response_data["message"] = "language not found"
+        response.data = json.dumps(response_data)
+        return response, 404
+    if subtitle_format not in CurrentASRText.SUBTITLE_HEADERS:
+        response = json_response(
+            {"success": False, "session_id": session_id, "message": "Unsupported format"}
+        )
+        return response, 400
+
+    current_text = sessions[session_id].texts.current_texts[language]
+    etag = current_text.etag()
+    if etag in request.if_none_match:
+        response = make_response("")
+        response.set_etag(etag)
+        response = add_cors_headers(response)
+        return response, 304
+
+    # only changed cues are rendered, the file is streamed cue by cue
+    response = Response(
+        current_text.subtitle_cues(subtitle_format),
+        mimetype="application/x-subrip" if subtitle_format == "srt" else "text/vtt",
+    )
+    response.set_etag(etag)
     response = add_cors_headers(response)
     return response, 200
 
@@ -552,48 +1135,35 @@ def offload_computation():
         request_data = request.get_json()
         assert isinstance(request_data, dict)
 
-        if request_data["is_file"]:
-            got_offloaded_file(
-                session_id=request_data["session_id"],
-                timestamp=int(request_data["timestamp"]),
-                tsw=request_data["tsw"],
-                ends=request_data["ends"],
-                language=request_data["language"],
-            )
+        if "stats" in request_data:
+            record_worker_stats(request_data["stats"])
+
+        if request_data["session_id"] in sessions:
+            got_offloaded_result(request_data)
         else:
-            got_offloaded_data(
-                session_id=request_data["session_id"],
-                timestamp=int(request_data["timestamp"]),
-                tsw=request_data["tsw"],
-                ends=request_data["ends"],
-                language=request_data["language"],
-            )
+            # the packet was handed out by another API process
+            sessions.forward_to_owner(request_data["session_id"], "/offload_ASR", request_data)
 
         response_data = {
             "success": True,
         }
 
-        response = make_response(
-            jsonpickle.encode(response_data, unpicklable=True, indent=4)
-        )
+        response = make_response(json.dumps(response_data))
         response.headers["Content-Type"] = "application/json"
         response = add_cors_headers(response)
         return response, 200
 
     elif request.method == "GET":
         response_data = get_data_to_offload()
-        response = make_response(
-            jsonpickle.encode(response_data, unpicklable=True, indent=4)
-        )
+        # the audio makes this the largest response, encode it without any padding
+        response = make_response(encode_json(response_data))
         response.headers["Content-Type"] = "application/json"
         response = add_cors_headers(response)
         return response, 200
 
     else:
         response_data = {"success": False, "message": "Method not allowed"}
-        response = make_response(
-            jsonpickle.encode(response_data, unpicklable=True, indent=4)
-        )
+        response = make_response(json.dumps(response_data))
         response.headers["Content-Type"] = "application/json"
         response = add_cors_headers(response)
         return response, 405
@@ -604,7 +1174,8 @@ def get_active_sessions():
     """Get the active sessions.
 
     This route returns a JSON payload with the following fields:
-    - active_sessions (`list`): A list of active sessions.
+    - active_sessions (`list`): A list of active sessions, of all nodes if the sessions are
+      sharded.
 
     Example:
         >>> requests.get("https://API_URL/get_active_sessions")
@@ -612,8 +1183,11 @@ def get_active_sessions():
     """
 
     global sessions
+    active_sessions = sessions.active_session_ids()
+    if shard_ring is not None and FORWARDED_HEADER not in request.headers:
+        active_sessions += active_sessions_of_other_nodes()
     response_data = {
-        "active_sessions": list(sessions.keys()),
+        "active_sessions": active_sessions,
     }
 
     response = make_response(json.dumps(response_data))
@@ -654,7 +1228,7 @@ def create_session():
         response.data = json.dumps(response_data)
         return response, 404
 
-    if session_id in sessions:
+    if sessions.create(session_id, lambda: new_session(session_id)) is None:
         response = session_not_found(session_id=session_id)
         response_data = json.loads(response.data)
         response_data["message"] = "Session already exists"
@@ -662,7 +1236,6 @@ def create_session():
         response.data = json.dumps(response_data)
         return response, 404
 
-    sessions[session_id] = Session(session_id=session_id, config=CONFIG)
     response_data = {
         "success": True,
         "message": f"Successfully created session {session_id}",
@@ -698,16 +1271,17 @@ def end_session():
     global sessions
     session_id = request.args.get("session_id", default=None, type=str)
 
-    if session_id is None or session_id not in sessions or len(session_id) == 0:
+    # only one of concurrent requests ending the same session gets it
+    session = None if session_id is None else sessions.pop(session_id)
+    if session is None or len(session_id) == 0:
         response = session_not_found(session_id=session_id)
         return response, 404
 
-    sessions[session_id].end_session()
-    del sessions[session_id]
+    session.end_session()
 
     # throw away everything from processing queue that belongs to this session
     global processing_queue
-    processing_queue = [x for x in processing_queue if x.session_id != session_id]
+    processing_queue.remove_session(session_id)
 
     response_data = {
         "success": True,
@@ -740,12 +1314,9 @@ def rate_text_chunk() -> Tuple[Response, int]:
         return response, 404
 
     session = sessions[session_id]
-    session.texts.current_texts[language].rate_text_chunk(
+    new_rating: int = session.texts.current_texts[language].rate_text_chunk(
         timestamp, version, rating_update
     )
-    new_rating: int = (
-        session.texts.current_texts[language].text_chunks[timestamp][version].rating
-    )
 
     response_data = {
         "success": True,
@@ -791,16 +1362,12 @@ def submit_correction_rules():
         return response, 404
 
     session = sessions[session_id]
-    session.texts.current_texts[language].correction_rules = []
-
-    for rule in request_data:
-        session.texts.current_texts[language].correction_rules.append(CorrectionRule())
-        session.texts.current_texts[language].correction_rules[-1].decode_from_dict(
-            rule
-        )
+    current_text = session.texts.current_texts[language]
+    with current_text.lock:
+        current_text.set_encoded_correction_rules(request_data)
 
-    # clear empty rules
-    session.texts.current_texts[language].clear_empty_correction_rules()
+        # clear empty rules
+        current_text.clear_empty_correction_rules()
     response_data = {
         "success": True,
         "message": f"Successfully uploaded rules for session {session_id}, language {language}",
@@ -828,13 +1395,177 @@ def get_correction_rules():
         return response, 404
 
     session = sessions[session_id]
-    response_data = []
-    for rule in session.texts.current_texts[language].correction_rules:
-        response_data.append(rule.encode_to_dict())
+    current_text = session.texts.current_texts[language]
+    return cached_json_response(
+        current_text,
+        "correction_rules",
+        lambda: {
+            "locked": True,
+            "entries": current_text.encode_correction_rules(),
+        },
+        delivers_text=False,
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Get the metrics of this API process in the Prometheus text format: depth and age of the
+    work queues, audio buffered per session, latencies of the pipeline stages and endpoints,
+    resends and connected viewers.
+
+    Example:
+        >>> requests.get("https://API_URL/metrics")
+        # HELP coletra_queue_depth Packets waiting in a work queue, handed out or not
+        # TYPE coletra_queue_depth gauge
+        coletra_queue_depth{queue="transcribe"} 2
+        ...
+    """
+    response = make_response(render_metrics())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response = add_cors_headers(response)
+    return response, 200
+
+
+def check_profiling_token() -> Union[Tuple[Response, int], None]:
+    """Returns the error response if profiling is disabled or the token is wrong"""
+    if not CONFIG.PROFILING_TOKEN:
+        return json_response({"success": False, "message": "Profiling disabled"}), 403
+    if request.args.get("token", default="", type=str) != CONFIG.PROFILING_TOKEN:
+        return json_response({"success": False, "message": "Invalid token"}), 403
+    return None
+
+
+@app.route("/start_profiling", methods=["GET"])
+def start_profiling():
+    """Start the sampling profiler of this API process, see `src.profiler`. Available only with
+    the `COLETRA_PROFILING_TOKEN` environment variable set.
+
+    Args:
+        token (`str`): The value of `COLETRA_PROFILING_TOKEN`.
+        seconds (`float`): How long to profile, 30 by default, at most 600.
+        fraction (`float`): Optional, profile only this fraction of the requests, otherwise all
+            threads of the process are profiled.
+
+    Returns:
+        json: A JSON response with the following fields:
+        - success (`bool`): Whether the profiler was started.
+        - path (`str`): The file the folded stacks will be written to when profiling ends.
+        - message (`str`): What went wrong if the profiler was not started.
+
+    Example:
+        >>> requests.get("https://API_URL/start_profiling?token=secret&seconds=60&fraction=0.1")
+        {"success": true, "path": "profiles/profile-20240301-101500-4242.folded"}
+    """
+    error = check_profiling_token()
+    if error is not None:
+        return error
+    seconds = request.args.get("seconds", default=30.0, type=float)
+    fraction = request.args.get("fraction", default=None, type=float)
+
+    valid_fraction = fraction is None or 0.0 < fraction <= 1.0
+    if not 0.0 < seconds <= profiler.MAX_SECONDS or not valid_fraction:
+        return json_response({"success": False, "message": "Invalid seconds or fraction"}), 400
+    if profiler.running():
+        return json_response({"success": False, "message": "Profiler already running"}), 409
+    path = profiler.start(seconds, fraction)
+    return json_response({"success": True, "path": path}), 200
+
+
+@app.route("/stop_profiling", methods=["GET"])
+def stop_profiling():
+    """Stop the sampling profiler before its time is up and write the folded stacks.
+
+    Args:
+        token (`str`): The value of `COLETRA_PROFILING_TOKEN`.
+
+    Example:
+        >>> requests.get("https://API_URL/stop_profiling?token=secret")
+        {"success": true, "path": "profiles/profile-20240301-101500-4242.folded", "samples": 5120}
+    """
+    error = check_profiling_token()
+    if error is not None:
+        return error
+    path = profiler.stop()
+    if path is None:
+        return json_response({"success": False, "message": "Profiler not running"}), 409
+    return json_response({"success": True, "path": path, "samples": profiler.samples}), 200
+
+
+@app.route("/get_worker_stats", methods=["GET"])
+def get_worker_stats():
+    """Get the performance of the workers transcribing for this API process, from the reports
+    they send with their transcriptions, and the number of workers needed for some lectures.
+
+    With several API processes or nodes, each one reports the workers' results it received,
+    sum `worker_seconds` and `lecture_seconds` over them for the whole deployment.
+
+    Args:
+        lectures (`int`): Optional, the number of concurrent lectures to estimate the workers
+            for.
+
+    Returns:
+        json: A JSON response with the following fields:
+        - success (`bool`): Whether the request was successful.
+        - workers (`Dict[str, Dict]`): Per worker name: its model, beam_size and batch_size, the
+          number of reports, the total audio_seconds, wall_seconds, vad_trimmed_seconds,
+          fetch_seconds and parse_seconds, the real_time_factor (wall seconds per audio second),
+          the utilization (share of the time since its first report spent transcribing),
+          first_seen and last_seen.
+        - worker_seconds (`float`): The wall seconds of all the workers.
+        - lecture_seconds (`float`): The number of active sessions integrated over time.
+        - worker_seconds_per_lecture_second (`float`): Worker time needed per lecture, i.e. the
+          workers one lecture keeps busy, None before any lecture time.
+        - workers_needed (`float`): `lectures` times the above, if `lectures` is given.
+
+    Example:
+        >>> requests.get("https://API_URL/get_worker_stats?lectures=40")
+        {"success": true, "workers": {"gpu1:4242": {"reports": 812, "audio_seconds": 9120.5, "wall_seconds": 301.2, "real_time_factor": 0.033, "utilization": 0.41, "model": "large-v2", "beam_size": 5, ...}}, "worker_seconds": 301.2, "lecture_seconds": 1830.0, "worker_seconds_per_lecture_second": 0.165, "workers_needed": 6.6}
+    """
+    lectures = request.args.get("lectures", default=None, type=int)
+
+    worker_stats.sample_sessions(len(sessions))
+    response_data = {"success": True, **worker_stats.summary(lectures)}
+    response = make_response(json.dumps(response_data))
+    response.headers["Content-Type"] = "application/json"
+    response = add_cors_headers(response)
+    return response, 200
+
+
+@app.route("/get_latency_breakdown", methods=["GET"])
+def get_latency_breakdown():
+    """Get where the time of the recent audio packets of a session went, from queueing to the
+    first viewer getting the text, see `src.tracing.STAGES`. The traces are also appended to
+    `traces.jsonl` in the session folder.
+
+    Args:
+        session_id (`str`): The session ID of the session.
+        limit (`int`): The number of the most recent traces to return, 20 by default.
+
+    Returns:
+        json: A JSON response with the following fields:
+        - success (`bool`): Whether the request was successful.
+        - session_id (`str`): The session ID of the session.
+        - stages (`Dict[str, Dict[str, float]]`): The count, mean, p50, p90, p99 and max of every
+          stage in seconds, over the recent traces.
+        - traces (`List[Dict]`): The most recent traces, each with the timestamp of the packet,
+          the time it was queued and the seconds of its stages.
+
+    Example:
+        >>> requests.get("https://API_URL/get_latency_breakdown?session_id=default&limit=1")
+        {"success": true, "session_id": "default", "stages": {"queue": {"count": 40, "mean": 0.2, ...}, ...}, "traces": [{"timestamp": 41, "queued": 1700000000.0, "stages": {"queue": 0.1, ...}}]}
+    """
+    global sessions
+    session_id = request.args.get("session_id", default=None, type=str)
+    limit = request.args.get("limit", default=20, type=int)
+
+    session = None if session_id is None else sessions.get(session_id)
+    if session is None:
+        return session_not_found(session_id=session_id), 404
 
     response_data = {
-        "locked": True,
-        "entries": response_data,
+        "success": True,
+        "session_id": session.session_id,
+        **session.tracer.breakdown(limit),
     }
     response = make_response(json.dumps(response_data))
     response.headers["Content-Type"] = "application/json"
@@ -864,12 +1595,13 @@ def submit_audio_file():
         return plain_response(f"Wrong sample rate: {sr} instead of 16000"), 400
 
     # get a random session_id
-    session_id = "".join(random.choice(string.ascii_letters) for i in range(32))
-    while session_id in sessions:
+    session = None
+    while session is None:
         session_id = "".join(random.choice(string.ascii_letters) for i in range(32))
-
-    sessions[session_id] = Session(session_id=session_id, config=CONFIG)
-    session = sessions[session_id]
+        if shard_ring is not None and shard_ring.owner(session_id) != CONFIG.SHARD_SELF:
+            # place the session on this node, which already has its audio
+            continue
+        session = sessions.create(session_id, lambda: new_session(session_id))
     processing_queue.append(
         TranscribePacket(
             session_id=session_id,
@@ -896,32 +1628,24 @@ def submit_audio_file():
 def got_translated_data(session_id, timestamp, timespan, translated_text):
     global processing_queue_translate
 
-    packet = None
-    # search for the TranscribePacket in the processing queue by session_id and timestamp
-    for item in processing_queue_translate:
-        if item.session_id == session_id and item.timestamp == timestamp:
-            packet = item
-            break
-
+    packet = processing_queue_translate.pop(session_id, timestamp)
     if packet is None:
-        # no such packet found
+        # no such packet found or data already received
         return
 
     assert isinstance(packet, TranslatePacket)
-
-    if packet.recieved:
-        # data already received
-        return
     packet.recieved = True
+    TRANSLATION_SECONDS.observe(time.time() - packet.queued_time)
 
-    session = sessions[session_id]
-
-    processing_queue_translate = [
-        x for x in processing_queue_translate if not x == packet
-    ]
+    session = sessions.get(session_id)
+    if session is None:
+        return
+    session.tracer.translated(timestamp, packet.queued_time)
 
-    timespan = jsonpickle.decode(timespan)
-    assert isinstance(timespan, Timespan)
+    if isinstance(timespan, str):
+        # translation workers that still echo the older jsonpickle encoded timespan
+        timespan = json.loads(timespan)
+    timespan = Timespan.from_dict(timespan)
 
     for language in translated_text:
         if language != session.transcript_language:
@@ -930,14 +1654,19 @@ def got_translated_data(session_id, timestamp, timespan, translated_text):
             )
 
 
-def get_translate_data():
-    for item in processing_queue_translate:
-        response_data = item.get_data_to_offload()
-        if response_data is not None:
-            return response_data
+def got_translation_result(request_data: Dict) -> None:
+    """Uses the result POSTed to `/offload_translation`, the session has to be owned by this
+    process"""
+    got_translated_data(
+        session_id=request_data["session_id"],
+        timestamp=int(request_data["timestamp"]),
+        translated_text=request_data["translated_text"],
+        timespan=request_data["timespan"],
+    )
 
-    response_data = None
-    return response_data
+
+def get_translate_data():
+    return processing_queue_translate.next_to_offload()
 
 
 @app.route("/offload_translation", methods=["GET", "POST"])
@@ -946,57 +1675,95 @@ def offload_translation():
         request_data = request.get_json()
         assert isinstance(request_data, dict)
 
-        got_translated_data(
-            session_id=request_data["session_id"],
-            timestamp=int(request_data["timestamp"]),
-            translated_text=request_data["translated_text"],
-            timespan=request_data["timespan"],
-        )
+        if request_data["session_id"] in sessions:
+            got_translation_result(request_data)
+        else:
+            sessions.forward_to_owner(
+                request_data["session_id"], "/offload_translation", request_data
+            )
 
         response_data = {
             "success": True,
         }
 
-        response = make_response(
-            jsonpickle.encode(response_data, unpicklable=True, indent=4)
-        )
+        response = make_response(json.dumps(response_data))
         response.headers["Content-Type"] = "application/json"
         response = add_cors_headers(response)
         return response, 200
 
     elif request.method == "GET":
         response_data = get_translate_data()
-        response = make_response(
-            jsonpickle.encode(response_data, unpicklable=True, indent=4)
-        )
+        response = make_response(encode_json(response_data))
         response.headers["Content-Type"] = "application/json"
         response = add_cors_headers(response)
         return response, 200
 
     else:
         response_data = {"success": False, "message": "Method not allowed"}
-        response = make_response(
-            jsonpickle.encode(response_data, unpicklable=True, indent=4)
-        )
+        response = make_response(json.dumps(response_data))
         response.headers["Content-Type"] = "application/json"
         response = add_cors_headers(response)
         return response, 405
 
 
+FORWARDED_HANDLERS: Dict[str, Callable[[Dict], None]] = {
+    "/offload_ASR": got_offloaded_result,
+    "/offload_translation": got_translation_result,
+}
+
+
+def handle_forwarded(endpoint: str, request_data: Dict) -> None:
+    """Handles a request that another API process forwarded to the owner of its session"""
+    FORWARDED_HANDLERS[endpoint](request_data)
+
+
+def restore_sessions() -> None:
+    """Restores the sessions that were not ended before the last shutdown of the API, except
+    those owned by another API process sharing the state"""
+    start_time = time.time()
+    for save_path in find_active_session_folders():
+        # save paths are "recordings/{session_id}/{index}"
+        session_id = save_path.split("/")[1]
+        try:
+            sessions.create(session_id, lambda: Session.restore(save_path, CONFIG, trim_policy))
+        except Exception as e:
+            print("cannot restore session from " + save_path + ": " + str(e), file=sys.stderr)
+    print(
+        f"restored {len(sessions)} sessions in {time.time() - start_time:.2f} s", file=sys.stderr
+    )
+
+
 def main() -> None:
+    start_time = time.time()
+    warm_up_tokenizers(CONFIG.TOKENIZER_LANGUAGES)
+    print(
+        f"loaded tokenizers for {', '.join(CONFIG.TOKENIZER_LANGUAGES)} in "
+        f"{time.time() - start_time:.2f} s",
+        file=sys.stderr,
+    )
+    restore_sessions()
+    sessions.start_forwarding(handle_forwarded)
+
     servercert: Union[str, None] = os.environ.get("SERVERCERT")
     serverkey: Union[str, None] = os.environ.get("SERVERKEY")
 
     host = os.environ.get("COLETRA_API_HOST", "localhost")
     port = int(os.environ.get("COLETRA_API_PORT", 5000))
 
+    if CONFIG.API_SERVER == "asgi":
+        from .asgi import serve
+
+        serve(host, port, servercert, serverkey)
+        return
+
     if servercert is None or serverkey is None:
-        app.run(port=port, host=host)
+        app.run(port=port, host=host, threaded=True)
     else:
         app.run(
             port=port,
             host=host,
             ssl_context=(servercert, serverkey),
+            threaded=True,
         )
 
 
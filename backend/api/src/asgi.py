@@ -0,0 +1,352 @@
+"""ASGI application of the API, selected with `COLETRA_API_SERVER=asgi` and served by uvicorn.
+
+Push streams (`/stream_text_chunks`) and long-polls (`/get_text_chunk_changes` with `wait`) wait
+on the event loop, so an idle viewer costs a coroutine instead of a thread. With
+`COLETRA_SHARD_ROUTING=proxy`, requests for sessions of other nodes are proxied on the event loop
+too, so streams from the owner pass through without holding a thread. Every other request,
+including audio ingest and the offload endpoints, has its body received on the event loop and is
+then handled by the unchanged Flask view on a pool of `ASGI_THREADS` threads, so the endpoint
+contract is the same in both server modes.
+"""
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from .api import CONFIG, PROXY_TIMEOUT_SECONDS, app, node_to_route_to, sessions
+from .sharding import FORWARDED_HEADER, HOP_BY_HOP_HEADERS, node_ssl_context
+from .text_handlers import CurrentASRText
+
+Scope = Dict
+Receive = Callable[[], Awaitable[Dict]]
+Send = Callable[[Dict], Awaitable[None]]
+Headers = List[Tuple[bytes, bytes]]
+
+CORS_HEADERS: Headers = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-allow-methods", b"*"),
+]
+
+executor = ThreadPoolExecutor(max_workers=CONFIG.ASGI_THREADS, thread_name_prefix="flask-view")
+
+
+def wsgi_environ(scope: Scope, body: bytes) -> Dict:
+    """Returns the WSGI environ of the HTTP request `scope` with the already received `body`"""
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    for raw_name, raw_value in scope["headers"]:
+        name = raw_name.decode("latin-1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+def run_flask_view(environ: Dict) -> Tuple[int, Headers, bytes]:
+    """Runs the Flask app on one request, returns the status, headers and body"""
+    response: Dict = {}
+
+    def start_response(status: str, headers: List[Tuple[str, str]], exc_info=None) -> None:
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [
+            (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers
+        ]
+
+    result = app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+async def receive_body(receive: Receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+async def serve_with_flask(
+    scope: Scope, receive: Receive, send: Send, body: Union[bytes, None] = None
+) -> None:
+    if body is None:
+        body = await receive_body(receive)
+    environ = wsgi_environ(scope, body)
+    loop = asyncio.get_running_loop()
+    status, headers, response_body = await loop.run_in_executor(
+        executor, run_flask_view, environ
+    )
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": response_body})
+
+
+def query_args(scope: Scope) -> Dict[str, str]:
+    return dict(parse_qsl(scope["query_string"].decode("latin-1")))
+
+
+def int_arg(value: Union[str, None], default: int) -> int:
+    """Parses an integer argument the way Flask's `request.args.get(..., type=int)` does"""
+    try:
+        return int(value) if value is not None else default
+    except ValueError:
+        return default
+
+
+def find_text(args: Dict[str, str]) -> Union[CurrentASRText, None]:
+    session = sessions.get(args.get("session_id", ""))
+    if session is None:
+        return None
+    return session.texts.current_texts.get(args.get("language", ""))
+
+
+async def stream_text_chunks(scope: Scope, receive: Receive, send: Send) -> None:
+    """Native version of the `/stream_text_chunks` view, see its documentation"""
+    args = query_args(scope)
+    current_text = find_text(args)
+    if current_text is None:
+        # the Flask view responds with the usual error
+        await serve_with_flask(scope, receive, send)
+        return
+
+    since = int_arg(args.get("since"), 0)
+    for name, value in scope["headers"]:
+        if name.lower() == b"last-event-id":
+            since = int_arg(value.decode("latin-1"), since)
+
+    async def wait_for_disconnect() -> None:
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    disconnect = asyncio.ensure_future(wait_for_disconnect())
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ]
+            + CORS_HEADERS,
+        }
+    )
+    try:
+        events = current_text.events.subscribe_async(since, current_text.catch_up_event)
+        async for payload in events:
+            if disconnect.done():
+                return
+            await send({"type": "http.response.body", "body": payload, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        disconnect.cancel()
+
+
+async def get_text_chunk_changes(scope: Scope, receive: Receive, send: Send) -> None:
+    """Waits for the long-poll of `/get_text_chunk_changes` on the event loop, then lets the
+    Flask view build the response"""
+    args = query_args(scope)
+    wait = args.pop("wait", None)
+    current_text = find_text(args)
+    if wait is not None and current_text is not None:
+        try:
+            timeout = min(float(wait), current_text.events.MAX_WAIT_SECONDS)
+        except ValueError:
+            timeout = 0.0
+        if timeout > 0:
+            await current_text.events.wait_async(int_arg(args.get("since"), 0), timeout)
+        scope = dict(scope, query_string=urlencode(args).encode("latin-1"))
+    await serve_with_flask(scope, receive, send)
+
+
+async def read_chunks(reader: asyncio.StreamReader, headers: Dict[str, str]):
+    """Yields the body of an HTTP/1.1 response as it arrives, every read waits at most
+    `PROXY_TIMEOUT_SECONDS`"""
+
+    async def read(coroutine):
+        return await asyncio.wait_for(coroutine, PROXY_TIMEOUT_SECONDS)
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await read(reader.readline())).split(b";", 1)[0], 16)
+            if size == 0:
+                return
+            yield await read(reader.readexactly(size))
+            await read(reader.readexactly(2))  # CRLF after the chunk
+    elif "content-length" in headers:
+        yield await read(reader.readexactly(int(headers["content-length"])))
+    else:
+        while True:
+            chunk = await read(reader.read(64 * 1024))
+            if not chunk:
+                return
+            yield chunk
+
+
+async def proxy_to_owner(scope: Scope, receive: Receive, send: Send, owner: str) -> None:
+    """Native version of the proxying of `api.route_to_owner`, the response of the owner is
+    passed on as it arrives"""
+    body = await receive_body(receive)
+    url = urlsplit(owner)
+    port = url.port or (443 if url.scheme == "https" else 80)
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(url.hostname, port, ssl=node_ssl_context(owner)),
+            PROXY_TIMEOUT_SECONDS,
+        )
+    except (OSError, asyncio.TimeoutError) as e:
+        print(f"cannot reach node {owner}: {e}", file=sys.stderr)
+        response_body = {
+            "success": False,
+            "session_id": query_args(scope).get("session_id"),
+            "message": "Session node unreachable",
+        }
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 502,
+                "headers": [(b"content-type", b"application/json")] + CORS_HEADERS,
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(response_body).encode()})
+        return
+
+    disconnect: Union[asyncio.Future, None] = None
+    try:
+        path = scope["path"]
+        if scope["query_string"]:
+            path += "?" + scope["query_string"].decode("latin-1")
+        lines = [f"{scope['method']} {path} HTTP/1.1", f"Host: {url.netloc}"]
+        for raw_name, raw_value in scope["headers"]:
+            name = raw_name.decode("latin-1")
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                lines.append(f"{name}: {raw_value.decode('latin-1')}")
+        lines += [f"{FORWARDED_HEADER}: 1", f"Content-Length: {len(body)}", "Connection: close"]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), PROXY_TIMEOUT_SECONDS)
+        status = int(status_line.split(b" ", 2)[1])
+        headers: Dict[str, str] = dict()
+        response_headers: Headers = []
+        while True:
+            line = await asyncio.wait_for(reader.readline(), PROXY_TIMEOUT_SECONDS)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, value = line.decode("latin-1").split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+            if name.strip().lower() not in HOP_BY_HOP_HEADERS:
+                response_headers.append((name.strip().lower().encode(), value.strip().encode()))
+
+        async def wait_for_disconnect() -> None:
+            while (await receive())["type"] != "http.disconnect":
+                pass
+
+        disconnect = asyncio.ensure_future(wait_for_disconnect())
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        try:
+            async for chunk in read_chunks(reader, headers):
+                if disconnect.done():
+                    return
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            # the response has started, it can only be cut short
+            print(f"proxied response of {owner} failed: {e}", file=sys.stderr)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if disconnect is not None:
+            disconnect.cancel()
+        writer.close()
+
+
+ROUTES: Dict[str, Callable[[Scope, Receive, Send], Awaitable[None]]] = {
+    "/stream_text_chunks": stream_text_chunks,
+    "/get_text_chunk_changes": get_text_chunk_changes,
+}
+
+
+async def lifespan(receive: Receive, send: Send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope: Scope, receive: Receive, send: Send) -> None:
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if CONFIG.SHARD_ROUTING == "proxy":
+        forwarded = any(
+            name.lower() == FORWARDED_HEADER.lower().encode() for name, _ in scope["headers"]
+        )
+        owner = node_to_route_to(query_args(scope).get("session_id"), scope["method"], forwarded)
+        if owner is not None:
+            await proxy_to_owner(scope, receive, send, owner)
+            return
+
+    route = ROUTES.get(scope["path"])
+    if route is not None and scope["method"] == "GET":
+        await route(scope, receive, send)
+    else:
+        await serve_with_flask(scope, receive, send)
+
+
+def serve(host: str, port: int, servercert: Union[str, None], serverkey: Union[str, None]) -> None:
+    try:
+        import uvicorn
+    except ImportError:
+        print(
+            "COLETRA_API_SERVER=asgi needs uvicorn, install the api with the asgi extra",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    uvicorn.run(
+        application,
+        host=host,
+        port=port,
+        ssl_certfile=servercert,
+        ssl_keyfile=serverkey,
+        # every API process is a separate instance of the shared state, see `STATE_BACKEND`
+        workers=1,
+    )
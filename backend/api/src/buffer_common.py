@@ -1,8 +1,12 @@
 # from typing import List
+import itertools
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, Tuple, Union
+
 import numpy as np
 import tokenize_uk
 from mosestokenizer import MosesTokenizer
-from typing import List, Tuple
 
 # # DONE?: rework this according to computation_node_fast
 # class AudioBuffer:
@@ -44,9 +48,9 @@ from typing import List, Tuple
 
 class HypothesisBuffer:
     def __init__(self):
-        self.commited_in_buffer = []
-        self.buffer = []
-        self.new = []
+        self.commited_in_buffer = deque()
+        self.buffer = deque()
+        self.new = deque()
 
         self.last_commited_time = 0
         self.last_commited_word = None
@@ -56,7 +60,7 @@ class HypothesisBuffer:
         # the new tail is added to self.new
 
         new = [(a + offset, b + offset, t) for a, b, t in new]
-        self.new = [(a, b, t) for a, b, t in new if a > self.last_commited_time - 0.1]
+        self.new = deque((a, b, t) for a, b, t in new if a > self.last_commited_time - 0.1)
 
         if len(self.new) >= 1:
             a, b, t = self.new[0]
@@ -66,13 +70,12 @@ class HypothesisBuffer:
                     cn = len(self.commited_in_buffer)
                     nn = len(self.new)
                     for i in range(1, min(min(cn, nn), 5) + 1):  # 5 is the maximum
-                        c = " ".join(
-                            [self.commited_in_buffer[-j][2] for j in range(1, i + 1)][::-1]
-                        )
-                        tail = " ".join(self.new[j - 1][2] for j in range(1, i + 1))
-                        if c == tail:
+                        # the words are compared one by one, both ends of the deques are O(1)
+                        if all(
+                            self.commited_in_buffer[j - i][2] == self.new[j][2] for j in range(i)
+                        ):
                             for j in range(i):
-                                self.new.pop(0)
+                                self.new.popleft()
                             break
 
     def flush(self):
@@ -89,31 +92,94 @@ class HypothesisBuffer:
                 commit.append((na, nb, nt))
                 self.last_commited_word = nt
                 self.last_commited_time = nb
-                self.buffer.pop(0)
-                self.new.pop(0)
+                self.buffer.popleft()
+                self.new.popleft()
             else:
                 break
         self.buffer = self.new
-        self.new = []
+        self.new = deque()
         self.commited_in_buffer.extend(commit)
         return commit
 
     def pop_commited(self, time):
         while self.commited_in_buffer and self.commited_in_buffer[0][1] <= time:
-            self.commited_in_buffer.pop(0)
+            self.commited_in_buffer.popleft()
 
     def complete(self):
         return self.buffer
 
+    def get_state(self):
+        """Returns the state as a JSON serializable dict, see `set_state`"""
+        return {
+            "commited_in_buffer": list(self.commited_in_buffer),
+            "buffer": list(self.buffer),
+            "new": list(self.new),
+            "last_commited_time": self.last_commited_time,
+            "last_commited_word": self.last_commited_word,
+        }
+
+    def set_state(self, state):
+        self.commited_in_buffer = deque(tuple(word) for word in state["commited_in_buffer"])
+        self.buffer = deque(tuple(word) for word in state["buffer"])
+        self.new = deque(tuple(word) for word in state["new"])
+        self.last_commited_time = state["last_commited_time"]
+        self.last_commited_word = state["last_commited_word"]
+
+
+class TrimPolicy:
+    HARD_FACTOR = 1.5  # the buffer is trimmed without a boundary when longer than this * target
+
+    def __init__(
+        self,
+        max_audio_seconds: float = 30.0,
+        min_audio_seconds: float = 10.0,
+        latency_budget_seconds: float = 0.0,
+    ) -> None:
+        """
+        TrimPolicy sets how long the audio buffer of `OnlineASRProcessor` may grow. The whole
+        buffer is transcribed with every packet, so its length sets the cost and the latency of
+        every inference.
+
+        The target is `max_audio_seconds`, lowered so that transcribing it takes at most
+        `latency_budget_seconds` at the measured speed of the workers, but not below
+        `min_audio_seconds`. Buffers longer than the target are trimmed at the end of a Whisper
+        segment, buffers longer than `HARD_FACTOR` times the target also without one. A latency
+        budget of 0 keeps the target at `max_audio_seconds`.
+        """
+        self.max_audio_seconds: float = max_audio_seconds
+        self.min_audio_seconds: float = min_audio_seconds
+        self.latency_budget_seconds: float = latency_budget_seconds
+        self.real_time_factor: Union[float, None] = None
+        """seconds of inference per second of audio of the workers, None until measured"""
+        self.listener: Union[Callable[[str, float], None], None] = None
+        """called with the reason and the seconds of audio of every trim"""
+
+    def target_seconds(self) -> float:
+        target = self.max_audio_seconds
+        if self.latency_budget_seconds > 0 and self.real_time_factor:
+            target = min(target, self.latency_budget_seconds / self.real_time_factor)
+        return max(self.min_audio_seconds, target)
+
+    def trimmed(self, reason: str, seconds: float) -> None:
+        if self.listener is not None:
+            self.listener(reason, seconds)
+
 
 class OnlineASRProcessor:
     SAMPLING_RATE = 16000
+    # most committed words that are segmented into sentences at once, in speech without
+    # punctuation the older words are skipped so that segmenting costs the same every commit.
+    # Only these last committed words are kept, the text is stored by CurrentASRText.
+    SENTENCE_TAIL_WORDS = 200
+    PROMPT_CHARS = 200  # prompt size
 
-    def __init__(self, tokenizer):
+    def __init__(self, tokenizer, trim_policy: Union[TrimPolicy, None] = None):
         """asr: WhisperASR object
         tokenizer: sentence tokenizer object for the target language. Must have a method *split* that behaves like the one of MosesTokenizer.
+        trim_policy: how long the audio buffer may grow, see TrimPolicy.
         """
         self.tokenizer = tokenizer
+        self.trim_policy: TrimPolicy = trim_policy if trim_policy is not None else TrimPolicy()
         # NOTE: when using something else than FasterWhisperASR, change the separator to the one used by the ASR
         self.asr_sep = ""
         self.init()
@@ -124,13 +190,64 @@ class OnlineASRProcessor:
         self.buffer_time_offset = 0
 
         self.transcript_buffer = HypothesisBuffer()
-        self.commited:List[Tuple[float, float, str]] = []
+        self.commited: Deque[Tuple[float, float, str]] = deque(maxlen=self.SENTENCE_TAIL_WORDS)
+        self.commited_count: int = 0  # words committed since the start, also the dropped ones
         self.last_chunked_at = 0
+        # number of the first committed word of the sentence that is not completed yet, the
+        # words before it are not segmented again
+        self.sentence_start: int = 0
+
+        # committed words that are still in the audio buffer, and the suffix of those before it
+        # that is used as the prompt, see `prompt`
+        self.context: Deque[Tuple[float, float, str]] = deque()
+        self.prompt_words: Deque[str] = deque()
+        self.prompt_chars: int = 0
 
         self.silence_iters = 0
         self.buffer_updated: bool= False
         self.last_timestamp: int = 0
 
+    def get_state(self):
+        """Returns the state without the audio buffer as a JSON serializable dict,
+        see `set_state`"""
+        return {
+            "buffer_time_offset": self.buffer_time_offset,
+            "transcript_buffer": self.transcript_buffer.get_state(),
+            "commited": list(self.commited),
+            "commited_count": self.commited_count,
+            "last_chunked_at": self.last_chunked_at,
+            "sentence_start": self.sentence_start,
+            "context": list(self.context),
+            "prompt_words": list(self.prompt_words),
+            "silence_iters": self.silence_iters,
+            "last_timestamp": self.last_timestamp,
+        }
+
+    def set_state(self, state, audio_buffer) -> None:
+        self.audio_buffer = np.asarray(audio_buffer, dtype=np.float32)
+        self.buffer_time_offset = state["buffer_time_offset"]
+        self.transcript_buffer.set_state(state["transcript_buffer"])
+        commited = [tuple(word) for word in state["commited"]]
+        self.commited = deque(commited, maxlen=self.SENTENCE_TAIL_WORDS)
+        self.commited_count = state.get("commited_count", len(commited))
+        self.last_chunked_at = state["last_chunked_at"]
+        self.sentence_start = state.get("sentence_start", 0)
+        self.prompt_words = deque()
+        self.prompt_chars = 0
+        if "context" in state:
+            self.context = deque(tuple(word) for word in state["context"])
+            for word in state["prompt_words"]:
+                self.scroll_away(word)
+        else:
+            # checkpoints from before the history was bounded keep all committed words
+            self.context = deque(word for word in commited if word[1] > self.last_chunked_at)
+            for word in commited[: len(commited) - len(self.context)]:
+                self.scroll_away(word[2])
+        self.silence_iters = state["silence_iters"]
+        self.last_timestamp = state["last_timestamp"]
+        # the audio has to be sent for transcription again
+        self.buffer_updated = len(self.audio_buffer) > 0
+
     def insert_audio_chunk(self, audio):
         self.audio_buffer = np.append(self.audio_buffer, audio)
         self.buffer_updated = True
@@ -139,20 +256,16 @@ class OnlineASRProcessor:
         """Returns a tuple: (prompt, context), where "prompt" is a 200-character suffix of commited text that is inside of the scrolled away part of audio buffer.
         "context" is the commited text that is inside the audio buffer. It is transcribed again and skipped. It is returned only for debugging and logging reasons.
         """
-        k = max(0, len(self.commited) - 1)
-        while k > 0 and self.commited[k - 1][1] > self.last_chunked_at:
-            k -= 1
-
-        p = self.commited[:k]
-        p = [t for _, _, t in p]
-        prompt = []
-        llllll = 0
-        while p and llllll < 200:  # 200 characters prompt size
-            x = p.pop(-1)
-            llllll += len(x) + 1
-            prompt.append(x)
-        non_prompt = self.commited[k:]
-        return self.asr_sep.join(prompt[::-1]), self.asr_sep.join(t for _, _, t in non_prompt)
+        context = self.asr_sep.join(t for _, _, t in self.context)
+        return self.asr_sep.join(self.prompt_words), context
+
+    def scroll_away(self, word: str) -> None:
+        """Adds a committed word that left the audio buffer to the prompt, and drops the oldest
+        words that are not needed for `PROMPT_CHARS` characters"""
+        self.prompt_words.append(word)
+        self.prompt_chars += len(word) + 1
+        while self.prompt_chars - len(self.prompt_words[0]) - 1 >= self.PROMPT_CHARS:
+            self.prompt_chars -= len(self.prompt_words.popleft()) + 1
 
     def process_iter(self, tsw, ends):
         """Runs on the current audio buffer.
@@ -162,33 +275,43 @@ class OnlineASRProcessor:
         self.transcript_buffer.insert(tsw, self.buffer_time_offset)
         o = self.transcript_buffer.flush()
         self.commited.extend(o)
+        self.commited_count += len(o)
+        self.context.extend(o)
         # there is a newly confirmed text
         if o:
             # we trim all the completed sentences from the audio buffer
             self.chunk_completed_sentence()
 
-        # if the audio buffer is longer than 30s, trim it...
-        if len(self.audio_buffer) / self.SAMPLING_RATE > 30:
+        # if the audio buffer is longer than the target of the policy, trim it...
+        target = self.trim_policy.target_seconds()
+        if len(self.audio_buffer) / self.SAMPLING_RATE > target:
             # ...on the last completed segment (labeled by Whisper)
             self.chunk_completed_segment(ends)
+        # ...or on the best boundary left when it is much longer
+        if len(self.audio_buffer) / self.SAMPLING_RATE > target * self.trim_policy.HARD_FACTOR:
+            self.chunk_to_seconds(target)
 
         return self.to_flush(o)
 
     def chunk_completed_sentence(self):
-        if self.commited == []:
-            return
-        sents = self.words_to_sentences(self.commited)
+        """Trims the buffers at the end of the last completed sentence. Only the words since
+        the previous completed sentence are segmented, a sentence is completed when the
+        tokenizer starts another one after it."""
+        tail = min(self.commited_count - self.sentence_start, len(self.commited))
+        start = self.commited_count - tail
+        sents = self.segment_words(
+            list(itertools.islice(self.commited, len(self.commited) - tail, None))
+        )
         if len(sents) < 2:
             return
-        while len(sents) > 2:
-            sents.pop(0)
+        self.sentence_start = start + sents[-2][3]
         # we will continue with audio processing at this timestamp
         chunk_at = sents[-2][1]
 
-        self.chunk_at(chunk_at)
+        self.chunk_at(chunk_at, "sentence")
 
     def chunk_completed_segment(self, ends):
-        if self.commited == []:
+        if not self.commited:
             return
 
         t = self.commited[-1][1]
@@ -199,37 +322,59 @@ class OnlineASRProcessor:
                 ends.pop(-1)
                 e = ends[-2] + self.buffer_time_offset
             if e <= t:
-                self.chunk_at(e)
+                self.chunk_at(e, "segment")
+
+    def chunk_to_seconds(self, seconds):
+        """Trims the audio buffer to at most `seconds`, at the end of the last committed word if
+        that is enough, otherwise without a boundary. The uncommitted words of the trimmed audio
+        are lost, the rest of the state is kept."""
+        end = self.buffer_time_offset + len(self.audio_buffer) / self.SAMPLING_RATE
+        if self.commited and end - seconds <= self.commited[-1][1] <= end:
+            self.chunk_at(self.commited[-1][1], "word")
+            return
+        time = end - seconds
+        self.chunk_at(time, "forced")
+        # words heard partly before the cut are not committed again
+        buffer = self.transcript_buffer
+        buffer.last_commited_time = max(buffer.last_commited_time, time)
 
-    def chunk_at(self, time):
+    def chunk_at(self, time, reason="sentence"):
         """trims the hypothesis and audio buffer at "time" """
         self.transcript_buffer.pop_commited(time)
         cut_seconds = time - self.buffer_time_offset
-        self.audio_buffer = self.audio_buffer[int(cut_seconds) * self.SAMPLING_RATE :]
+        self.audio_buffer = self.audio_buffer[int(cut_seconds * self.SAMPLING_RATE) :]
+        self.trim_policy.trimmed(reason, cut_seconds)
         self.buffer_time_offset = time
         self.last_chunked_at = time
+        while self.context and self.context[0][1] <= time:
+            self.scroll_away(self.context.popleft()[2])
 
     def words_to_sentences(self, words):
         """Uses self.tokenizer for sentence segmentation of words.
         Returns: [(beg,end,"sentence 1"),...]
         """
+        return [(beg, end, sent) for beg, end, sent, _ in self.segment_words(words)]
 
-        cwords = [w for w in words]
-        t = " ".join(o[2] for o in cwords)
-        s = self.tokenizer.split(t)
+    def segment_words(self, words):
+        """Like `words_to_sentences`, with the number of words up to the end of every sentence.
+        Returns: [(beg,end,"sentence 1",words),...]
+        """
+        t = " ".join(o[2] for o in words)
         out = []
-        while s:
+        i = 0
+        for sent in self.tokenizer.split(t):
             beg = None
-            end = None
-            sent = s.pop(0).strip()
+            sent = sent.strip()
             fsent = sent
-            while cwords:
-                b, e, w = cwords.pop(0)
+            while i < len(words):
+                b, e, w = words[i]
+                i += 1
+                # faster-whisper words start with a space
+                w = w.strip()
                 if beg is None and sent.startswith(w):
                     beg = b
-                elif end is None and sent == w:
-                    end = e
-                    out.append((beg, end, fsent))
+                if sent == w:
+                    out.append((beg, e, fsent, i))
                     break
                 sent = sent[len(w) :].strip()
         return out
@@ -291,3 +436,44 @@ def create_tokenizer(lan):
         return MosesTokenizer(lan)
 
     raise ValueError("language not supported by Current Tokenizers: " + lan)
+
+
+class SharedTokenizer:
+    def __init__(self, tokenizer) -> None:
+        """
+        SharedTokenizer lets all sessions of the process use one tokenizer of a language, the
+        tokenizers are not thread-safe, so it splits one text at a time. Segmenting only the
+        tail of the committed words keeps the texts short, see
+        `OnlineASRProcessor.chunk_completed_sentence`.
+        """
+        self.tokenizer = tokenizer
+        self.lock = threading.Lock()
+
+    def split(self, text):
+        with self.lock:
+            return self.tokenizer.split(text)
+
+
+# tokenizers shared by the sessions of the process, by language, see `get_tokenizer`
+tokenizers: Dict[str, SharedTokenizer] = dict()
+tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer(lan) -> SharedTokenizer:
+    """Returns the tokenizer of `lan` shared by the whole process, it is created on the first
+    use, or by `warm_up_tokenizers`"""
+    tokenizer = tokenizers.get(lan)
+    if tokenizer is None:
+        with tokenizers_lock:
+            tokenizer = tokenizers.get(lan)
+            if tokenizer is None:
+                tokenizer = SharedTokenizer(create_tokenizer(lan))
+                tokenizers[lan] = tokenizer
+    return tokenizer
+
+
+def warm_up_tokenizers(languages: Iterable[str]) -> None:
+    """Creates the tokenizers of `languages` and splits a text with each of them, so that the
+    first sessions do not wait for loading them"""
+    for lan in languages:
+        get_tokenizer(lan).split("Warm up. The tokenizer")
@@ -1,4 +1,7 @@
-import jsonpickle
+import json
+import os
+import socket
+from typing import Dict
 
 
 class ASRConfig:
@@ -13,22 +16,90 @@ class ASRConfig:
         # FIXME: Write language codes for all supported languages
         self.supported_languages = ["cs", "en"]
 
+        # transcript journal, see `TranscriptJournal`
+        self.JOURNAL_FSYNC = os.environ.get("COLETRA_JOURNAL_FSYNC", "batch")
+        self.JOURNAL_BATCH_SIZE = int(os.environ.get("COLETRA_JOURNAL_BATCH_SIZE", 64))  # records
+        self.JOURNAL_FLUSH_SECONDS = float(os.environ.get("COLETRA_JOURNAL_FLUSH_SECONDS", 1.0))
+        # seconds between checkpoints of a session used for restoring it after a restart
+        self.CHECKPOINT_SECONDS = float(os.environ.get("COLETRA_CHECKPOINT_SECONDS", 30.0))
+        # maximum number of disk writes waiting for the write-behind writer, request handlers
+        # block when it is full
+        self.WRITE_QUEUE_SIZE = int(os.environ.get("COLETRA_WRITE_QUEUE_SIZE", 1024))
+        # "flask" runs the development server, "asgi" runs `src.asgi.application` with uvicorn
+        self.API_SERVER = os.environ.get("COLETRA_API_SERVER", "flask")
+        # threads running the synchronous Flask views in the asgi server mode
+        self.ASGI_THREADS = int(os.environ.get("COLETRA_ASGI_THREADS", 32))
+        # "memory" keeps the sessions and work queues in this process, "sqlite" shares them
+        # between API processes through the database at STATE_DB_PATH, see `src.session_store`
+        self.STATE_BACKEND = os.environ.get("COLETRA_STATE_BACKEND", "memory")
+        self.STATE_DB_PATH = os.environ.get("COLETRA_STATE_DB_PATH", "state.sqlite3")
+        # name of this API process in the shared state, it has to stay the same across restarts
+        self.API_INSTANCE = os.environ.get(
+            "COLETRA_API_INSTANCE",
+            socket.gethostname() + ":" + os.environ.get("COLETRA_API_PORT", "5000"),
+        )
+        # base URLs of all API nodes sharing the sessions by consistent hashing, comma separated,
+        # e.g. "https://api1:5000,https://api2:5000", see `src.sharding`, empty on a single node
+        self.SHARD_NODES = [
+            url.rstrip("/") for url in os.environ.get("COLETRA_SHARD_NODES", "").split(",") if url
+        ]
+        # the URL of this node in SHARD_NODES
+        self.SHARD_SELF = os.environ.get("COLETRA_SHARD_SELF", "").rstrip("/")
+        # "redirect" answers requests for sessions of other nodes with a redirect to the owner,
+        # "proxy" passes them to the owner and its response back
+        self.SHARD_ROUTING = os.environ.get("COLETRA_SHARD_ROUTING", "redirect")
+        # token required to start and stop the profiler through the API, profiling is disabled
+        # when it is empty, see `src.profiler`
+        self.PROFILING_TOKEN = os.environ.get("COLETRA_PROFILING_TOKEN", "")
+        self.PROFILE_DIR = os.environ.get("COLETRA_PROFILE_DIR", "profiles")
+        # record the transcriptions of the workers into asr_results.jsonl in the session folder,
+        # for replaying the lecture without a GPU, see the model's ReplayASR
+        self.RECORD_ASR = os.environ.get("COLETRA_RECORD_ASR", "0").lower() in ("1", "true")
+        # audio buffer of a session, sent to the worker with every packet, see `TrimPolicy`: it is
+        # trimmed to at most TRIM_MAX_AUDIO_SECONDS, or less so that the inference takes at most
+        # TRIM_LATENCY_BUDGET_SECONDS at the measured speed of the workers (0 for no budget), but
+        # not below TRIM_MIN_AUDIO_SECONDS
+        self.TRIM_MAX_AUDIO_SECONDS = float(os.environ.get("COLETRA_TRIM_MAX_AUDIO_SECONDS", 30.0))
+        self.TRIM_MIN_AUDIO_SECONDS = float(os.environ.get("COLETRA_TRIM_MIN_AUDIO_SECONDS", 10.0))
+        self.TRIM_LATENCY_BUDGET_SECONDS = float(
+            os.environ.get("COLETRA_TRIM_LATENCY_BUDGET_SECONDS", 0.0)
+        )
+        # languages whose sentence tokenizers are loaded at the start, comma separated, the
+        # others are loaded by the first session using them
+        self.TOKENIZER_LANGUAGES = [
+            language
+            for language in os.environ.get(
+                "COLETRA_TOKENIZER_LANGUAGES", ",".join(self.supported_languages)
+            ).split(",")
+            if language
+        ]
+
 
 class Timespan:
+    __slots__ = ("start", "end")
+
     def __init__(self, start: float, end: float):
         """Timespan in seconds"""
         self.start = start
         self.end = end
 
+    def to_dict(self) -> Dict[str, float]:
+        return {"start": self.start, "end": self.end}
+
+    @staticmethod
+    def from_dict(data: Dict[str, float]) -> "Timespan":
+        return Timespan(data["start"], data["end"])
+
     def to_json(self):
-        res = jsonpickle.encode(self, unpicklable=True, indent=4)
-        assert isinstance(res, str)
-        return res
+        return encode_json(self.to_dict())
 
     def from_json(self, json_str: str):
-        res = jsonpickle.decode(json_str)
-        assert isinstance(res, Timespan)
-        return res
+        return Timespan.from_dict(json.loads(json_str))
+
+
+def encode_json(data) -> str:
+    """Encodes plain dicts and lists produced by the `to_dict` methods, without indentation"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
 
 
 def format_timestamp(
@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+import time
+import weakref
+from typing import Dict, List, Tuple, Union
+
+from .persistence import get_writer
+
+FSYNC_POLICIES = ["always", "batch", "never"]
+
+
+class TranscriptJournal:
+    def __init__(
+        self,
+        path: str,
+        fsync_policy: str = "batch",
+        batch_size: int = 64,
+        flush_seconds: float = 1.0,
+    ) -> None:
+        """
+        TranscriptJournal is an append-only JSONL log of all changes of one CurrentASRText:
+        appended and edited text chunk versions, ratings and correction rules.
+
+        Records are buffered and handed to the write-behind writer in batches, a batch is
+        written when it has `batch_size` records or at the latest `flush_seconds` after the
+        last write, by the `JournalFlusher` if no further record comes.
+
+        Args:
+            path (str): The path of the journal file, it is created if it does not exist.
+            fsync_policy (str): "always" writes and fsyncs every record before returning,
+                "batch" fsyncs every written batch and "never" leaves syncing to the operating
+                system.
+            batch_size (int): The maximum number of buffered records.
+            flush_seconds (float): The maximum time between writes while records are buffered.
+        """
+        assert fsync_policy in FSYNC_POLICIES, "fsync policy must be one of " + str(FSYNC_POLICIES)
+        self.path: str = path
+        self.fsync_policy: str = fsync_policy
+        self.batch_size: int = batch_size
+        self.flush_seconds: float = flush_seconds
+
+        # the JournalFlusher flushes from its own thread
+        self.lock = threading.Lock()
+        self.buffer: List[str] = []
+        self.last_flush_time: float = time.time()
+        self.size: int = journal_size(path)
+        """size of the journal in bytes once everything handed to the writer is written"""
+        get_flusher().watch(self)
+
+    def write(self, record: Dict) -> None:
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+        with self.lock:
+            self.buffer.append(line)
+            if (
+                self.fsync_policy == "always"
+                or len(self.buffer) >= self.batch_size
+                or time.time() - self.last_flush_time >= self.flush_seconds
+            ):
+                self._flush()
+                return
+            first_record = len(self.buffer) == 1
+        if first_record:
+            # the buffer has a deadline now
+            get_flusher().wake_up()
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.last_flush_time = time.time()
+        if not self.buffer:
+            return
+        lines, self.buffer = self.buffer, []
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self.size += len(data)
+        writer = get_writer()
+        writer.append(self.path, data, fsync=self.fsync_policy != "never")
+        if self.fsync_policy == "always":
+            writer.flush()
+
+    def flush_deadline(self) -> Union[float, None]:
+        """Returns the time by which the buffered records have to be written, None if there are
+        none"""
+        return self.last_flush_time + self.flush_seconds if self.buffer else None
+
+    def close(self) -> None:
+        self.flush()
+
+
+class JournalFlusher:
+    def __init__(self) -> None:
+        """
+        JournalFlusher writes the buffers of idle journals when their `flush_seconds` pass, so
+        that a record is never buffered for longer even if no further record comes. It sleeps
+        until the earliest deadline, journals wake it up when they get one.
+        """
+        self.journals: "weakref.WeakSet[TranscriptJournal]" = weakref.WeakSet()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="journal-flusher", daemon=True)
+        self.thread.start()
+
+    def watch(self, journal: TranscriptJournal) -> None:
+        with self.condition:
+            self.journals.add(journal)
+
+    def wake_up(self) -> None:
+        with self.condition:
+            self.condition.notify()
+
+    def _due_journals(self, now: float) -> Tuple[List[TranscriptJournal], Union[float, None]]:
+        """Returns the journals to flush at `now` and the earliest deadline of the others"""
+        due: List[TranscriptJournal] = []
+        next_deadline: Union[float, None] = None
+        for journal in list(self.journals):
+            deadline = journal.flush_deadline()
+            if deadline is None:
+                continue
+            if deadline <= now:
+                due.append(journal)
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+        return due, next_deadline
+
+    def _run(self) -> None:
+        while True:
+            with self.condition:
+                now = time.time()
+                due, next_deadline = self._due_journals(now)
+                if not due:
+                    # the journals are only weakly referenced while waiting
+                    self.condition.wait(None if next_deadline is None else next_deadline - now)
+                    continue
+            # the journals are flushed after releasing the condition, so a `write` never waits
+            # for the condition while the flusher waits for its journal
+            self._flush_due(due)
+
+    @staticmethod
+    def _flush_due(due: List[TranscriptJournal]) -> None:
+        for journal in due:
+            with journal.lock:
+                deadline = journal.flush_deadline()
+                if deadline is not None and deadline <= time.time():
+                    journal._flush()
+
+
+_flusher: Union[JournalFlusher, None] = None
+_flusher_lock = threading.Lock()
+
+
+def get_flusher() -> JournalFlusher:
+    """Returns the process-wide journal flusher, starting it on the first call"""
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = JournalFlusher()
+        return _flusher
+
+
+def journal_size(path: str) -> int:
+    """Returns the size of the journal at `path` in bytes, usable as an offset for `read_journal`"""
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+
+def read_journal(path: str, offset: int = 0) -> List[Dict[str, Union[str, int, float, List]]]:
+    """Returns the records of the journal at `path` starting at the byte `offset`, skipping
+    a partially written last line"""
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        f.seek(offset)
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return records
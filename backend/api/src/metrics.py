@@ -0,0 +1,201 @@
+"""Metrics of the API in the Prometheus text format, served by `/metrics`.
+
+Counters and histograms are updated where things happen, callback gauges are computed when the
+metrics are scraped. All metrics are registered in `REGISTRY` when they are created.
+"""
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, LabelValues, float]
+
+# seconds, from a fast request to a packet waiting for a worker for a minute
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0, 60.0)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        """
+        Metric is one metric family, its samples are told apart by the values of `label_names`,
+        given as keyword arguments when updating it.
+        """
+        self.name: str = name
+        self.documentation: str = documentation
+        self.label_names: Tuple[str, ...] = label_names
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def label_values(self, labels: Dict[str, str]) -> LabelValues:
+        assert set(labels) == set(self.label_names), f"{self.name} has labels {self.label_names}"
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[Sample]:
+        """Returns the samples as (name suffix, label values, value)"""
+        raise NotImplementedError("must be implemented in the child class")
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, label_values, value in self.samples():
+            names = self.label_names + (("le",) if suffix == "_bucket" else ())
+            labels = ",".join(
+                f'{name}="{escape_label_value(label_value)}"'
+                for name, label_value in zip(names, label_values)
+            )
+            labels = "{" + labels + "}" if labels else ""
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, label_names)
+        self.values: Dict[LabelValues, float] = dict()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self.lock:
+            return [("_total", key, value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets: Tuple[float, ...] = buckets
+        # per label values: the count of every bucket (not cumulative), the sum and the count
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = dict()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = ([0] * (len(self.buckets) + 1), [0.0, 0.0])
+            counts, totals = self.values[key]
+            counts[index] += 1
+            totals[0] += value
+            totals[1] += 1
+
+    def samples(self) -> List[Sample]:
+        samples: List[Sample] = []
+        with self.lock:
+            for key, (counts, totals) in sorted(self.values.items()):
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append(("_bucket", key + (format_value(upper_bound),), cumulative))
+                samples.append(("_sum", key, totals[0]))
+                samples.append(("_count", key, totals[1]))
+        return samples
+
+
+class CallbackGauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...],
+        collect: Callable[[], Iterable[Tuple[LabelValues, float]]],
+    ) -> None:
+        """CallbackGauge takes its values from `collect()` when the metrics are scraped, it
+        yields (label values, value) pairs"""
+        super().__init__(name, documentation, label_names)
+        self.collect = collect
+
+    def samples(self) -> List[Sample]:
+        return [("", label_values, value) for label_values, value in self.collect()]
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_metrics() -> str:
+    return "".join(metric.render() for metric in REGISTRY)
+
+
+# stages of the pipeline, see `api.got_offloaded_data`
+DISPATCH_SECONDS = Histogram(
+    "coletra_dispatch_seconds",
+    "Time from queueing a packet to handing it to a worker for the first time",
+    ("queue",),
+)
+PACKET_RESENDS = Counter(
+    "coletra_packet_resends",
+    "Packets handed out again because no result came within the resend timeout",
+    ("queue",),
+)
+INFERENCE_SECONDS = Histogram(
+    "coletra_inference_round_trip_seconds",
+    "Time from handing a packet to a worker to receiving its transcription",
+)
+COMMIT_SECONDS = Histogram(
+    "coletra_commit_seconds",
+    "Time from receiving a transcription to adding the committed text to the transcript",
+)
+TRANSLATION_SECONDS = Histogram(
+    "coletra_translation_seconds",
+    "Time from queueing a committed text for translation to receiving the translation",
+)
+WORKER_AUDIO_SECONDS = Counter(
+    "coletra_worker_audio_seconds",
+    "Seconds of audio transcribed by a worker, as reported by the worker",
+    ("worker",),
+)
+WORKER_BUSY_SECONDS = Counter(
+    "coletra_worker_busy_seconds",
+    "Seconds a worker spent transcribing, as reported by the worker",
+    ("worker",),
+)
+PACKET_AUDIO_SECONDS = Histogram(
+    "coletra_packet_audio_seconds",
+    "Seconds of audio in a packet sent for transcription, the audio buffer of its session",
+    buckets=(1.0, 2.0, 5.0, 10.0, 15.0, 20.0, 25.0, 30.0, 40.0, 50.0, 60.0),
+)
+BUFFER_TRIMS = Counter(
+    "coletra_buffer_trims",
+    "Trims of the audio buffer of a session by the boundary they were made at",
+    ("reason",),
+)
+BUFFER_TRIMMED_SECONDS = Counter(
+    "coletra_buffer_trimmed_seconds",
+    "Seconds of audio trimmed from the audio buffers by the boundary they were trimmed at",
+    ("reason",),
+)
+REQUEST_SECONDS = Histogram(
+    "coletra_request_seconds",
+    "Time spent handling a request, until the response (or the start of a stream) is ready",
+    ("endpoint", "method"),
+)
+REQUESTS = Counter(
+    "coletra_requests", "Handled requests by response status", ("endpoint", "method", "status")
+)
@@ -1,8 +1,16 @@
 from .common import ASRConfig, Timespan
+from .journal import read_journal
+from .persistence import get_writer
 from .text_handlers import CurrentASRTextContainer
-from .buffer_common import OnlineASRProcessor, create_tokenizer
+from .tracing import LatencyTracer
+from .buffer_common import OnlineASRProcessor, TrimPolicy, get_tokenizer
 from typing import Dict, List, Union
+import numpy as np
+import functools
+import io
 import json
+import sys
+import threading
 import time
 import os
 
@@ -17,6 +25,7 @@ class TranscribePacket:
         prompt: str,
         audio: List,
         is_file: bool = False,
+        audio_offset: float = 0.0,
     ) -> None:
         """
         TranscribePacket is a container for audio and metadata in `processing_queue`.
@@ -29,12 +38,17 @@ class TranscribePacket:
             source_language (str): The language of the audio chunk.
             transcript_languages (List[str]): The language of the transcript.
             audio (list): The audio data as a byte string.
+            audio_offset (float): The time of the start of the audio in the lecture, in seconds.
         """
         self.session_id: str = session_id
         self.timestamp: int = timestamp
         self.source_language: str = source_language
         self.transcript_language: str = transcript_language
         self.audio: List = audio
+        self.audio_offset: float = audio_offset
+        self.audio_seconds: float = len(audio) / OnlineASRProcessor.SAMPLING_RATE
+        self.queued_time: float = time.time()
+        self.first_sent_time: float = 0.0
         self.sent_out_time: float = 0.0
         self.transcript: Union[None, str] = None
         self.prompt: str = prompt
@@ -55,6 +69,8 @@ class TranscribePacket:
         if self.transcript is None:
             if time.time() - self.sent_out_time > 15:
                 self.sent_out_time = time.time()
+                if self.first_sent_time == 0.0:
+                    self.first_sent_time = self.sent_out_time
                 return {
                     "session_id": self.session_id,
                     "timestamp": self.timestamp,
@@ -63,10 +79,25 @@ class TranscribePacket:
                     "transcript_language": self.transcript_language,
                     "prompt": self.prompt,
                     "audio": self.audio,
+                    "audio_offset": self.audio_offset,
                     "is_file": self.is_file,
                 }
         return None
 
+    @staticmethod
+    def from_offload_data(data: Dict) -> "TranscribePacket":
+        """Inverse of `get_data_to_offload`"""
+        return TranscribePacket(
+            session_id=data["session_id"],
+            timestamp=data["timestamp"],
+            source_language=data["source_language"],
+            transcript_language=data["transcript_language"],
+            prompt=data["prompt"],
+            audio=data["audio"],
+            is_file=data["is_file"],
+            audio_offset=data.get("audio_offset", 0.0),
+        )
+
 
 class TranslatePacket:
     def __init__(
@@ -95,6 +126,8 @@ class TranslatePacket:
         self.source_language: str = source_language
         self.target_languages: List[str] = target_languages
         self.source_text = source_text
+        self.queued_time: float = time.time()
+        self.first_sent_time: float = 0.0
         self.sent_out_time: float = 0.0
         self.recieved = False
         self.timespan = timespan
@@ -113,53 +146,108 @@ class TranslatePacket:
 
         if (not self.recieved) and (time.time() - self.sent_out_time > 15):
             self.sent_out_time = time.time()
+            if self.first_sent_time == 0.0:
+                self.first_sent_time = self.sent_out_time
             return {
                 "session_id": self.session_id,
                 "timestamp": self.timestamp,
                 "source_language": self.source_language,
                 "target_languages": self.target_languages,
                 "source_text": self.source_text,
-                "timespan": self.timespan.to_json(),
+                "timespan": self.timespan.to_dict(),
             }
         return None
 
+    @staticmethod
+    def from_offload_data(data: Dict) -> "TranslatePacket":
+        """Inverse of `get_data_to_offload`"""
+        return TranslatePacket(
+            session_id=data["session_id"],
+            timestamp=data["timestamp"],
+            source_language=data["source_language"],
+            target_languages=data["target_languages"],
+            source_text=data["source_text"],
+            timespan=Timespan.from_dict(data["timespan"]),
+        )
+
 
 class Session:
-    def __init__(self, session_id: str, config: ASRConfig) -> None:
+    CHECKPOINT_FILE = "checkpoint.json"
+    ASR_RESULTS_FILE = "asr_results.jsonl"
+
+    def __init__(
+        self,
+        session_id: str,
+        config: ASRConfig,
+        save_path: Union[str, None] = None,
+        trim_policy: Union[TrimPolicy, None] = None,
+    ) -> None:
+        """
+        Session holds the state of one lecture. If `save_path` is given, the session continues
+        in an existing recordings folder, see `Session.restore`. `trim_policy` is shared by the
+        sessions of the process.
+
+        `lock` guards the ASR processor, the languages and the lists of timestamps, the texts
+        have locks of their own.
+        """
+        self.lock = threading.RLock()
         self.session_id: str = session_id
         self.source_language: str = "en"  # default audio language
         self.transcript_language: str = "en"  # default transcript language
         self.supported_languages: List[str] = config.supported_languages
 
-        self.save_path: str = self.get_save_folder(config.supported_languages)
+        if save_path is None:
+            self.save_path: str = self.get_save_folder(config.supported_languages)
+        else:
+            self.save_path = save_path
         self.texts: CurrentASRTextContainer = CurrentASRTextContainer(
-            self.save_path + "/text_chunks", config.supported_languages
+            self.save_path + "/text_chunks", config.supported_languages, config
         )
         self.online_asr_processor: OnlineASRProcessor = OnlineASRProcessor(
-            create_tokenizer(self.transcript_language)
+            get_tokenizer(self.transcript_language), trim_policy
         )
 
+        self.tracer: LatencyTracer = LatencyTracer(self.save_path + "/traces.jsonl")
+        for language, text in self.texts.current_texts.items():
+            text.delivery_listener = functools.partial(self.tracer.delivered, language)
+
         self.untranscribed_timestamps: List[int] = [0]
         self.transcribed_timestamps: List[int] = []
 
+        self.checkpoint_seconds: float = config.CHECKPOINT_SECONDS
+        self.last_checkpoint_time: float = 0.0
+        self.checkpoint_index: int = 0
+        if save_path is None:
+            self.checkpoint()
+
     def switch_transcript_language(self, language: str):
-        self.transcript_language = language
-        self.online_asr_processor.tokenizer = create_tokenizer(self.transcript_language)
+        with self.lock:
+            self.transcript_language = language
+            self.online_asr_processor.tokenizer = get_tokenizer(self.transcript_language)
 
     def switch_source_language(self, language: str):
-        self.source_language = language
+        with self.lock:
+            self.source_language = language
 
     def end_session(self):
-        for text in self.texts.current_texts.values():
-            with open(
-                self.save_path + f"/final_transcripts/{text.language}/transcript.srt", "w", encoding="utf-8"
-            ) as file:
-                print(str(text), file=file)
+        with self.lock:
+            writer = get_writer()
+            for text in self.texts.current_texts.values():
+                writer.write(
+                    self.save_path + f"/final_transcripts/{text.language}/transcript.srt",
+                    (str(text) + "\n").encode("utf-8"),
+                )
+                writer.write(
+                    self.save_path + f"/final_transcripts/{text.language}/all_text_chunks.json",
+                    (text.to_json() + "\n").encode("utf-8"),
+                )
+
+                # let the push subscribers of this session disconnect
+                text.events.close()
 
-            with open(
-                self.save_path + f"/final_transcripts/{text.language}/all_text_chunks.json", "w", encoding="utf-8"
-            ) as file:
-                print(text.to_json(), file=file)
+            self.texts.close_journals()
+            self.tracer.close()
+            self.checkpoint(ended=True)
 
     def get_save_folder(self, supported_languages: List[str]):
         if not os.path.isdir("recordings"):
@@ -193,9 +281,149 @@ class Session:
             os.mkdir(recordings_folder + "/final_transcripts/" + language)
         return recordings_folder
 
+    def checkpoint(self, ended: bool = False) -> None:
+        """Saves the state of the session, so that it can be restored after a crash of the API.
+
+        Together with the checkpoint, the offsets of the transcript journals are saved, changes
+        after the checkpoint are restored by replaying the journals. The audio buffer is saved
+        in a separate binary file, alternating between two files so that the checkpoint always
+        refers to a complete one. All files are written by the write-behind writer.
+        """
+        with self.lock:
+            self._checkpoint(ended)
+
+    def _checkpoint(self, ended: bool) -> None:
+        texts = {}
+        for language, text in self.texts.current_texts.items():
+            # no record may be journaled between the text checkpoint and the journal offset
+            with text.lock:
+                text.journal.flush()
+                texts[language] = text.get_checkpoint()
+                texts[language]["journal_offset"] = text.journal.size
+
+        self.checkpoint_index = 1 - self.checkpoint_index
+        audio_file = f"checkpoint_audio_{self.checkpoint_index}.npy"
+        audio_data = io.BytesIO()
+        np.save(audio_data, self.online_asr_processor.audio_buffer)
+        writer = get_writer()
+        writer.write(self.save_path + "/" + audio_file, audio_data.getvalue(), atomic=True)
+
+        self.last_checkpoint_time = time.time()
+        checkpoint = {
+            "session_id": self.session_id,
+            "time": self.last_checkpoint_time,
+            "ended": ended,
+            "source_language": self.source_language,
+            "transcript_language": self.transcript_language,
+            "processor": self.online_asr_processor.get_state(),
+            "audio_file": audio_file,
+            "texts": texts,
+        }
+        # the writer keeps the order, the checkpoint is written after the audio and the journals
+        writer.write(
+            self.save_path + "/" + self.CHECKPOINT_FILE,
+            json.dumps(checkpoint, separators=(",", ":")).encode("utf-8"),
+            atomic=True,
+            fsync=True,
+        )
+
+    def record_asr_result(self, record: Dict) -> None:
+        """Appends the transcription of a packet to `ASR_RESULTS_FILE`, see
+        `ASRConfig.RECORD_ASR`"""
+        get_writer().append(
+            self.save_path + "/" + self.ASR_RESULTS_FILE,
+            (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8"),
+        )
+
+    def maybe_checkpoint(self) -> None:
+        if time.time() - self.last_checkpoint_time >= self.checkpoint_seconds:
+            self.checkpoint()
+
+    @staticmethod
+    def restore(
+        save_path: str, config: ASRConfig, trim_policy: Union[TrimPolicy, None] = None
+    ) -> "Session":
+        """Rebuilds a session from its last checkpoint in `save_path`, the transcript journals
+        and the audio chunks saved after the checkpoint."""
+        with open(save_path + "/" + Session.CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+
+        session = Session(
+            checkpoint["session_id"], config, save_path=save_path, trim_policy=trim_policy
+        )
+        session.switch_source_language(checkpoint["source_language"])
+        session.switch_transcript_language(checkpoint["transcript_language"])
+
+        for language, text in session.texts.current_texts.items():
+            if language not in checkpoint["texts"]:
+                os.makedirs(save_path + "/text_chunks/" + language, exist_ok=True)
+                os.makedirs(save_path + "/final_transcripts/" + language, exist_ok=True)
+                continue
+            text.restore_checkpoint(checkpoint["texts"][language])
+            for record in read_journal(
+                text.journal_path(), checkpoint["texts"][language]["journal_offset"]
+            ):
+                text.replay_journal_record(record)
+
+        processor = session.online_asr_processor
+        processor.set_state(
+            checkpoint["processor"], np.load(save_path + "/" + checkpoint["audio_file"])
+        )
+        for chunk in session.audio_chunks_saved_after(checkpoint["time"]):
+            processor.insert_audio_chunk([chunk[x] for x in chunk])
+
+        # the audio after the checkpoint is transcribed again, skip the words that are
+        # already in the replayed transcript
+        transcript = session.texts.current_texts.get(session.transcript_language)
+        if transcript is not None and len(transcript.timestamps) > 0:
+            last_end = transcript.text_chunks[transcript.timestamps[-1]].timespans[-1].end
+            if last_end > processor.transcript_buffer.last_commited_time:
+                processor.transcript_buffer.last_commited_time = last_end
+
+        session.checkpoint_index = 0 if checkpoint["audio_file"].endswith("_1.npy") else 1
+        session.last_checkpoint_time = time.time()
+        return session
+
+    def audio_chunks_saved_after(self, after_time: float) -> List[Dict[str, float]]:
+        saved_chunks = []
+        for filename in os.listdir(self.save_path + "/audio"):
+            # filenames are "{timestamp}_{time.time()}.json"
+            saved_time = float(filename[: -len(".json")].split("_", 1)[1])
+            if saved_time > after_time:
+                saved_chunks.append((saved_time, filename))
+
+        chunks = []
+        for _, filename in sorted(saved_chunks):
+            with open(self.save_path + "/audio/" + filename, "r") as f:
+                chunks.append(json.load(f))
+        return chunks
+
     def save_audio_chunk(self, chunk: Dict[str, float], timestamp: int):
-        with open(
+        get_writer().write(
             self.save_path + "/audio/" + str(timestamp) + "_" + str(time.time()) + ".json",
-            mode="w",
-        ) as f:
-            print(json.dumps(chunk), file=f)
+            (json.dumps(chunk) + "\n").encode("utf-8"),
+        )
+
+
+def find_active_session_folders() -> List[str]:
+    """Returns the recordings folders of sessions that were not ended, at most one per session"""
+    if not os.path.isdir("recordings"):
+        return []
+
+    folders = []
+    for session_id in os.listdir("recordings"):
+        if not os.path.isdir("recordings/" + session_id):
+            continue
+        indices = [x for x in os.listdir("recordings/" + session_id) if x.isdigit()]
+        if len(indices) == 0:
+            continue
+        save_path = "recordings/" + session_id + "/" + str(max(int(x) for x in indices))
+        try:
+            with open(save_path + "/" + Session.CHECKPOINT_FILE, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError) as e:
+            print("cannot read checkpoint of " + save_path + ": " + str(e), file=sys.stderr)
+            continue
+        if not checkpoint["ended"]:
+            folders.append(save_path)
+    return folders
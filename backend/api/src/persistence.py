@@ -0,0 +1,158 @@
+import atexit
+import os
+import queue
+import sys
+import threading
+from typing import Dict, List, Union
+
+from .common import ASRConfig
+
+
+class WriteTask:
+    __slots__ = ("path", "data", "append", "atomic", "fsync")
+
+    def __init__(self, path: str, data: bytes, append: bool, atomic: bool, fsync: bool) -> None:
+        self.path = path
+        self.data = data
+        self.append = append
+        self.atomic = atomic
+        self.fsync = fsync
+
+
+class WriteBehindWriter:
+    BATCH_SIZE = 256  # maximum number of tasks coalesced into one batch
+
+    def __init__(self, max_queue_size: int) -> None:
+        """
+        WriteBehindWriter performs all disk writes of the API on one dedicated thread, so that
+        request handlers never wait for the filesystem.
+
+        Tasks waiting in the queue are taken in batches and coalesced: of several whole-file
+        writes to the same path only the last one is performed, at the position of the last
+        one, and appends to the same path with no write to it in between are concatenated into
+        one write at the position of the first one. The tasks of one path keep their order, and
+        no task is performed before tasks of other paths queued before it, except for appends
+        concatenated into an earlier run, so e.g. a checkpoint never reaches the disk before the
+        journal records it refers to. When the queue is full, `write` and `append` block until
+        the writer catches up.
+        """
+        self.queue: "queue.Queue[Union[WriteTask, None]]" = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.closed = False
+        self.thread.start()
+
+    def write(self, path: str, data: bytes, atomic: bool = False, fsync: bool = False) -> None:
+        """Replaces the content of the file at `path` with `data`.
+
+        With `atomic`, the file contains either the old or the new data even after a crash.
+        """
+        self.queue.put(WriteTask(path, data, append=False, atomic=atomic, fsync=fsync))
+
+    def append(self, path: str, data: bytes, fsync: bool = False) -> None:
+        self.queue.put(WriteTask(path, data, append=True, atomic=False, fsync=fsync))
+
+    def flush(self) -> None:
+        """Waits until all tasks queued so far are written"""
+        self.queue.join()
+
+    def close(self) -> None:
+        """Writes everything queued and stops the writer thread"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Union[WriteTask, None]] = [self.queue.get()]
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            tasks = [task for task in batch if task is not None]
+            try:
+                for task in self._coalesce(tasks):
+                    # a failing path must not drop the writes of other files
+                    try:
+                        self._perform(task)
+                    except Exception as e:
+                        print(f"write-behind writer failed on {task.path}: {e}", file=sys.stderr)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if len(tasks) < len(batch):
+                return
+
+    @staticmethod
+    def _coalesce(tasks: List[WriteTask]) -> List[WriteTask]:
+        last_write: Dict[str, int] = {}
+        for i, task in enumerate(tasks):
+            if not task.append:
+                last_write[task.path] = i
+
+        # a whole-file write is performed at the position of the last one to its path, the
+        # earlier ones are overwritten anyway. Appends to a path are concatenated only while no
+        # write to the path comes between them, the run is performed at the position of its
+        # first append, so a write never overtakes an append to its path or the other way round.
+        coalesced: List[Union[WriteTask, List[WriteTask]]] = []
+        open_appends: Dict[str, List[WriteTask]] = {}
+        for i, task in enumerate(tasks):
+            if task.append:
+                run = open_appends.get(task.path)
+                if run is None:
+                    run = []
+                    open_appends[task.path] = run
+                    coalesced.append(run)
+                run.append(task)
+            else:
+                open_appends.pop(task.path, None)
+                if last_write[task.path] == i:
+                    coalesced.append(task)
+
+        merged: List[WriteTask] = []
+        for item in coalesced:
+            if isinstance(item, WriteTask):
+                merged.append(item)
+            elif len(item) == 1:
+                merged.append(item[0])
+            else:
+                merged.append(
+                    WriteTask(
+                        item[0].path,
+                        b"".join(task.data for task in item),
+                        append=True,
+                        atomic=False,
+                        fsync=any(task.fsync for task in item),
+                    )
+                )
+        return merged
+
+    @staticmethod
+    def _perform(task: WriteTask) -> None:
+        path = task.path + ".tmp" if task.atomic else task.path
+        with open(path, "ab" if task.append else "wb") as f:
+            f.write(task.data)
+            if task.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        if task.atomic:
+            os.replace(path, task.path)
+
+
+_writer: Union[WriteBehindWriter, None] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> WriteBehindWriter:
+    """Returns the process-wide writer, starting it on the first call. Everything queued is
+    written before the interpreter exits."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteBehindWriter(ASRConfig().WRITE_QUEUE_SIZE)
+            atexit.register(_writer.close)
+        return _writer
@@ -0,0 +1,120 @@
+"""Opt-in sampling profiler, started and stopped through the API, see `api.start_profiling`.
+
+While it runs, a thread samples the Python stacks of the profiled threads and counts them. The
+result is written in the folded format of Brendan Gregg's FlameGraph ("frame;frame;frame count"
+per line), which flamegraph.pl, speedscope and inferno read. While it is stopped, the only cost
+is the check of `SamplingProfiler.request_fraction` before every request.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, Set, Union
+
+
+def fold_stack(frame) -> str:
+    """Returns the stack of `frame` as "file:function;file:function", the outermost first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    INTERVAL_SECONDS = 0.005  # between two samples
+    MAX_SECONDS = 600.0  # longest profiling window
+
+    def __init__(self, output_dir: str) -> None:
+        """
+        SamplingProfiler samples either all threads, or only the threads handling a random
+        fraction of the requests, for a time window. The folded stacks are written into
+        `output_dir` when the window ends or the profiler is stopped.
+        """
+        self.output_dir: str = output_dir
+        self.lock = threading.Lock()
+        self.request_fraction: float = 0.0
+        """fraction of the requests to profile, 0 when not profiling requests"""
+        self.threads: Union[Set[int], None] = None
+        """IDs of the profiled threads, None to profile all threads"""
+        self.stacks: Dict[str, int] = dict()
+        self.samples: int = 0
+        self.stop_event = threading.Event()
+        self.sampler: Union[threading.Thread, None] = None
+        self.path: Union[str, None] = None
+
+    def running(self) -> bool:
+        return self.sampler is not None and self.sampler.is_alive()
+
+    def start(self, seconds: float, request_fraction: Union[float, None] = None) -> str:
+        """Starts profiling for `seconds`, only the threads of `request_fraction` of the
+        requests if it is given, all threads otherwise. Returns the path of the output file."""
+        assert 0.0 < seconds <= self.MAX_SECONDS, f"seconds must be in (0, {self.MAX_SECONDS}]"
+        assert request_fraction is None or 0.0 < request_fraction <= 1.0
+        with self.lock:
+            assert not self.running(), "the profiler is already running"
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.path = os.path.join(
+                self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S") + f"-{os.getpid()}.folded"
+            )
+            self.stacks = dict()
+            self.samples = 0
+            self.threads = None if request_fraction is None else set()
+            self.request_fraction = request_fraction or 0.0
+            self.stop_event.clear()
+            self.sampler = threading.Thread(
+                target=self._sample, args=(time.time() + seconds,), daemon=True
+            )
+            self.sampler.start()
+            return self.path
+
+    def stop(self) -> Union[str, None]:
+        """Stops profiling and writes the output, returns its path or None if not running"""
+        sampler = self.sampler
+        if sampler is None or not sampler.is_alive():
+            return None
+        self.stop_event.set()
+        sampler.join()
+        return self.path
+
+    def begin_request(self) -> bool:
+        """Profiles the current thread with the probability `request_fraction`, returns whether
+        it does, then `end_request` has to be called when the request is handled"""
+        if self.request_fraction <= 0.0 or random.random() >= self.request_fraction:
+            return False
+        with self.lock:
+            if self.threads is None:
+                return False
+            self.threads.add(threading.get_ident())
+        return True
+
+    def end_request(self) -> None:
+        with self.lock:
+            if self.threads is not None:
+                self.threads.discard(threading.get_ident())
+
+    def _sample(self, until: float) -> None:
+        own_id = threading.get_ident()
+        while time.time() < until and not self.stop_event.wait(self.INTERVAL_SECONDS):
+            with self.lock:
+                threads = None if self.threads is None else set(self.threads)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (threads is not None and thread_id not in threads):
+                    continue
+                stack = fold_stack(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+        with self.lock:
+            self.request_fraction = 0.0
+            self.threads = None
+        self._write()
+
+    def _write(self) -> None:
+        assert self.path is not None
+        with open(self.path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        print(f"profile of {self.samples} samples written to {self.path}", file=sys.stderr)
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import threading
+from collections import deque
+from typing import AsyncIterator, Callable, Deque, Iterator, List, Tuple, Union
+
+
+def format_event(event_id: int, event: str, data) -> bytes:
+    """Serializes one Server-Sent Event"""
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+KEEP_ALIVE = b": keep-alive\n\n"
+
+
+class EventChannel:
+    HISTORY_SIZE = 256  # number of most recent events kept for reconnecting subscribers
+    MAX_WAIT_SECONDS = 30.0  # longest wait of a long-poll
+
+    def __init__(self) -> None:
+        """
+        EventChannel fans out events of one (session, language) pair to all its subscribers.
+        Every event is serialized once in `publish` and the same bytes are sent to every
+        subscriber. Event ids are the change sequence numbers of the text, so a subscriber can
+        resume from the id of the last event it has seen.
+
+        Subscribers are either threads (`subscribe`, `wait`) or coroutines on an event loop
+        (`subscribe_async`, `wait_async`), events are published from any thread.
+        """
+        self.condition = threading.Condition()
+        self.history: Deque[Tuple[int, bytes]] = deque(maxlen=self.HISTORY_SIZE)
+        self.last_id: int = 0
+        self.closed: bool = False
+        self.subscribers: int = 0
+        self.long_polls: int = 0  # clients waiting in `wait` or `wait_async`
+        self.async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def publish(self, event_id: int, event: str, data) -> None:
+        payload = format_event(event_id, event, data)
+        with self.condition:
+            self.history.append((event_id, payload))
+            self.last_id = event_id
+            self._notify()
+
+    def reset(self, event_id: int) -> None:
+        """Forgets the history, subscribers behind `event_id` will have to catch up"""
+        with self.condition:
+            self.history.clear()
+            self.last_id = event_id
+            self._notify()
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self._notify()
+
+    def _notify(self) -> None:
+        """Wakes up all waiting subscribers, the condition has to be held"""
+        self.condition.notify_all()
+        for loop, event in self.async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self.async_waiters = []
+
+    def _events_since(self, cursor: int) -> Union[List[Tuple[int, bytes]], None]:
+        """Returns the events newer than `cursor`, or None if some of them are not in history"""
+        if not self.history or self.history[0][0] > cursor + 1 or cursor > self.last_id:
+            return None
+        return [(event_id, payload) for event_id, payload in self.history if event_id > cursor]
+
+    def _pending(self, cursor: int) -> Union[List[Tuple[int, bytes]], None]:
+        """Returns the events newer than `cursor`, see `_events_since`, the condition has to be
+        held"""
+        if self.last_id == cursor:
+            return []
+        return self._events_since(cursor)
+
+    @staticmethod
+    def _payloads(
+        events: Union[List[Tuple[int, bytes]], None],
+        cursor: int,
+        catch_up: Callable[[int], Tuple[bytes, int]],
+    ) -> Tuple[List[bytes], int]:
+        """Returns what to send for `events` from `_pending` and the new cursor"""
+        if events is None:
+            payload, cursor = catch_up(cursor)
+            return [payload], cursor
+        if not events:
+            return [KEEP_ALIVE], cursor
+        return [payload for _, payload in events], events[-1][0]
+
+    def wait(self, cursor: int, timeout: float) -> None:
+        """Blocks until there is an event newer than `cursor`, the channel is closed or `timeout`
+        seconds pass"""
+        with self.condition:
+            if not self.closed and self.last_id == cursor:
+                self.long_polls += 1
+                self.condition.wait(timeout=timeout)
+                self.long_polls -= 1
+
+    async def wait_async(self, cursor: int, timeout: float) -> None:
+        """Same as `wait`, without blocking the event loop"""
+        with self.condition:
+            self.long_polls += 1
+        try:
+            await self._wait_async(cursor, timeout)
+        finally:
+            with self.condition:
+                self.long_polls -= 1
+
+    async def _wait_async(self, cursor: int, timeout: float) -> None:
+        event = asyncio.Event()
+        with self.condition:
+            if self.closed or self.last_id != cursor:
+                return
+            waiter = (asyncio.get_running_loop(), event)
+            self.async_waiters.append(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.condition:
+                if waiter in self.async_waiters:
+                    self.async_waiters.remove(waiter)
+
+    def subscribe(
+        self,
+        cursor: int,
+        catch_up: Callable[[int], Tuple[bytes, int]],
+        keep_alive_seconds: float = 15.0,
+    ) -> Iterator[bytes]:
+        """Yields the serialized events newer than `cursor` until the channel is closed.
+
+        `catch_up(cursor)` is called when the missed events are no longer in history, it has to
+        return a single event bringing the subscriber up to date and the new cursor.
+        """
+        with self.condition:
+            self.subscribers += 1
+        try:
+            while True:
+                with self.condition:
+                    if not self.closed and self.last_id == cursor:
+                        self.condition.wait(timeout=keep_alive_seconds)
+                    if self.closed:
+                        return
+                    events = self._pending(cursor)
+
+                payloads, cursor = self._payloads(events, cursor, catch_up)
+                for payload in payloads:
+                    yield payload
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+    async def subscribe_async(
+        self,
+        cursor: int,
+        catch_up: Callable[[int], Tuple[bytes, int]],
+        keep_alive_seconds: float = 15.0,
+    ) -> AsyncIterator[bytes]:
+        """Same as `subscribe`, waiting on the event loop instead of blocking a thread"""
+        with self.condition:
+            self.subscribers += 1
+        try:
+            while True:
+                await self._wait_async(cursor, keep_alive_seconds)
+                with self.condition:
+                    if self.closed:
+                        return
+                    events = self._pending(cursor)
+
+                payloads, cursor = self._payloads(events, cursor, catch_up)
+                for payload in payloads:
+                    yield payload
+        finally:
+            with self.condition:
+                self.subscribers -= 1
@@ -0,0 +1,535 @@
+"""Sessions and work queues of the API, kept either in this process or shared between several
+API processes through SQLite, selected by `ASRConfig.STATE_BACKEND`.
+
+The state of a session (its audio buffer, ASR processor and texts) always lives in the memory of
+one API process, its owner. What the shared backend shares is everything the processes have to
+agree on: which session IDs exist and who owns them, and the queues of packets waiting for
+workers. Any process can then hand out packets of any session to a worker, and a result posted
+to a process that does not own the session is forwarded to its owner, see
+`SessionStore.forward_to_owner`. Requests naming a session have to reach its owner, e.g. through
+a reverse proxy hashing the `session_id` query argument.
+"""
+import json
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple, Type, Union
+
+import numpy as np
+
+from .buffer_common import OnlineASRProcessor
+from .common import ASRConfig, encode_json
+from .metrics import DISPATCH_SECONDS, PACKET_RESENDS
+from .networking_common import Session, TranscribePacket, TranslatePacket
+
+Packet = Union[TranscribePacket, TranslatePacket]
+ForwardHandler = Callable[[str, Dict], None]
+
+
+class SessionStore:
+    """Interface of the session stores, see `InMemorySessionStore` and `SQLiteSessionStore`.
+
+    Lookups (`in`, `[]`, `get`, `keys`, `values`) see only the sessions owned by this process,
+    `active_session_ids` lists the sessions of all processes.
+    """
+
+    def __contains__(self, session_id: object) -> bool:
+        return self.get(session_id) is not None  # type: ignore
+
+    def __getitem__(self, session_id: str) -> Session:
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def get(self, session_id: str) -> Union[Session, None]:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def keys(self) -> List[str]:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def values(self) -> List[Session]:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def active_session_ids(self) -> List[str]:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def create(self, session_id: str, factory: Callable[[], Session]) -> Union[Session, None]:
+        """Adds the session built by `factory`, or returns None if the session already exists"""
+        raise NotImplementedError("must be implemented in the child class")
+
+    def pop(self, session_id: str) -> Union[Session, None]:
+        """Removes the session and returns it, only one of concurrent callers gets it"""
+        raise NotImplementedError("must be implemented in the child class")
+
+    def forward_to_owner(self, session_id: str, endpoint: str, data: Dict) -> None:
+        """Hands the request `data` of `endpoint` to the process owning the session, which runs
+        the handler given to `start_forwarding`. Dropped if the session does not exist."""
+        raise NotImplementedError("must be implemented in the child class")
+
+    def start_forwarding(self, handler: ForwardHandler) -> None:
+        """Starts calling `handler(endpoint, data)` on requests forwarded to this process"""
+        raise NotImplementedError("must be implemented in the child class")
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self) -> None:
+        """
+        InMemorySessionStore holds the running sessions by their session ID, for an API running
+        as a single process.
+
+        Lookups do not lock, they see the sessions dict either before or after a change. Adding
+        and removing sessions is serialized, so that two requests can never create the same
+        session twice or both end it. The state of a session itself is guarded by `Session.lock`.
+        """
+        self.lock = threading.Lock()
+        self.sessions: Dict[str, Session] = dict()
+
+    def __contains__(self, session_id: object) -> bool:
+        return session_id in self.sessions
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def get(self, session_id: str) -> Union[Session, None]:
+        return self.sessions.get(session_id)
+
+    def keys(self) -> List[str]:
+        return list(self.sessions.keys())
+
+    def values(self) -> List[Session]:
+        return list(self.sessions.values())
+
+    def active_session_ids(self) -> List[str]:
+        return self.keys()
+
+    def create(self, session_id: str, factory: Callable[[], Session]) -> Union[Session, None]:
+        with self.lock:
+            if session_id in self.sessions:
+                return None
+            session = factory()
+            self.sessions[session_id] = session
+            return session
+
+    def pop(self, session_id: str) -> Union[Session, None]:
+        with self.lock:
+            return self.sessions.pop(session_id, None)
+
+    def forward_to_owner(self, session_id: str, endpoint: str, data: Dict) -> None:
+        # there is no other process, the session has ended
+        pass
+
+    def start_forwarding(self, handler: ForwardHandler) -> None:
+        pass
+
+
+class WorkQueue:
+    """Interface of the work queues, see `InMemoryWorkQueue` and `SQLiteWorkQueue`.
+
+    A work queue holds the packets waiting for a worker, TranscribePackets or TranslatePackets,
+    in the order they were added. Packets are identified by their session ID and timestamp.
+    Every operation is atomic: a packet is handed out to at most one worker at a time by
+    `next_to_offload` and removed exactly once by `pop`.
+    """
+
+    name: str  # "transcribe" or "translate", also the label of the queue in the metrics
+
+    def __len__(self) -> int:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def oldest_age(self) -> float:
+        """Returns the seconds since the oldest queued packet was queued, 0 if there is none"""
+        raise NotImplementedError("must be implemented in the child class")
+
+    def record_handout(self, queued_time: float, sent_out_time: float, now: float) -> None:
+        """Records the metrics of handing out a packet that was sent out at `sent_out_time`
+        before, 0 if never"""
+        if sent_out_time == 0.0:
+            DISPATCH_SECONDS.observe(now - queued_time, queue=self.name)
+        else:
+            PACKET_RESENDS.inc(queue=self.name)
+
+    def append(self, packet: Packet) -> None:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def pop(self, session_id: str, timestamp: int) -> Union[Packet, None]:
+        """Removes and returns the packet, or returns None if it is not (or no longer) queued"""
+        raise NotImplementedError("must be implemented in the child class")
+
+    def remove_session(self, session_id: str) -> None:
+        raise NotImplementedError("must be implemented in the child class")
+
+    def next_to_offload(self) -> Union[Dict, None]:
+        """Returns the data of the oldest packet that is ready to be offloaded, see
+        `TranscribePacket.get_data_to_offload`, or None"""
+        raise NotImplementedError("must be implemented in the child class")
+
+
+class InMemoryWorkQueue(WorkQueue):
+    def __init__(self, name: str) -> None:
+        """InMemoryWorkQueue keeps the packets in a dict of this process"""
+        self.name: str = name
+        self.lock = threading.Lock()
+        self.packets: Dict[Tuple[str, int], Packet] = dict()
+
+    def __len__(self) -> int:
+        return len(self.packets)
+
+    def oldest_age(self) -> float:
+        with self.lock:
+            queued_times = [packet.queued_time for packet in self.packets.values()]
+        return time.time() - min(queued_times) if queued_times else 0.0
+
+    def __iter__(self) -> Iterator[Packet]:
+        with self.lock:
+            return iter(list(self.packets.values()))
+
+    def append(self, packet: Packet) -> None:
+        with self.lock:
+            self.packets[(packet.session_id, packet.timestamp)] = packet
+
+    def pop(self, session_id: str, timestamp: int) -> Union[Packet, None]:
+        with self.lock:
+            return self.packets.pop((session_id, timestamp), None)
+
+    def remove_session(self, session_id: str) -> None:
+        with self.lock:
+            self.packets = {
+                key: packet for key, packet in self.packets.items() if key[0] != session_id
+            }
+
+    def next_to_offload(self) -> Union[Dict, None]:
+        with self.lock:
+            for packet in self.packets.values():
+                sent_out_time = packet.sent_out_time
+                data = packet.get_data_to_offload()
+                if data is not None:
+                    self.record_handout(packet.queued_time, sent_out_time, packet.sent_out_time)
+                    return data
+        return None
+
+
+class SQLiteDatabase:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS packets (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            queue TEXT NOT NULL,
+            session_id TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            audio BLOB,
+            queued_time REAL NOT NULL,
+            sent_out_time REAL NOT NULL DEFAULT 0,
+            first_sent_time REAL NOT NULL DEFAULT 0,
+            UNIQUE (queue, session_id, timestamp)
+        );
+        CREATE INDEX IF NOT EXISTS packets_by_queue ON packets (queue, sent_out_time, seq);
+        CREATE TABLE IF NOT EXISTS forwarded (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        SQLiteDatabase is the database file shared by the API processes. It is used in WAL
+        mode, so readers never wait for the writer, and every thread gets its own connection.
+        Writes are short `BEGIN IMMEDIATE` transactions, serialized between the processes by
+        SQLite's file lock.
+        """
+        self.path: str = path
+        self.local = threading.local()
+        self.connection().executescript(self.SCHEMA)
+        self._add_column("packets", "first_sent_time REAL NOT NULL DEFAULT 0")
+
+    def _add_column(self, table: str, column: str) -> None:
+        """Adds a column missing in a database created by an older version"""
+        columns = {row[1] for row in self.connection().execute(f"PRAGMA table_info({table})")}
+        if column.split()[0] in columns:
+            return
+        try:
+            self.connection().execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+        except sqlite3.OperationalError as e:
+            # another process added it in the meantime
+            if "duplicate column" not in str(e):
+                raise
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            # transactions are started explicitly, see `transaction`
+            connection = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+
+class SQLiteSessionStore(InMemorySessionStore):
+    FORWARD_POLL_SECONDS = 0.05  # how often the owner looks for forwarded requests
+
+    def __init__(self, database: SQLiteDatabase, instance: str) -> None:
+        """
+        SQLiteSessionStore holds the sessions owned by this process like InMemorySessionStore
+        and registers them in the `sessions` table of the shared database, so that a session ID
+        is created only once across all processes.
+
+        A registered session whose owner is `instance` but which is not held in memory was left
+        by this process before a restart, `create` takes it over, e.g. when restoring it.
+        """
+        super().__init__()
+        self.database: SQLiteDatabase = database
+        self.instance: str = instance
+        self.forwarding_thread: Union[threading.Thread, None] = None
+
+    def active_session_ids(self) -> List[str]:
+        rows = self.database.connection().execute("SELECT session_id FROM sessions").fetchall()
+        return [row[0] for row in rows]
+
+    def create(self, session_id: str, factory: Callable[[], Session]) -> Union[Session, None]:
+        with self.lock:
+            if session_id in self.sessions:
+                return None
+            with self.database.transaction() as connection:
+                row = connection.execute(
+                    "SELECT owner FROM sessions WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row is not None and row[0] != self.instance:
+                    return None
+                connection.execute(
+                    "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                    (session_id, self.instance, time.time()),
+                )
+            try:
+                session = factory()
+            except BaseException:
+                self._unregister(session_id)
+                raise
+            self.sessions[session_id] = session
+            return session
+
+    def pop(self, session_id: str) -> Union[Session, None]:
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                self._unregister(session_id)
+            return session
+
+    def _unregister(self, session_id: str) -> None:
+        with self.database.transaction() as connection:
+            connection.execute(
+                "DELETE FROM sessions WHERE session_id = ? AND owner = ?",
+                (session_id, self.instance),
+            )
+
+    def forward_to_owner(self, session_id: str, endpoint: str, data: Dict) -> None:
+        with self.database.transaction() as connection:
+            row = connection.execute(
+                "SELECT owner FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None or row[0] == self.instance:
+                # the session has ended, or it is ours and has ended in the meantime
+                return
+            connection.execute(
+                "INSERT INTO forwarded (owner, endpoint, data) VALUES (?, ?, ?)",
+                (row[0], endpoint, encode_json(data)),
+            )
+
+    def start_forwarding(self, handler: ForwardHandler) -> None:
+        if self.forwarding_thread is not None:
+            return
+        self.forwarding_thread = threading.Thread(
+            target=self._run_forwarded, args=(handler,), name="forwarded", daemon=True
+        )
+        self.forwarding_thread.start()
+
+    def _run_forwarded(self, handler: ForwardHandler) -> None:
+        while True:
+            with self.database.transaction() as connection:
+                rows = connection.execute(
+                    "SELECT seq, endpoint, data FROM forwarded WHERE owner = ? ORDER BY seq",
+                    (self.instance,),
+                ).fetchall()
+                if rows:
+                    connection.execute(
+                        "DELETE FROM forwarded WHERE owner = ? AND seq <= ?",
+                        (self.instance, rows[-1][0]),
+                    )
+            for _, endpoint, data in rows:
+                try:
+                    handler(endpoint, json.loads(data))
+                except Exception as e:
+                    print(f"forwarded request to {endpoint} failed: {e!r}", file=sys.stderr)
+            if not rows:
+                time.sleep(self.FORWARD_POLL_SECONDS)
+
+
+class SQLiteWorkQueue(WorkQueue):
+    RESEND_SECONDS = 15.0  # same as `TranscribePacket.get_data_to_offload`
+
+    def __init__(self, database: SQLiteDatabase, name: str, packet_type: Type[Packet]) -> None:
+        """
+        SQLiteWorkQueue keeps the packets in the `packets` table of the shared database, so that
+        a worker polling any API process gets the oldest packet of all of them.
+
+        Packets are stored as their offload data, see `TranscribePacket.from_offload_data`. The
+        audio of TranscribePackets is stored as float32 samples, the precision the ASR uses.
+
+        Args:
+            database (SQLiteDatabase): The shared database.
+            name (str): The name of the queue, queues with the same name are the same queue.
+            packet_type (Type[Packet]): TranscribePacket or TranslatePacket.
+        """
+        self.database: SQLiteDatabase = database
+        self.name: str = name
+        self.packet_type: Type[Packet] = packet_type
+
+    def __len__(self) -> int:
+        row = (
+            self.database.connection()
+            .execute("SELECT COUNT(*) FROM packets WHERE queue = ?", (self.name,))
+            .fetchone()
+        )
+        return row[0]
+
+    def oldest_age(self) -> float:
+        row = (
+            self.database.connection()
+            .execute("SELECT MIN(queued_time) FROM packets WHERE queue = ?", (self.name,))
+            .fetchone()
+        )
+        return time.time() - row[0] if row[0] is not None else 0.0
+
+    def append(self, packet: Packet) -> None:
+        # a packet is offloaded at any time, get its data without marking it as sent out
+        data = self._offload_data(packet)
+        audio = data.pop("audio", None)
+        blob = None if audio is None else np.asarray(audio, dtype=np.float32).tobytes()
+        with self.database.transaction() as connection:
+            connection.execute(
+                "INSERT INTO packets (queue, session_id, timestamp, data, audio, queued_time) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (queue, session_id, timestamp) "
+                "DO UPDATE SET data = excluded.data, audio = excluded.audio, "
+                "queued_time = excluded.queued_time, sent_out_time = 0, first_sent_time = 0",
+                (
+                    self.name,
+                    packet.session_id,
+                    packet.timestamp,
+                    encode_json(data),
+                    blob,
+                    packet.queued_time,
+                ),
+            )
+
+    @staticmethod
+    def _offload_data(packet: Packet) -> Dict:
+        sent_out_time, first_sent_time = packet.sent_out_time, packet.first_sent_time
+        packet.sent_out_time = 0.0
+        data = packet.get_data_to_offload()
+        packet.sent_out_time, packet.first_sent_time = sent_out_time, first_sent_time
+        assert data is not None, "a processed packet cannot be queued"
+        return data
+
+    @staticmethod
+    def _decode(data: str, audio: Union[bytes, None]) -> Dict:
+        decoded = json.loads(data)
+        if audio is not None:
+            decoded["audio"] = np.frombuffer(audio, dtype=np.float32).tolist()
+        return decoded
+
+    def pop(self, session_id: str, timestamp: int) -> Union[Packet, None]:
+        """See `WorkQueue.pop`, the audio of a popped TranscribePacket is not loaded, its
+        transcription has already arrived"""
+        with self.database.transaction() as connection:
+            row = connection.execute(
+                "SELECT seq, data, queued_time, sent_out_time, first_sent_time, length(audio) "
+                "FROM packets "
+                "WHERE queue = ? AND session_id = ? AND timestamp = ?",
+                (self.name, session_id, timestamp),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute("DELETE FROM packets WHERE seq = ?", (row[0],))
+        data = self._decode(row[1], None)
+        if self.packet_type is TranscribePacket:
+            data["audio"] = []
+        packet = self.packet_type.from_offload_data(data)
+        packet.queued_time, packet.sent_out_time, packet.first_sent_time = row[2], row[3], row[4]
+        if isinstance(packet, TranscribePacket) and row[5] is not None:
+            # float32 samples
+            packet.audio_seconds = row[5] / 4 / OnlineASRProcessor.SAMPLING_RATE
+        return packet
+
+    def remove_session(self, session_id: str) -> None:
+        with self.database.transaction() as connection:
+            connection.execute(
+                "DELETE FROM packets WHERE queue = ? AND session_id = ?", (self.name, session_id)
+            )
+
+    def next_to_offload(self) -> Union[Dict, None]:
+        now = time.time()
+        with self.database.transaction() as connection:
+            row = connection.execute(
+                "SELECT seq, data, audio, queued_time, sent_out_time FROM packets "
+                "WHERE queue = ? AND sent_out_time < ? ORDER BY seq LIMIT 1",
+                (self.name, now - self.RESEND_SECONDS),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE packets SET sent_out_time = ?, first_sent_time = "
+                "CASE WHEN first_sent_time = 0 THEN ? ELSE first_sent_time END WHERE seq = ?",
+                (now, now, row[0]),
+            )
+        self.record_handout(row[3], row[4], now)
+        return self._decode(row[1], row[2])
+
+
+STATE_BACKENDS = ["memory", "sqlite"]
+
+
+def create_state(config: ASRConfig) -> Tuple[SessionStore, WorkQueue, WorkQueue]:
+    """Returns the session store, the transcription queue and the translation queue of the
+    backend selected by `config.STATE_BACKEND`"""
+    assert config.STATE_BACKEND in STATE_BACKENDS, "state backend must be one of " + str(
+        STATE_BACKENDS
+    )
+    if config.STATE_BACKEND == "memory":
+        return (
+            InMemorySessionStore(),
+            InMemoryWorkQueue("transcribe"),
+            InMemoryWorkQueue("translate"),
+        )
+
+    database = SQLiteDatabase(config.STATE_DB_PATH)
+    return (
+        SQLiteSessionStore(database, config.API_INSTANCE),
+        SQLiteWorkQueue(database, "transcribe", TranscribePacket),
+        SQLiteWorkQueue(database, "translate", TranslatePacket),
+    )
@@ -0,0 +1,135 @@
+"""Sharding of sessions across API nodes, enabled by `ASRConfig.SHARD_NODES`.
+
+Every session is owned by the node chosen by consistent hashing of its session ID, and all its
+state stays on that node. A request naming a session (the `session_id` query argument) that
+reaches another node is redirected or proxied to the owner, see `api.route_to_owner`. Workers
+poll every node for work, so the offload endpoints are never routed.
+"""
+import bisect
+import hashlib
+import ssl
+import sys
+import urllib.error
+import urllib.request
+from typing import Dict, Iterator, List, Tuple, Union
+
+# set on requests proxied by a node, the receiving node serves them without routing them again
+FORWARDED_HEADER = "X-Coletra-Forwarded"
+# headers of a single connection, not passed on by the proxy
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "host",
+    "content-length",
+}
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    VIRTUAL_NODES = 128  # points of every node on the ring, evens out the shares of the nodes
+
+    def __init__(self, nodes: List[str]) -> None:
+        """
+        HashRing maps session IDs to nodes by consistent hashing: each node owns the arcs of the
+        ring ending at its points, so adding or removing a node moves only the sessions of the
+        arcs it gains or loses. All nodes have to be given the same list of nodes.
+
+        Args:
+            nodes (List[str]): The base URLs of the nodes, e.g. "https://api1.example.com:5000".
+        """
+        assert len(nodes) > 0, "a hash ring needs at least one node"
+        self.nodes: List[str] = list(nodes)
+        points = sorted(
+            (hash_key(f"{node}#{i}"), node) for node in nodes for i in range(self.VIRTUAL_NODES)
+        )
+        self.hashes: List[int] = [point for point, _ in points]
+        self.owners: List[str] = [node for _, node in points]
+
+    def owner(self, session_id: str) -> str:
+        index = bisect.bisect(self.hashes, hash_key(session_id))
+        return self.owners[index % len(self.owners)]
+
+
+class ProxyResponse:
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, status: int, headers: List[Tuple[str, str]], upstream) -> None:
+        """ProxyResponse is the response of a node to a proxied request, its body is read from
+        `upstream` while it is being sent, so push streams pass through as they come"""
+        self.status: int = status
+        self.headers: List[Tuple[str, str]] = headers
+        self.upstream = upstream
+
+    def body(self) -> Iterator[bytes]:
+        # `read1` returns what has arrived instead of waiting for a full chunk
+        read = getattr(self.upstream, "read1", self.upstream.read)
+        try:
+            while True:
+                chunk = read(self.CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        finally:
+            self.upstream.close()
+
+
+def node_ssl_context(node: str) -> Union[ssl.SSLContext, None]:
+    """Returns the SSL context for connecting to `node`, None for plain HTTP"""
+    if not node.startswith("https://"):
+        return None
+    # the nodes use the same, often self-signed, certificates as the workers connect to
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def proxy_request(
+    node: str,
+    method: str,
+    full_path: str,
+    headers: Dict[str, str],
+    body: bytes,
+    timeout: float,
+) -> Union[ProxyResponse, None]:
+    """Sends the request to `node`, returns its response or None if the node is unreachable.
+
+    `timeout` limits the wait for each read, so it has to be longer than the longest long-poll
+    and the keep-alive interval of push streams.
+    """
+    request_headers = {
+        name: value for name, value in headers.items() if name.lower() not in HOP_BY_HOP_HEADERS
+    }
+    request_headers[FORWARDED_HEADER] = "1"
+    upstream_request = urllib.request.Request(
+        node + full_path, data=body or None, headers=request_headers, method=method
+    )
+
+    try:
+        upstream = urllib.request.urlopen(
+            upstream_request, timeout=timeout, context=node_ssl_context(node)
+        )
+        status, upstream_headers = upstream.getcode(), upstream.headers
+    except urllib.error.HTTPError as e:
+        # error responses of the owner are passed on as they are, the body is read through the
+        # error, which closes the response when it is garbage collected
+        upstream, status, upstream_headers = e, e.code, e.headers
+    except OSError as e:
+        print(f"cannot reach node {node}: {e}", file=sys.stderr)
+        return None
+
+    response_headers = [
+        (name, value)
+        for name, value in upstream_headers.items()
+        if name.lower() not in HOP_BY_HOP_HEADERS
+    ]
+    return ProxyResponse(status, response_headers, upstream)
@@ -1,6 +1,16 @@
-import jsonpickle  # type: ignore
-from typing import Dict, List, Tuple, Union
-from .common import format_timestamp, Timespan
+import gzip
+import json
+import random
+import sys
+import threading
+from bisect import bisect_left
+from array import array
+from heapq import heappop, heappush
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Set, Tuple, Union
+from .common import ASRConfig, encode_json, format_timestamp, Timespan
+from .journal import TranscriptJournal
+from .push import EventChannel, format_event
 import time
 import re
 
@@ -24,6 +34,8 @@ def break_line(line: str, length: int):
 
 
 class ASRTextUnit:
+    __slots__ = ("text", "timestamp", "timespan", "version", "rating")
+
     def __init__(self, text: str, timestamp: int, timespan: Timespan, version: int) -> None:
         self.text = text
         self.timestamp = timestamp
@@ -46,6 +58,10 @@ class ASRTextUnit:
         This is some transcribed text.
         ```
         """
+        return self.subtitle_cue("srt")
+
+    def subtitle_cue(self, subtitle_format: str = "srt") -> str:
+        """Returns the text unit as one cue of a .srt or .vtt file"""
 
         def clean_text(text, line_length: int = 0):
             text = re.sub(r"-+>", "->", text)
@@ -56,12 +72,17 @@ class ASRTextUnit:
 
             return text
 
+        decimal_marker = "," if subtitle_format == "srt" else "."
         cleaned_text = clean_text(self.text, line_length=0)
         return (
             f"{self.timestamp}\n"
-            + format_timestamp(self.timespan.start, always_include_hours=True, decimal_marker=",")
-            + "--> "
-            + format_timestamp(self.timespan.end, always_include_hours=True, decimal_marker=",")
+            + format_timestamp(
+                self.timespan.start, always_include_hours=True, decimal_marker=decimal_marker
+            )
+            + " --> "
+            + format_timestamp(
+                self.timespan.end, always_include_hours=True, decimal_marker=decimal_marker
+            )
             + "\n"
             + cleaned_text
             + "\n\n"
@@ -70,15 +91,207 @@ class ASRTextUnit:
     def raw_text(self) -> str:
         return self.text
 
+    def to_dict(self) -> Dict[str, Union[str, int, float]]:
+        return {
+            "text": self.text,
+            "timestamp": self.timestamp,
+            "start": self.timespan.start,
+            "end": self.timespan.end,
+            "version": self.version,
+            "rating": self.rating,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict) -> "ASRTextUnit":
+        text_unit = ASRTextUnit(
+            text=data["text"],
+            timestamp=data["timestamp"],
+            timespan=Timespan(data["start"], data["end"]),
+            version=data["version"],
+        )
+        text_unit.rating = data["rating"]
+        return text_unit
+
     def to_json(self):
-        res = jsonpickle.encode(self, unpicklable=True, indent=4)
-        assert isinstance(res, str)
-        return res
+        return encode_json(self.to_dict())
 
     def from_json(self, json_str: str):
-        res = jsonpickle.decode(json_str)
-        assert isinstance(res, ASRTextUnit)
-        return res
+        return ASRTextUnit.from_dict(json.loads(json_str))
+
+
+def diff_texts(old: str, new: str) -> Tuple[int, int, str]:
+    """Returns `(prefix, suffix, middle)` such that
+    `new == old[:prefix] + middle + old[len(old) - suffix:]`"""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    return prefix, suffix, new[prefix : len(new) - suffix]
+
+
+def patch_text(old: str, delta: Tuple[int, int, str]) -> str:
+    prefix, suffix, middle = delta
+    return old[:prefix] + middle + old[len(old) - suffix :]
+
+
+class ChunkHistory:
+    __slots__ = (
+        "timestamp",
+        "first_version",
+        "base_text",
+        "deltas",
+        "head",
+        "timespans",
+        "ratings",
+        "history_size",
+    )
+
+    DELTA_OVERHEAD = 120  # approximate bytes of a stored delta besides its text
+
+    def __init__(self, timestamp: int, text: str, timespan: Timespan) -> None:
+        """
+        ChunkHistory holds all versions of one text chunk and can be used as a list of their
+        ASRTextUnits. Only the newest text is stored whole, older versions are kept as deltas
+        against the previous version, consecutive versions with equal timespans share one
+        Timespan and ratings are kept in an array.
+
+        Only the holder of the lock of the CurrentASRText changes a ChunkHistory. Readers without
+        the lock use `head`, which is replaced as a whole after all other fields are updated.
+
+        The texts of versions older than `first_version` are dropped by `compact`, their
+        timespans and ratings are kept.
+        """
+        self.timestamp: int = timestamp
+        self.first_version: int = 0
+        self.base_text: str = text
+        """text of the version `first_version`"""
+        self.deltas: List[Tuple[int, int, str]] = []
+        """delta i turns version `first_version + i` into the next version"""
+        self.head: Tuple[int, str] = (0, text)
+        """(version, text) of the newest version"""
+        self.timespans: List[Timespan] = [timespan]
+        self.ratings = array("i", [0])
+        self.history_size: int = 0
+        """approximate bytes taken by the texts of the older versions"""
+
+    def to_dict(self, latest_only: bool = False) -> Dict:
+        """Returns the texts from `first_version` (or only the newest one with `latest_only`),
+        all timespans and all ratings"""
+        first_version = self.latest_version if latest_only else self.first_version
+        return {
+            "timestamp": self.timestamp,
+            "first_version": first_version,
+            "texts": [self.get_text(version) for version in range(first_version, len(self))],
+            "timespans": [[timespan.start, timespan.end] for timespan in self.timespans],
+            "ratings": self.ratings.tolist(),
+        }
+
+    @staticmethod
+    def from_dict(data: Dict) -> "ChunkHistory":
+        timespans = [Timespan(start, end) for start, end in data["timespans"]]
+        first_version = data["first_version"]
+        history = ChunkHistory(data["timestamp"], data["texts"][0], timespans[0])
+        for version in range(1, len(data["ratings"])):
+            timespan = timespans[version]
+            if version <= first_version:
+                history.timespans.append(history._share_timespan(timespan))
+                history.ratings.append(0)
+            else:
+                history.append(
+                    ASRTextUnit(
+                        text=data["texts"][version - first_version],
+                        timestamp=data["timestamp"],
+                        timespan=timespan,
+                        version=version,
+                    )
+                )
+        history.first_version = first_version
+        history.ratings = array("i", data["ratings"])
+        history.head = (len(history.ratings) - 1, history.latest_text)
+        return history
+
+    def __len__(self) -> int:
+        return len(self.ratings)
+
+    def __getitem__(self, version: int) -> ASRTextUnit:
+        if version < 0:
+            version += len(self)
+        if not 0 <= version < len(self):
+            raise IndexError(f"text chunk {self.timestamp} has no version {version}")
+        text_unit = ASRTextUnit(
+            text=self.get_text(version),
+            timestamp=self.timestamp,
+            timespan=self.timespans[version],
+            version=version,
+        )
+        text_unit.rating = self.ratings[version]
+        return text_unit
+
+    @property
+    def latest_version(self) -> int:
+        return self.head[0]
+
+    @property
+    def latest_text(self) -> str:
+        return self.head[1]
+
+    def get_text(self, version: int) -> str:
+        if version == self.latest_version:
+            return self.latest_text
+        if version < self.first_version:
+            raise IndexError(f"version {version} of text chunk {self.timestamp} was compacted")
+        text = self.base_text
+        for delta in self.deltas[: version - self.first_version]:
+            text = patch_text(text, delta)
+        return text
+
+    def append(self, text_unit: ASRTextUnit) -> int:
+        """Adds `text_unit` as the newest version, returns the growth of `history_size`"""
+        assert text_unit.version == len(self)
+        delta = diff_texts(self.latest_text, text_unit.text)
+        self.deltas.append(delta)
+        self.timespans.append(self._share_timespan(text_unit.timespan))
+        self.ratings.append(text_unit.rating)
+        self.head = (text_unit.version, text_unit.text)
+
+        growth = len(delta[2]) + self.DELTA_OVERHEAD
+        self.history_size += growth
+        return growth
+
+    def _share_timespan(self, timespan: Timespan) -> Timespan:
+        """Returns the newest timespan instead of an equal `timespan`"""
+        previous_timespan = self.timespans[-1]
+        if previous_timespan.start == timespan.start and previous_timespan.end == timespan.end:
+            return previous_timespan
+        return timespan
+
+    def rate(self, version: int, d_rating: int) -> int:
+        self.ratings[version] += d_rating
+        return self.ratings[version]
+
+    def compact(self) -> int:
+        """Drops the texts of all but the newest version, returns the freed `history_size`"""
+        freed = self.history_size
+        self.first_version = self.latest_version
+        self.base_text = self.latest_text
+        self.deltas = []
+        self.history_size = 0
+        return freed
+
+    def memory_usage(self) -> int:
+        """Returns the approximate number of bytes taken by this object"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.base_text) + sys.getsizeof(self.deltas)
+        for delta in self.deltas:
+            size += sys.getsizeof(delta) + sys.getsizeof(delta[2])
+        if self.latest_text is not self.base_text:
+            size += sys.getsizeof(self.latest_text)
+        size += sys.getsizeof(self.timespans) + sys.getsizeof(self.ratings)
+        shared_timespans = set(id(timespan) for timespan in self.timespans)
+        size += len(shared_timespans) * sys.getsizeof(self.timespans[0])
+        return size
 
 
 class SourceString:
@@ -86,15 +299,18 @@ class SourceString:
         self.string = string
         self.active = active
 
+    def to_dict(self) -> Dict[str, Union[str, bool]]:
+        return {"string": self.string, "active": self.active}
+
+    @staticmethod
+    def from_dict(data: Dict) -> "SourceString":
+        return SourceString(string=data["string"], active=data["active"])
+
     def to_json(self):
-        res = jsonpickle.encode(self, unpicklable=True, indent=4)
-        assert isinstance(res, str)
-        return res
+        return encode_json(self.to_dict())
 
     def from_json(self, json_str: str):
-        res = jsonpickle.decode(json_str)
-        assert isinstance(res, SourceString)
-        return res
+        return SourceString.from_dict(json.loads(json_str))
 
 
 class CorrectionRule:
@@ -103,15 +319,26 @@ class CorrectionRule:
         self.to: str = ""
         self.version: int = -1
 
+    def to_dict(self) -> Dict:
+        return {
+            "source_strings": [source_string.to_dict() for source_string in self.source_strings],
+            "to": self.to,
+            "version": self.version,
+        }
+
+    @staticmethod
+    def from_dict(data: Dict) -> "CorrectionRule":
+        rule = CorrectionRule()
+        rule.source_strings = [SourceString.from_dict(x) for x in data["source_strings"]]
+        rule.to = data["to"]
+        rule.version = data["version"]
+        return rule
+
     def to_json(self):
-        res = jsonpickle.encode(self, unpicklable=True, indent=4)
-        assert isinstance(res, str)
-        return res
+        return encode_json(self.to_dict())
 
     def from_json(self, json_str: str):
-        res = jsonpickle.decode(json_str)
-        assert isinstance(res, CorrectionRule)
-        return res
+        return CorrectionRule.from_dict(json.loads(json_str))
 
     def decode_from_dict(self, input_dict):
         """Gets:
@@ -166,57 +393,161 @@ class CorrectionRule:
 
 
 class CurrentASRText:
-    def __init__(self, save_path: str, language: str) -> None:
-        self.text_chunks: Dict[int, List[ASRTextUnit]] = dict()
-        """dict of timestamp -> version -> ASRTextUnit"""
+    CHANGE_LOG_SIZE = 1000  # number of most recent chunk changes kept for `get_changes_since`
+    RESPONSE_CACHE_SIZE = 64  # maximum number of cached responses for one revision
+    COMPRESS_MIN_SIZE = 1024  # bytes, smaller cached responses are not gzipped
+    HISTORY_BUDGET_BYTES = 4 * 1024 * 1024  # older chunk versions are compacted above this size
+    SUBTITLE_HEADERS = {"srt": "", "vtt": "WEBVTT\n\n"}  # supported subtitle formats
+
+    def __init__(
+        self, save_path: str, language: str, journal: Union[TranscriptJournal, None] = None
+    ) -> None:
+        """
+        CurrentASRText holds the transcript of one session in one language.
+
+        All changes are made while holding `lock`. Readers do not take it, they work on
+        `chunk_view` and the `head` of each ChunkHistory: text chunks and timestamps are only
+        ever added at the end, everything else a reader touches is replaced as a whole.
+        """
+        self.lock = threading.RLock()
+        self.text_chunks: Dict[int, ChunkHistory] = dict()
+        """dict of timestamp -> ChunkHistory, which maps version -> ASRTextUnit"""
+        self.history_size: int = 0
+        """sum of `history_size` of all text chunks"""
+        self.uncompacted: Set[int] = set()
+        """timestamps of the text chunks with a nonzero `history_size`"""
+        self.compact_queue: List[int] = []
+        """heap of the timestamps in `uncompacted`, the oldest text chunk first"""
+        self.timestamps: List[int] = []
+        """timestamps of all text chunks in the order they were created, which is also sorted"""
         self.save_path = save_path
         self.language = language
         self.correction_rules: List[CorrectionRule] = []
+        self.journal: TranscriptJournal = (
+            journal if journal is not None else TranscriptJournal(self.journal_path())
+        )
+        """log of all changes, written instead of a file per text chunk version"""
+
+        self.change_seq: int = 0
+        """monotonic counter, increased every time a text chunk gets a new version"""
+        self.change_log: Deque[Tuple[int, int]] = deque(maxlen=self.CHANGE_LOG_SIZE)
+        """(change_seq, timestamp) pairs of the most recent changes, oldest first, the timestamp is
+        None for changes of the correction rules"""
+        self.events: EventChannel = EventChannel()
+        self.delivered_seq: int = 0
+        """the highest change_seq a viewer has got, see `mark_delivered`"""
+        self.delivery_listener: Union[Callable[[int], None], None] = None
+        """called with the new `delivered_seq` when it grows"""
+
+        self.revision: int = 0
+        """increased on every change of text chunks, their ratings or correction rules"""
+        self.etag_prefix: str = "%08x" % random.getrandbits(32)
+        """distinguishes revisions of this text from revisions of a text with the same name
+        before an API restart"""
+        self.response_cache: Dict[str, bytes] = dict()
+        """key -> encoded response, valid for the current revision only"""
+        self.cue_cache: Dict[str, Dict[int, Tuple[int, str]]] = {
+            subtitle_format: dict() for subtitle_format in self.SUBTITLE_HEADERS
+        }
+        """subtitle format -> timestamp -> (version, cue) of the last rendered version of the text
+        chunks"""
+        self.chunk_view: Tuple[
+            Dict[int, ChunkHistory], List[int], Dict[str, Dict[int, Tuple[int, str]]]
+        ] = (self.text_chunks, self.timestamps, self.cue_cache)
+        """(text_chunks, timestamps, cue_cache) for readers, replaced at once when the text is
+        cleared, so that a reader never mixes the old text chunks with the new ones"""
 
     def __str__(self) -> str:
         """Returns .srt format of the text chunks"""
-        ret_value = []
-        for timestamp in sorted(self.text_chunks.keys()):
-            ret_value.append(str(self.text_chunks[timestamp][-1]))
-        return "".join(ret_value)
+        return "".join(self.subtitle_cues("srt"))
+
+    def subtitle_cues(self, subtitle_format: str = "srt") -> Iterator[str]:
+        """Yields the header and the cues of the newest versions of the text chunks in
+        `subtitle_format`, "srt" or "vtt". Only cues of text chunks that got a new version since
+        the last call are rendered, the others come from `cue_cache`."""
+        text_chunks, timestamps, cue_cache = self.chunk_view
+        cues = cue_cache[subtitle_format]
+        yield self.SUBTITLE_HEADERS[subtitle_format]
+        for timestamp in timestamps[:]:
+            history = text_chunks[timestamp]
+            version, text = history.head
+            cue = cues.get(timestamp)
+            if cue is None or cue[0] != version:
+                text_unit = ASRTextUnit(text, timestamp, history.timespans[version], version)
+                cue = (version, text_unit.subtitle_cue(subtitle_format))
+                cues[timestamp] = cue
+            yield cue[1]
 
     def raw_text(self) -> str:
+        text_chunks, timestamps, _ = self.chunk_view
         ret_value = []
-        for timestamp in sorted(self.text_chunks.keys()):
-            ret_value.append(self.text_chunks[timestamp][-1].raw_text())
+        for timestamp in timestamps[:]:
+            ret_value.append(text_chunks[timestamp].latest_text)
         return " ".join(ret_value)
 
+    def to_dict(self) -> Dict:
+        """Returns all stored versions of the text chunks and the correction rules"""
+        with self.lock:
+            return {
+                "language": self.language,
+                "correction_rules": [rule.to_dict() for rule in self.correction_rules],
+                "text_chunks": [
+                    self.text_chunks[timestamp].to_dict() for timestamp in self.timestamps
+                ],
+            }
+
     def to_json(self):
-        res = jsonpickle.encode(self, unpicklable=True, indent=4)
-        assert isinstance(res, str)
-        return res
+        return encode_json(self.to_dict())
 
     def from_json(self, json_str: str):
-        res = jsonpickle.decode(json_str)
-        assert isinstance(res, CurrentASRText)
+        data = json.loads(json_str)
+        res = CurrentASRText(self.save_path, data["language"])
+        for chunk in data["text_chunks"]:
+            history = ChunkHistory.from_dict(chunk)
+            res.text_chunks[chunk["timestamp"]] = history
+            res.timestamps.append(chunk["timestamp"])
+            res._add_history_size(chunk["timestamp"], history.history_size)
+        res.correction_rules = [CorrectionRule.from_dict(x) for x in data["correction_rules"]]
         return res
 
+    def journal_path(self) -> str:
+        return self.save_path + "/" + self.language + "/journal.jsonl"
+
     def clear_empty_correction_rules(self) -> None:
         # DONE: Versioning of correction rules? Right now we just overwrite the old ones
-        # remove empty correction rules
-        for rule in self.correction_rules:
-            rule.source_strings = [
-                source_string
-                for source_string in rule.source_strings
-                if source_string.string != ""
-            ]
-        self.correction_rules = [
-            rule
-            for rule in self.correction_rules
-            if len(rule.source_strings) > 0 and rule.to != ""
-        ]
+        # remove empty correction rules, the rules may be read concurrently, so new ones are built
+        with self.lock:
+            correction_rules = []
+            for rule in self.correction_rules:
+                cleared_rule = CorrectionRule()
+                cleared_rule.source_strings = [
+                    source_string
+                    for source_string in rule.source_strings
+                    if source_string.string != ""
+                ]
+                cleared_rule.to = rule.to
+                cleared_rule.version = rule.version
+                if len(cleared_rule.source_strings) > 0 and cleared_rule.to != "":
+                    correction_rules.append(cleared_rule)
+            self.correction_rules = correction_rules
+
+            self._record_change(None)
+            self._invalidate()
+            encoded_rules = self.encode_correction_rules()
+            self.events.publish(
+                self.change_seq, "rules", {"entries": encoded_rules, "cursor": self.change_seq}
+            )
+            self.journal.write({"op": "rules", "time": time.time(), "rules": encoded_rules})
+
+    def encode_correction_rules(self) -> List[Dict]:
+        return [rule.encode_to_dict() for rule in self.correction_rules]
 
-        current_time = str(time.time()).replace(".", "_")
-        with open(
-            self.save_path + "/" + self.language + "/" + f"correction_rules_{current_time}.json",
-            "w",
-        ) as f:
-            print(self.correction_rules, file=f)
+    def set_encoded_correction_rules(self, encoded_rules: List[Dict]) -> None:
+        correction_rules = []
+        for encoded_rule in encoded_rules:
+            correction_rules.append(CorrectionRule())
+            correction_rules[-1].decode_from_dict(encoded_rule)
+        self.correction_rules = correction_rules
 
     def longest_correction_rule_source(self) -> int:
         longest_rule = 0
@@ -264,111 +595,388 @@ class CurrentASRText:
         if text == "":
             return
 
-        timestamp = max(self.text_chunks.keys()) if len(self.text_chunks.keys()) > 0 else 0
-        corrected_text = self.apply_correction_rules(text)
+        with self.lock:
+            # timestamps are created in increasing order, the last one is the newest
+            timestamp = self.timestamps[-1] if len(self.timestamps) > 0 else 0
+            corrected_text = self.apply_correction_rules(text)
+
+            if len(self.timestamps) != 0 and len(self.text_chunks[timestamp].latest_text) < 35:
+                # if the last text chunk is too short, append to it instead of creating a new one
+                history = self.text_chunks[timestamp]
+                new_text_unit = ASRTextUnit(
+                    text=history.latest_text + corrected_text,
+                    timestamp=timestamp,
+                    timespan=Timespan(history.timespans[-1].start, timespan.end),
+                    version=history.latest_version + 1,
+                )
 
-        if len(self.text_chunks.keys()) != 0 and len(self.text_chunks[timestamp][-1].text) < 35:
-            # if the last text chunk is too short, append to it instead of creating a new one
-            new_text_unit = ASRTextUnit(
-                text=self.text_chunks[timestamp][-1].text + corrected_text,
-                timestamp=timestamp,
-                timespan=Timespan(self.text_chunks[timestamp][-1].timespan.start, timespan.end),
-                version=self.text_chunks[timestamp][-1].version + 1,
+            else:
+                # timestamp + 1 because we create a new text chunk
+                timestamp = self.timestamps[-1] + 1 if len(self.timestamps) > 0 else 0
+                new_text_unit = ASRTextUnit(
+                    text=corrected_text, timestamp=timestamp, timespan=timespan, version=0
+                )
+
+            self._store_version(new_text_unit)
+            self._publish_chunk(timestamp)
+            self.journal.write(
+                {
+                    "op": "append",
+                    "time": time.time(),
+                    "timestamp": timestamp,
+                    "version": new_text_unit.version,
+                    "text": new_text_unit.text,
+                    "start": new_text_unit.timespan.start,
+                    "end": new_text_unit.timespan.end,
+                }
             )
 
-        else:
-            # timestamp + 1 because we create a new text chunk
-            timestamp = max(self.text_chunks.keys()) + 1 if len(self.text_chunks.keys()) > 0 else 0
-            new_text_unit = ASRTextUnit(
-                text=corrected_text, timestamp=timestamp, timespan=timespan, version=0
+    def _store_version(self, text_unit: ASRTextUnit) -> None:
+        """Adds a new version of a text chunk, or a new text chunk if the version is 0"""
+        timestamp = text_unit.timestamp
+        if text_unit.version == 0:
+            self.text_chunks[timestamp] = ChunkHistory(
+                timestamp, text_unit.text, text_unit.timespan
             )
-            self.text_chunks[timestamp] = []
-
-        self.text_chunks[timestamp].append(new_text_unit)
-        with open(
-            self.save_path
-            + "/"
-            + self.language
-            + "/"
-            + str(timestamp)
-            + f"_{self.text_chunks[timestamp][-1].version}"
-            + ".json",
-            "w",
-        ) as f:
-            print(new_text_unit.to_json(), file=f)
+            self.timestamps.append(timestamp)
+        else:
+            self._add_history_size(timestamp, self.text_chunks[timestamp].append(text_unit))
+            self.compact_history()
+        self._record_change(timestamp)
+        self._invalidate()
 
     def clear(self) -> None:
         """Clears all text chunk data"""
+        with self.lock:
+            self._clear_text_chunks()
+            self.journal.write({"op": "clear", "time": time.time()})
+
+    def _clear_text_chunks(self) -> None:
         self.text_chunks = dict()
+        self.history_size = 0
+        self.uncompacted = set()
+        self.compact_queue = []
+        self.timestamps = []
+        self.cue_cache = {subtitle_format: dict() for subtitle_format in self.SUBTITLE_HEADERS}
+        self.chunk_view = (self.text_chunks, self.timestamps, self.cue_cache)
+        # every cursor handed out so far is stale now, force clients to take a full snapshot
+        self.change_seq += 1
+        self.change_log.clear()
+        self._invalidate()
+        self.events.reset(self.change_seq)
+
+    def replay_journal_record(self, record: Dict) -> None:
+        """Applies a record written to the journal, without writing it again. Versions that are
+        already present are skipped."""
+        with self.lock:
+            op = record["op"]
+            if op == "append" or op == "edit":
+                timestamp = record["timestamp"]
+                history = self.text_chunks.get(timestamp)
+                if record["version"] != (0 if history is None else len(history)):
+                    return
+                if op == "append":
+                    timespan = Timespan(record["start"], record["end"])
+                else:
+                    timespan = history.timespans[0]
+                self._store_version(
+                    ASRTextUnit(
+                        text=record["text"],
+                        timestamp=timestamp,
+                        timespan=timespan,
+                        version=record["version"],
+                    )
+                )
+            elif op == "rate":
+                self.text_chunks[record["timestamp"]].rate(
+                    record["version"], record["rating_update"]
+                )
+                self._invalidate()
+            elif op == "rules":
+                self.set_encoded_correction_rules(record["rules"])
+                self._record_change(None)
+                self._invalidate()
+            elif op == "clear":
+                self._clear_text_chunks()
+            # replayed changes are not published, subscribers catch up from the new cursor
+            self.events.reset(self.change_seq)
+
+    def get_checkpoint(self) -> Dict:
+        """Returns the newest versions of the text chunks and the correction rules as a JSON
+        serializable dict, see `restore_checkpoint`"""
+        with self.lock:
+            return {
+                "change_seq": self.change_seq,
+                "correction_rules": self.encode_correction_rules(),
+                "text_chunks": [
+                    self.text_chunks[timestamp].to_dict(latest_only=True)
+                    for timestamp in self.timestamps
+                ],
+            }
+
+    def restore_checkpoint(self, checkpoint: Dict) -> None:
+        """Replaces the text chunks and correction rules by the ones from `get_checkpoint`. The
+        texts of older versions are not restored, they are only kept in the journal."""
+        with self.lock:
+            self._clear_text_chunks()
+            for chunk in checkpoint["text_chunks"]:
+                self.text_chunks[chunk["timestamp"]] = ChunkHistory.from_dict(chunk)
+                self.timestamps.append(chunk["timestamp"])
+            self.set_encoded_correction_rules(checkpoint["correction_rules"])
+            self.change_seq = max(self.change_seq, checkpoint["change_seq"] + 1)
+            self._invalidate()
+            self.events.reset(self.change_seq)
+
+    def _record_change(self, timestamp: Union[int, None]) -> None:
+        self.change_seq += 1
+        self.change_log.append((self.change_seq, timestamp))
+
+    def _invalidate(self) -> None:
+        self.revision += 1
+        self.response_cache = dict()
+
+    def etag(self) -> str:
+        """Returns the entity tag of the current revision"""
+        return f"{self.etag_prefix}-{self.revision}"
+
+    def cached_response(
+        self, key: str, build: Callable[[], object], compress: bool = False
+    ) -> Tuple[bytes, bool]:
+        """Returns the JSON encoded `build()` for the current revision, computing it only once.
+
+        With `compress`, the response is gzipped if it is large enough. Returns a tuple
+        `(body, compressed)`.
+        """
+        # a concurrent change replaces the whole cache, so a stale body is never stored for the
+        # new revision
+        cache = self.response_cache
+        if key not in cache:
+            body = json.dumps(build()).encode("utf-8")
+            if len(cache) < self.RESPONSE_CACHE_SIZE:
+                cache[key] = body
+        else:
+            body = cache[key]
 
-    def get_latest_versions(self) -> Dict[int, int]:
-        """Returns a dict of timestamp -> version of the latest version of each text chunk"""
+        if not compress or len(body) < self.COMPRESS_MIN_SIZE:
+            return body, False
+
+        if key + ".gz" not in cache:
+            compressed_body = gzip.compress(body, compresslevel=5)
+            if len(cache) < self.RESPONSE_CACHE_SIZE:
+                cache[key + ".gz"] = compressed_body
+        else:
+            compressed_body = cache[key + ".gz"]
+        return compressed_body, True
+
+    def _publish_chunk(self, timestamp: int) -> None:
+        self.events.publish(
+            self.change_seq,
+            "chunks",
+            {
+                "text_chunks": [self._chunk_dict(self.text_chunks[timestamp])],
+                "cursor": self.change_seq,
+            },
+        )
+        if self.events.subscribers > 0:
+            self.mark_delivered(self.change_seq)
+
+    def mark_delivered(self, change_seq: int) -> None:
+        """Records that a viewer got the text up to `change_seq`"""
+        if change_seq > self.delivered_seq:
+            self.delivered_seq = change_seq
+            if self.delivery_listener is not None:
+                self.delivery_listener(change_seq)
+
+    def catch_up_event(self, since: int) -> Tuple[bytes, int]:
+        """Returns a serialized "sync" event with everything changed after `since` and the new
+        cursor, for push subscribers that missed events."""
+        text_chunks, cursor, snapshot = self.get_changes_since(since)
+        data = {
+            "text_chunks": text_chunks,
+            "entries": self.encode_correction_rules(),
+            "cursor": cursor,
+            "snapshot": snapshot,
+        }
+        return format_event(cursor, "sync", data), cursor
+
+    @staticmethod
+    def _chunk_dict(history: ChunkHistory) -> Dict[str, Union[int, str]]:
+        version, text = history.head
         return {
-            timestamp: self.text_chunks[timestamp][-1].version
-            for timestamp in self.text_chunks.keys()
+            "timestamp": history.timestamp,
+            "version": version,
+            "text": text,
         }
 
+    def _add_history_size(self, timestamp: int, growth: int) -> None:
+        """Accounts for `growth` bytes of new history of the text chunk at `timestamp`"""
+        self.history_size += growth
+        if growth > 0 and timestamp not in self.uncompacted:
+            # a text chunk compacted before is queued again when it gets new versions
+            self.uncompacted.add(timestamp)
+            heappush(self.compact_queue, timestamp)
+
+    def compact_history(self) -> None:
+        """Drops the texts of older versions of the oldest text chunks while the history takes
+        more than `HISTORY_BUDGET_BYTES`"""
+        while self.history_size > self.HISTORY_BUDGET_BYTES and self.compact_queue:
+            timestamp = heappop(self.compact_queue)
+            self.uncompacted.discard(timestamp)
+            self.history_size -= self.text_chunks[timestamp].compact()
+
+    def memory_usage(self) -> int:
+        """Returns the approximate number of bytes taken by the text chunks"""
+        with self.lock:
+            size = sys.getsizeof(self.text_chunks)
+            for history in self.text_chunks.values():
+                size += history.memory_usage()
+            return size
+
+    def get_latest_versions(self) -> Dict[int, int]:
+        """Returns a dict of timestamp -> version of the latest version of each text chunk"""
+        text_chunks, timestamps, _ = self.chunk_view
+        return {timestamp: text_chunks[timestamp].latest_version for timestamp in timestamps[:]}
+
     def get_latest_text_chunks(self, versions: Dict[int, int]):
+        text_chunks, timestamps, _ = self.chunk_view
         ret_value: List[Dict[str, Union[int, str]]] = []
-        for timestamp in self.text_chunks.keys():
-            newest_version = len(self.text_chunks[timestamp]) - 1
-            if timestamp in versions:
-                if versions[timestamp] < newest_version:
-                    ret_value.append(
-                        {
-                            "timestamp": timestamp,
-                            "version": newest_version,
-                            "text": self.text_chunks[timestamp][newest_version].raw_text(),
-                        }
-                    )
-            else:
-                ret_value.append(
-                    {
-                        "timestamp": timestamp,
-                        "version": newest_version,
-                        "text": self.text_chunks[timestamp][newest_version].raw_text(),
-                    }
-                )
+        for timestamp in timestamps[:]:
+            chunk = self._chunk_dict(text_chunks[timestamp])
+            if timestamp not in versions or versions[timestamp] < chunk["version"]:
+                ret_value.append(chunk)
         return ret_value
 
+    def get_tail(self, count: int) -> List[Dict[str, Union[int, str]]]:
+        """Returns the newest `count` text chunks"""
+        if count <= 0:
+            return []
+        text_chunks, timestamps, _ = self.chunk_view
+        return [self._chunk_dict(text_chunks[timestamp]) for timestamp in timestamps[-count:]]
+
+    def get_range(
+        self, start: int, end: Union[int, None], limit: int
+    ) -> Tuple[List[Dict[str, Union[int, str]]], Union[int, None]]:
+        """Returns at most `limit` text chunks with timestamps in `[start, end)` (`end=None` means
+        up to the newest one) in O(log n + limit).
+
+        Returns a tuple `(text_chunks, next_start)`, where `next_start` is the timestamp to pass as
+        `start` for the next page, or None if there are no more text chunks in the range.
+        """
+        text_chunks, timestamps, _ = self.chunk_view
+        # timestamps are only appended, the prefix of length n seen here does not change
+        n = len(timestamps)
+        first = bisect_left(timestamps, start, 0, n)
+        last = n if end is None else bisect_left(timestamps, end, 0, n)
+        # a page is never empty, otherwise `next_start == start` and paging would not end
+        page_end = min(last, first + max(limit, 1))
+        page = [
+            self._chunk_dict(text_chunks[timestamp]) for timestamp in timestamps[first:page_end]
+        ]
+        next_start = timestamps[page_end] if page_end < last else None
+        return page, next_start
+
+    def get_changes_since(
+        self, since: int
+    ) -> Tuple[List[Dict[str, Union[int, str]]], int, bool]:
+        """Returns the text chunks changed after the change sequence number `since`.
+
+        Returns a tuple `(text_chunks, cursor, snapshot)`, where `cursor` is the sequence number to
+        pass as `since` next time. If `since` is older than the change log (or does not belong to
+        this text at all), all text chunks are returned and `snapshot` is True.
+        """
+        # the cursor is read before the changes, so that a concurrent change is never skipped,
+        # at worst it is returned twice
+        cursor = self.change_seq
+        if since == cursor:
+            return [], cursor, False
+
+        # copying the deque is a single C call, no append can interleave with it
+        change_log = list(self.change_log)
+        if 0 <= since < cursor and change_log and change_log[0][0] <= since + 1:
+            text_chunks = self.chunk_view[0]
+            changed_timestamps = set()
+            for seq, timestamp in reversed(change_log):
+                if seq <= since:
+                    break
+                if timestamp is not None:
+                    changed_timestamps.add(timestamp)
+            changed_chunks = [
+                self._chunk_dict(text_chunks[timestamp])
+                for timestamp in sorted(changed_timestamps)
+                if timestamp in text_chunks
+            ]
+            return changed_chunks, cursor, False
+
+        return self.get_latest_text_chunks({}), cursor, True
+
     def edit_text_chunk(
         self, timestamp: int, _version: int, text: str
     ) -> Tuple[str, int]:  # noqa: ARG002
         """Edits the text chunk at the given timestamp and version to the given text"""
-        if self.apply_correction_rules(text) == self.text_chunks[timestamp][-1].text:
-            # if the text is the same as the newest version, discard the edit
-            return (
-                self.text_chunks[timestamp][-1].raw_text(),
-                self.text_chunks[timestamp][-1].version,
-            )
-
-        # DONE?: Maybe do something smarter with the version, not just discarding it
+        with self.lock:
+            history = self.text_chunks[timestamp]
+            corrected_text = self.apply_correction_rules(text)
+            if corrected_text == history.latest_text:
+                # if the text is the same as the newest version, discard the edit
+                return history.latest_text, history.latest_version
 
-        new_text_unit = ASRTextUnit(
-            text=self.apply_correction_rules(text),
-            timestamp=timestamp,
-            # The timespan is the same for all versions of a text chunk
-            timespan=self.text_chunks[timestamp][0].timespan,
-            version=len(self.text_chunks[timestamp]),
-        )
-        self.text_chunks[timestamp].append(new_text_unit)
+            # DONE?: Maybe do something smarter with the version, not just discarding it
 
-        with open(
-            self.save_path + "/" + self.language + "/" + str(timestamp) + "_0" + ".json", "w"
-        ) as f:
-            print(new_text_unit.to_json(), file=f)
+            new_text_unit = ASRTextUnit(
+                text=corrected_text,
+                timestamp=timestamp,
+                # The timespan is the same for all versions of a text chunk
+                timespan=history.timespans[0],
+                version=len(history),
+            )
+            self._store_version(new_text_unit)
+            self._publish_chunk(timestamp)
+            self.journal.write(
+                {
+                    "op": "edit",
+                    "time": time.time(),
+                    "timestamp": timestamp,
+                    "version": new_text_unit.version,
+                    "text": new_text_unit.text,
+                }
+            )
 
-        return new_text_unit.raw_text(), self.text_chunks[timestamp][-1].version
+            return new_text_unit.raw_text(), new_text_unit.version
 
-    def rate_text_chunk(self, timestamp: int, version: int, d_rating: int) -> None:
-        """Rates the text chunk at the given timestamp and version with the given rating"""
-        self.text_chunks[timestamp][version].rating += d_rating
+    def rate_text_chunk(self, timestamp: int, version: int, d_rating: int) -> int:
+        """Rates the text chunk at the given timestamp and version with the given rating,
+        returns the new rating"""
+        with self.lock:
+            new_rating = self.text_chunks[timestamp].rate(version, d_rating)
+            self._invalidate()
+            self.journal.write(
+                {
+                    "op": "rate",
+                    "time": time.time(),
+                    "timestamp": timestamp,
+                    "version": version,
+                    "rating_update": d_rating,
+                }
+            )
+            return new_rating
 
 
 class CurrentASRTextContainer:
-    def __init__(self, save_path: str, supported_languages: List[str]) -> None:
+    def __init__(
+        self, save_path: str, supported_languages: List[str], config: ASRConfig
+    ) -> None:
         self.current_texts = {
-            language: CurrentASRText(save_path, language) for language in supported_languages
+            language: CurrentASRText(
+                save_path,
+                language,
+                TranscriptJournal(
+                    save_path + "/" + language + "/journal.jsonl",
+                    fsync_policy=config.JOURNAL_FSYNC,
+                    batch_size=config.JOURNAL_BATCH_SIZE,
+                    flush_seconds=config.JOURNAL_FLUSH_SECONDS,
+                ),
+            )
+            for language in supported_languages
         }
 
     def get_latest_versions(self) -> Dict[str, Dict[int, int]]:
@@ -386,3 +994,8 @@ class CurrentASRTextContainer:
     def clear(self) -> None:
         for language in self.current_texts.keys():
             self.current_texts[language].clear()
+
+    def close_journals(self) -> None:
+        for text in self.current_texts.values():
+            with text.lock:
+                text.journal.close()
@@ -0,0 +1,197 @@
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple, Union
+
+from .persistence import get_writer
+
+# stages of the way of a TranscribePacket to the viewers, in order:
+# - queue: from queueing the packet to handing it to a worker for the first time
+# - resend: from the first to the last hand-out, waiting for the resend timeout
+# - network: the round trip to the worker without the time the worker held the packet
+# - inference: transcribing on the worker
+# - worker_other: the rest of the time the worker held the packet, e.g. decoding the audio
+# - commit: from receiving the transcription to adding the committed text to the transcript
+# - agreement: how long the committed words waited for the HypothesisBuffer to agree on them,
+#   from queueing the first packet with their audio to queueing this one
+# - delivery: from committing to the first viewer getting the text
+# - translation: from queueing the committed text for translation to receiving it
+STAGES = [
+    "queue",
+    "resend",
+    "network",
+    "inference",
+    "worker_other",
+    "commit",
+    "agreement",
+    "delivery",
+    "translation",
+]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LatencyTracer:
+    RECENT_SIZE = 512  # completed traces kept for `breakdown`
+    PENDING_SIZE = 256  # traces waiting for their delivery or translation
+    PACKETS_SIZE = 256  # queued packets remembered for the agreement stage
+
+    def __init__(self, trace_path: str) -> None:
+        """
+        LatencyTracer follows every TranscribePacket of one session through the pipeline and
+        splits its latency into `STAGES`. A trace is complete when its text was delivered to a
+        viewer and translated, then it is appended to the JSONL file at `trace_path` and counted
+        in `breakdown`. Traces still incomplete when the pending ones are too many, or when the
+        session ends, are written as they are.
+
+        Times measured by the worker are only used as differences, so the clocks of the API and
+        the workers do not have to be synchronized.
+        """
+        self.lock = threading.Lock()
+        self.trace_path: str = trace_path
+        self.packets: Deque[Tuple[int, float, float]] = deque(maxlen=self.PACKETS_SIZE)
+        """(timestamp, end of the audio in seconds, queued time) of the recent packets"""
+        self.pending: "OrderedDict[int, Dict]" = OrderedDict()
+        """packet timestamp -> trace waiting for delivery or translation"""
+        self.awaiting_delivery: Deque[Tuple[str, int, int]] = deque()
+        """(language, change_seq, packet timestamp) of committed texts not delivered yet"""
+        self.last_delivered: Dict[str, Tuple[int, float]] = dict()
+        """language -> (change_seq, time) of the newest delivery, push viewers get the text
+        while it is appended, before `transcribed` is called"""
+        self.recent: Deque[Dict] = deque(maxlen=self.RECENT_SIZE)
+
+    def packet_queued(self, timestamp: int, audio_end: float, queued_time: float) -> None:
+        with self.lock:
+            self.packets.append((timestamp, audio_end, queued_time))
+
+    def _first_queued_with(self, audio_end: float, default: float) -> float:
+        """Returns the queued time of the first packet that had audio up to `audio_end`"""
+        for _, packet_audio_end, queued_time in self.packets:
+            if packet_audio_end >= audio_end:
+                return queued_time
+        return default
+
+    def transcribed(
+        self,
+        timestamp: int,
+        times: Dict[str, float],
+        worker_trace: Union[Dict[str, float], None],
+        commit: Union[Tuple[str, int, float], None],
+    ) -> None:
+        """Starts the trace of a packet whose transcription was received.
+
+        Args:
+            timestamp (int): The timestamp of the packet.
+            times (Dict[str, float]): The API times "queued", "first_sent", "sent", "received"
+                and, if the transcription committed text, "committed".
+            worker_trace (Dict[str, float]): The "trace" sent by the worker with the
+                transcription, its times "received", "inference_start", "inference_end" and
+                "posted", or None for workers that do not send it.
+            commit (Tuple[str, int, float]): The language and the change_seq of the committed
+                text and the end of its audio in seconds, None if nothing was committed.
+        """
+        stages: Dict[str, float] = {
+            "queue": times["first_sent"] - times["queued"],
+            "resend": times["sent"] - times["first_sent"],
+        }
+        if worker_trace is not None:
+            held = worker_trace["posted"] - worker_trace["received"]
+            inference = worker_trace["inference_end"] - worker_trace["inference_start"]
+            stages["network"] = times["received"] - times["sent"] - held
+            stages["inference"] = inference
+            stages["worker_other"] = held - inference
+        trace = {"timestamp": timestamp, "queued": times["queued"], "stages": stages}
+
+        with self.lock:
+            if commit is None:
+                # no text came out of the packet, nothing to wait for
+                self._complete(trace)
+                return
+            language, change_seq, audio_end = commit
+            stages["commit"] = times["committed"] - times["received"]
+            stages["agreement"] = times["queued"] - self._first_queued_with(
+                audio_end, times["queued"]
+            )
+            trace["committed"] = times["committed"]
+            self.pending[timestamp] = trace
+            delivered_seq, delivered_time = self.last_delivered.get(language, (0, 0.0))
+            if delivered_seq >= change_seq:
+                # delivered to push viewers while appending, before "committed" was measured
+                stages["delivery"] = max(delivered_time - times["committed"], 0.0)
+                self._maybe_complete(trace)
+            else:
+                self.awaiting_delivery.append((language, change_seq, timestamp))
+            while len(self.pending) > self.PENDING_SIZE:
+                _, oldest = self.pending.popitem(last=False)
+                self._complete(oldest)
+
+    def delivered(self, language: str, change_seq: int) -> None:
+        """Records that a viewer got the text in `language` up to `change_seq`"""
+        now = time.time()
+        with self.lock:
+            self.last_delivered[language] = (change_seq, now)
+            if not self.awaiting_delivery:
+                return
+            waiting: Deque[Tuple[str, int, int]] = deque()
+            while self.awaiting_delivery:
+                entry = self.awaiting_delivery.popleft()
+                if entry[0] != language or entry[1] > change_seq:
+                    waiting.append(entry)
+                    continue
+                trace = self.pending.get(entry[2])
+                if trace is not None:
+                    trace["stages"]["delivery"] = now - trace["committed"]
+                    self._maybe_complete(trace)
+            self.awaiting_delivery = waiting
+
+    def translated(self, timestamp: int, queued_time: float) -> None:
+        with self.lock:
+            trace = self.pending.get(timestamp)
+            if trace is not None:
+                trace["stages"]["translation"] = time.time() - queued_time
+                self._maybe_complete(trace)
+
+    def _maybe_complete(self, trace: Dict) -> None:
+        if "delivery" in trace["stages"] and "translation" in trace["stages"]:
+            del self.pending[trace["timestamp"]]
+            self._complete(trace)
+
+    def _complete(self, trace: Dict) -> None:
+        trace.pop("committed", None)
+        self.recent.append(trace)
+        get_writer().append(self.trace_path, (json.dumps(trace) + "\n").encode("utf-8"))
+
+    def close(self) -> None:
+        """Writes the incomplete traces"""
+        with self.lock:
+            while self.pending:
+                _, trace = self.pending.popitem(last=False)
+                self._complete(trace)
+            self.awaiting_delivery.clear()
+
+    def breakdown(self, limit: int) -> Dict:
+        """Returns the count, mean, percentiles and maximum of every stage over the recent
+        traces, including the stages of the pending ones, and the `limit` most recent complete
+        traces"""
+        with self.lock:
+            traces = list(self.recent)
+            measured = [dict(trace["stages"]) for trace in traces]
+            measured += [dict(trace["stages"]) for trace in self.pending.values()]
+
+        stages = {}
+        for stage in STAGES:
+            values = sorted(trace[stage] for trace in measured if stage in trace)
+            if not values:
+                continue
+            stages[stage] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 0.5),
+                "p90": percentile(values, 0.9),
+                "p99": percentile(values, 0.99),
+                "max": values[-1],
+            }
+        return {"stages": stages, "traces": traces[-limit:] if limit > 0 else []}
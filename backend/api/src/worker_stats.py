@@ -0,0 +1,108 @@
+import threading
+import time
+from typing import Dict, Union
+
+# totals summed over the reports of a worker, see `WorkerStats.report`
+TOTALS = [
+    "audio_seconds",
+    "wall_seconds",
+    "vad_trimmed_seconds",
+    "fetch_seconds",
+    "parse_seconds",
+]
+# settings of a worker, the latest reported value is kept
+SETTINGS = ["model", "beam_size", "batch_size"]
+
+
+class WorkerStats:
+    RECENT_WEIGHT = 0.1  # weight of the newest report in `real_time_factor`
+
+    def __init__(self) -> None:
+        """
+        WorkerStats aggregates the performance reports the workers send with their
+        transcriptions, per worker, and estimates how many workers the lectures need.
+
+        The estimate divides the time the workers spent transcribing by the lecture-seconds
+        they transcribed, i.e. the number of active sessions integrated over time. It holds
+        while the workers keep up with the queue, overloaded workers get bigger packets less
+        often and the estimate comes out too low.
+        """
+        self.lock = threading.Lock()
+        self.workers: Dict[str, Dict] = dict()
+        self.started: float = time.time()
+        self.lecture_seconds: float = 0.0
+        self.sampled: float = self.started
+        self.recent_real_time_factor: Union[float, None] = None
+
+    def sample_sessions(self, active_sessions: int, now: Union[float, None] = None) -> None:
+        """Adds the lecture-seconds since the last sample, call it whenever the number of
+        active sessions may be read"""
+        now = time.time() if now is None else now
+        with self.lock:
+            self.lecture_seconds += active_sessions * max(0.0, now - self.sampled)
+            self.sampled = now
+
+    def report(self, stats: Dict) -> None:
+        """Adds the report of one transcription, a dict with the "worker" name, the `TOTALS`
+        and the `SETTINGS`. Missing values count as 0."""
+        now = time.time()
+        with self.lock:
+            worker = self.workers.get(stats["worker"])
+            if worker is None:
+                worker = {"reports": 0, "first_seen": now, **{total: 0.0 for total in TOTALS}}
+                self.workers[stats["worker"]] = worker
+            worker["reports"] += 1
+            worker["last_seen"] = now
+            for total in TOTALS:
+                worker[total] += float(stats.get(total) or 0.0)
+            for setting in SETTINGS:
+                if setting in stats:
+                    worker[setting] = stats[setting]
+
+            audio_seconds = float(stats.get("audio_seconds") or 0.0)
+            if audio_seconds > 0:
+                real_time_factor = float(stats.get("wall_seconds") or 0.0) / audio_seconds
+                if self.recent_real_time_factor is None:
+                    self.recent_real_time_factor = real_time_factor
+                else:
+                    self.recent_real_time_factor += self.RECENT_WEIGHT * (
+                        real_time_factor - self.recent_real_time_factor
+                    )
+
+    def real_time_factor(self) -> Union[float, None]:
+        """Returns the seconds of inference per second of audio of the recent transcriptions of
+        all workers, an exponential moving average, None before the first report"""
+        with self.lock:
+            return self.recent_real_time_factor
+
+    def summary(self, lectures: Union[int, None] = None) -> Dict:
+        """Returns the totals, real-time factor and utilization of every worker and the worker
+        time needed per lecture, with the workers needed for `lectures` if it is given"""
+        now = time.time()
+        with self.lock:
+            workers = {name: dict(worker) for name, worker in self.workers.items()}
+            lecture_seconds = self.lecture_seconds
+
+        for worker in workers.values():
+            audio_seconds = worker["audio_seconds"]
+            worker["real_time_factor"] = (
+                worker["wall_seconds"] / audio_seconds if audio_seconds > 0 else None
+            )
+            # busy time of the worker since its first report
+            worker["utilization"] = worker["wall_seconds"] / max(now - worker["first_seen"], 1e-9)
+
+        wall_seconds = sum(worker["wall_seconds"] for worker in workers.values())
+        worker_seconds_per_lecture = wall_seconds / lecture_seconds if lecture_seconds > 0 else None
+        summary: Dict = {
+            "workers": workers,
+            "worker_seconds": wall_seconds,
+            "lecture_seconds": lecture_seconds,
+            "worker_seconds_per_lecture_second": worker_seconds_per_lecture,
+        }
+        if lectures is not None:
+            summary["workers_needed"] = (
+                lectures * worker_seconds_per_lecture
+                if worker_seconds_per_lecture is not None
+                else None
+            )
+        return summary
@@ -0,0 +1,70 @@
+"""Checks that the version history of a transcript stays within its budget.
+
+Appends text to a CurrentASRText and edits random text chunks, old ones included, so that chunks
+that were already compacted get new versions. After every change it checks that:
+- `history_size` is at most `HISTORY_BUDGET_BYTES`,
+- `history_size` is the sum of `history_size` of all text chunks,
+- the newest text of every text chunk is the one last written.
+
+Run from `backend/api` with `python -m tests.check_history_budget`.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+from typing import Dict
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--changes", type=int, default=100000)
+    parser.add_argument("--budget", type=int, default=64 * 1024, help="bytes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from src.common import Timespan
+    from src.text_handlers import CurrentASRText
+
+    rng = random.Random(args.seed)
+    save_path = tempfile.mkdtemp()
+    os.makedirs(os.path.join(save_path, "en"))
+    text = CurrentASRText(save_path, "en")
+    text.HISTORY_BUDGET_BYTES = args.budget
+    expected: Dict[int, str] = dict()
+    peak = 0
+    for change in range(args.changes):
+        if not text.timestamps or rng.random() < 0.2:
+            sentence = f"sentence number {change} is long enough. "
+            text.append(sentence, Timespan(change, change))
+            # a too short last text chunk is extended instead of creating a new one
+            timestamp = text.timestamps[-1]
+            expected[timestamp] = expected.get(timestamp, "") + sentence
+        else:
+            timestamp = rng.choice(text.timestamps)
+            expected[timestamp], _ = text.edit_text_chunk(timestamp, 0, f"edit {change}")
+
+        peak = max(peak, text.history_size)
+        if text.history_size > args.budget:
+            print(f"FAILED: history_size {text.history_size} after {change} changes")
+            sys.exit(1)
+        if change % 1000 == 0:
+            total = sum(history.history_size for history in text.text_chunks.values())
+            if total != text.history_size:
+                print(f"FAILED: history_size {text.history_size}, chunks hold {total}")
+                sys.exit(1)
+    text.journal.close()
+
+    for timestamp, history in text.text_chunks.items():
+        if history.latest_text != expected[timestamp]:
+            print(f"FAILED: text chunk {timestamp} lost its newest text")
+            sys.exit(1)
+    print(
+        f"{args.changes} changes of {len(text.timestamps)} text chunks, "
+        f"history_size peaked at {peak} of {args.budget} bytes"
+    )
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Checks that a session restored from a checkpoint and its journals continues where it stopped.
+
+Creates a session through the Flask app run in this process, checkpoints it, changes its
+transcripts after the checkpoint (appends, edits, ratings and correction rules) and restores it
+with `Session.restore` like after a restart of the API. Then it checks that:
+- the restored transcripts are the ones held before the restart,
+- the push channel of every transcript is at its `change_seq`,
+- a viewer that is up to date waits in `/get_text_chunk_changes` instead of returning at once.
+
+Run from `backend/api` with `python -m tests.check_session_restore`.
+"""
+import os
+import sys
+import tempfile
+import time
+from typing import List
+
+failures: List[str] = []
+
+
+def main() -> None:
+    from src import api
+    from src.common import Timespan
+    from src.networking_common import Session
+    from src.persistence import get_writer
+
+    # the session is saved into ./recordings
+    os.chdir(tempfile.mkdtemp())
+    client = api.app.test_client()
+    session_id = "restore"
+    client.get(f"/create_session?session_id={session_id}")
+    session = api.sessions[session_id]
+    text = session.texts.current_texts["en"]
+    for i in range(5):
+        text.append(f"sentence number {i} before the checkpoint. ", Timespan(i, i + 1))
+    session.checkpoint()
+
+    for i in range(5, 10):
+        text.append(f"sentence number {i} after the checkpoint. ", Timespan(i, i + 1))
+    text.edit_text_chunk(text.timestamps[0], 0, "edited after the checkpoint")
+    text.rate_text_chunk(text.timestamps[1], 0, 1)
+    text.clear_empty_correction_rules()
+    expected = {
+        language: current_text.get_latest_text_chunks({})
+        for language, current_text in session.texts.current_texts.items()
+    }
+    session.texts.close_journals()
+    get_writer().flush()
+
+    # the restart: the session is rebuilt from the files only
+    api.sessions.pop(session_id)
+    api.sessions.create(
+        session_id, lambda: Session.restore(session.save_path, api.CONFIG, api.trim_policy)
+    )
+    restored = api.sessions[session_id]
+    for language, current_text in restored.texts.current_texts.items():
+        if current_text.get_latest_text_chunks({}) != expected[language]:
+            failures.append(f"{language}: the restored text differs")
+        if current_text.events.last_id != current_text.change_seq:
+            failures.append(
+                f"{language}: push channel at {current_text.events.last_id}, "
+                f"text at {current_text.change_seq}"
+            )
+
+    cursor = restored.texts.current_texts["en"].change_seq
+    start_time = time.time()
+    response = client.get(
+        f"/get_text_chunk_changes?session_id={session_id}&language=en&since={cursor}&wait=1"
+    )
+    waited = time.time() - start_time
+    if response.status_code != 200 or response.get_json()["text_chunks"]:
+        failures.append(f"up to date long-poll: {response.status_code} {response.data[:200]!r}")
+    if waited < 0.9:
+        failures.append(f"up to date long-poll returned after {waited:.3f} s instead of waiting")
+    client.get(f"/end_session?session_id={session_id}")
+
+    if failures:
+        for message in failures:
+            print("FAILED: " + message, file=sys.stderr)
+        sys.exit(1)
+    print("OK", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
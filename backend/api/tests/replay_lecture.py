@@ -0,0 +1,216 @@
+"""Replays a recorded lecture through the API without a GPU.
+
+The lecture has to be recorded with `COLETRA_RECORD_ASR=1`, so that its folder
+`recordings/{session_id}/{index}` holds the transcriptions of the workers in `asr_results.jsonl`
+next to the archived audio chunks. The audio is submitted to the Flask app run in this process,
+the worker's `ReplayASR` answers the offloaded packets with the recorded transcriptions and an
+echo translator answers the translation queue, so the whole pipeline from `OnlineASRProcessor`
+to the correction rules and the translations runs as in the lecture.
+
+With `--speed 0` (the default) everything runs in one thread as fast as possible and the result
+is deterministic, `--save` stores the transcripts and `--expect` compares them with stored ones
+for regression tests. With `--speed 1` the audio and the transcriptions come with the timing of
+the lecture, `--speed 2` twice as fast, and the latency breakdown is meaningful.
+
+Run from `backend/api` with `python -m tests.replay_lecture recordings/default/0`.
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from typing import Dict, List, Tuple
+
+MODEL_SRC = os.path.join(os.path.dirname(__file__), "..", "..", "model", "src")
+
+
+def load_replay_asr(results_path: str, speed: float):
+    """Imports `ReplayASR` of the worker, whose package is also named `src`"""
+    package = types.ModuleType("coletra_worker")
+    package.__path__ = [os.path.abspath(MODEL_SRC)]
+    sys.modules["coletra_worker"] = package
+    worker = importlib.import_module("coletra_worker.computation_node_fast")
+    asr = worker.ReplayASR(lan="en", model_dir=results_path)
+    asr.speed = speed
+    return asr
+
+
+def read_audio_chunks(recording: str) -> List[Tuple[float, Dict]]:
+    """Returns the archived audio chunks as submitted to `/submit_audio_chunk`, with the time
+    they were received, in order"""
+    chunks = []
+    for filename in os.listdir(os.path.join(recording, "audio")):
+        # filenames are "{timestamp}_{time.time()}.json"
+        timestamp, saved_time = filename[: -len(".json")].split("_", 1)
+        with open(os.path.join(recording, "audio", filename), "r") as f:
+            chunk = {"timestamp": int(timestamp), "chunk": json.load(f)}
+        chunks.append((float(saved_time), chunk))
+    chunks.sort(key=lambda chunk: chunk[0])
+    return chunks
+
+
+def worker_step(client, asr) -> bool:
+    """Transcribes one offloaded packet, returns False if there was none"""
+    data = client.get("/offload_ASR").get_json()
+    if data is None or data.get("timestamp") is None:
+        return False
+    trace = {"received": time.time()}
+    asr.original_language = data["source_language"]
+    asr.audio_offset = data.get("audio_offset", 0.0)
+    trace["inference_start"] = time.time()
+    res = asr.transcribe(data["audio"], init_prompt=data["prompt"])
+    trace["inference_end"] = time.time()
+    client.post(
+        "/offload_ASR",
+        json={
+            "session_id": data["session_id"],
+            "timestamp": data["timestamp"],
+            "tsw": asr.ts_words(res),
+            "ends": asr.segments_end_ts(res),
+            "language": data["transcript_language"],
+            "is_file": data["is_file"],
+            "trace": {**trace, "posted": time.time()},
+        },
+    )
+    return True
+
+
+def translator_step(client) -> bool:
+    """Answers one translation packet with the source text, returns False if there was none"""
+    data = client.get("/offload_translation").get_json()
+    if data is None:
+        return False
+    client.post(
+        "/offload_translation",
+        json={
+            "session_id": data["session_id"],
+            "timestamp": data["timestamp"],
+            "timespan": data["timespan"],
+            "translated_text": {
+                language: data["source_text"] for language in data["target_languages"]
+            },
+        },
+    )
+    return True
+
+
+def drain(client, asr) -> None:
+    while worker_step(client, asr) or translator_step(client):
+        pass
+
+
+def replay_fast(client, asr, session_id: str, chunks: List[Tuple[float, Dict]]) -> None:
+    for _, chunk in chunks:
+        client.post(f"/submit_audio_chunk?session_id={session_id}", json=chunk)
+        drain(client, asr)
+
+
+def replay_timed(
+    app, asr, session_id: str, chunks: List[Tuple[float, Dict]], speed: float
+) -> None:
+    stop = threading.Event()
+
+    def work() -> None:
+        client = app.test_client()
+        while not stop.is_set():
+            if not (worker_step(client, asr) or translator_step(client)):
+                time.sleep(0.01)
+
+    worker = threading.Thread(target=work)
+    worker.start()
+    client = app.test_client()
+    start_time = time.time()
+    for saved_time, chunk in chunks:
+        delay = (saved_time - chunks[0][0]) / speed - (time.time() - start_time)
+        if delay > 0:
+            time.sleep(delay)
+        client.post(f"/submit_audio_chunk?session_id={session_id}", json=chunk)
+    stop.set()
+    worker.join()
+    drain(client, asr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("recording", help="recordings/{session_id}/{index} of the lecture")
+    parser.add_argument("--speed", type=float, default=0.0, help="0 for as fast as possible")
+    parser.add_argument("--save", help="write the transcripts into this JSON file")
+    parser.add_argument("--expect", help="compare the transcripts with this JSON file")
+    args = parser.parse_args()
+
+    recording = os.path.abspath(args.recording)
+    with open(os.path.join(recording, "checkpoint.json"), "r") as f:
+        checkpoint = json.load(f)
+    chunks = read_audio_chunks(recording)
+    asr = load_replay_asr(os.path.join(recording, "asr_results.jsonl"), args.speed)
+
+    from src import api
+    from src.buffer_common import OnlineASRProcessor
+
+    # the replayed session is saved into ./recordings
+    os.chdir(tempfile.mkdtemp())
+    client = api.app.test_client()
+    session_id = "replay"
+    client.get(f"/create_session?session_id={session_id}")
+    client.post(
+        f"/switch_source_language?session_id={session_id}",
+        json={"language": checkpoint["source_language"]},
+    )
+    client.post(
+        f"/switch_transcript_language?session_id={session_id}",
+        json={"language": checkpoint["transcript_language"]},
+    )
+    # the rules of the last checkpoint, the edits of the rules during the lecture are not saved
+    for language, text in checkpoint["texts"].items():
+        if text["correction_rules"]:
+            client.post(
+                f"/submit_correction_rules?session_id={session_id}&language={language}",
+                json={"entries": text["correction_rules"]},
+            )
+
+    start_time = time.time()
+    if args.speed > 0:
+        replay_timed(api.app, asr, session_id, chunks, args.speed)
+    else:
+        replay_fast(client, asr, session_id, chunks)
+    wall_seconds = time.time() - start_time
+
+    breakdown = client.get(f"/get_latency_breakdown?session_id={session_id}").get_json()
+    session = api.sessions[session_id]
+    transcripts = {
+        language: str(text) for language, text in sorted(session.texts.current_texts.items())
+    }
+    client.get(f"/end_session?session_id={session_id}")
+
+    audio_seconds = sum(len(chunk["chunk"]) for _, chunk in chunks)
+    audio_seconds /= OnlineASRProcessor.SAMPLING_RATE
+    print(
+        f"replayed {audio_seconds:.1f} s of audio in {wall_seconds:.2f} s, "
+        f"{audio_seconds / max(wall_seconds, 1e-9):.1f}x real time"
+    )
+    if args.speed > 0:
+        print(json.dumps(breakdown, indent=2))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(transcripts, f, indent=2, ensure_ascii=False)
+    if args.expect:
+        with open(args.expect, "r", encoding="utf-8") as f:
+            expected = json.load(f)
+        differing = [
+            language
+            for language in set(expected) | set(transcripts)
+            if expected.get(language) != transcripts.get(language)
+        ]
+        if differing:
+            print("transcripts differ in: " + ", ".join(sorted(differing)))
+            sys.exit(1)
+        print("transcripts match")
+
+
+if __name__ == "__main__":
+    main()
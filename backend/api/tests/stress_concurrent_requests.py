@@ -0,0 +1,218 @@
+"""Stress test of the API served by many threads at once.
+
+Runs the Flask app in this process and hits it from concurrent threads: audio ingest for several
+sessions, fake ASR workers taking and answering /offload_ASR, editors and raters, and viewers
+polling every read endpoint. Afterwards it checks that:
+- every request succeeded with status 200,
+- every viewer saw the versions of text chunks and the change cursor only growing,
+- every audio packet was transcribed at most once,
+- replaying the transcript journal gives exactly the text held in memory.
+
+Run from `backend/api` with `python -m tests.stress_concurrent_requests`.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+SAMPLING_RATE = 16000
+CHUNK_SECONDS = 0.5
+
+failures: List[str] = []
+failures_lock = threading.Lock()
+
+
+def fail(message: str) -> None:
+    with failures_lock:
+        failures.append(message)
+
+
+def check_status(response, what: str) -> None:
+    """Fails unless the request succeeded"""
+    if response.status_code != 200:
+        fail(f"{what}: {response.status_code} {response.data[:200]!r}")
+
+
+def ingest(app, session_id: str, stop: threading.Event) -> None:
+    client = app.test_client()
+    timestamp = 0
+    while not stop.is_set():
+        samples = int(SAMPLING_RATE * CHUNK_SECONDS)
+        chunk = {str(i): random.uniform(-0.5, 0.5) for i in range(samples)}
+        response = client.post(
+            f"/submit_audio_chunk?session_id={session_id}",
+            json={"timestamp": timestamp, "chunk": chunk},
+        )
+        check_status(response, "submit_audio_chunk")
+        timestamp += 1
+        time.sleep(CHUNK_SECONDS / 4)
+
+
+def fake_worker(app, stop: threading.Event) -> None:
+    """Answers offloaded audio with one word every 0.2 s and a full stop every 5 words"""
+    client = app.test_client()
+    while not stop.is_set():
+        response = client.get("/offload_ASR")
+        check_status(response, "GET offload_ASR")
+        data = response.get_json()
+        if data is None or data.get("timestamp") is None:
+            time.sleep(0.01)
+            continue
+
+        duration = len(data["audio"]) / SAMPLING_RATE
+        tsw = []
+        for i in range(int(duration / 0.2)):
+            word = f" w{i}." if i % 5 == 4 else f" w{i}"
+            tsw.append((i * 0.2, i * 0.2 + 0.15, word))
+        response_data = {
+            "is_file": False,
+            "session_id": data["session_id"],
+            "timestamp": data["timestamp"],
+            "tsw": tsw,
+            "ends": [duration],
+            "language": data["transcript_language"],
+        }
+        # sometimes answer twice, like a worker retrying after a timeout
+        for _ in range(2 if random.random() < 0.1 else 1):
+            response = client.post("/offload_ASR", json=response_data)
+            check_status(response, "POST offload_ASR")
+
+
+def editor(app, session_id: str, stop: threading.Event) -> None:
+    client = app.test_client()
+    while not stop.is_set():
+        response = client.get(f"/get_text_chunks_window?session_id={session_id}&language=en&tail=3")
+        check_status(response, "get_text_chunks_window")
+        text_chunks = response.get_json()["text_chunks"]
+        if not text_chunks:
+            time.sleep(0.05)
+            continue
+        chunk = random.choice(text_chunks)
+        response = client.post(
+            f"/edit_asr_chunk?session_id={session_id}&language=en",
+            json={
+                "timestamp": chunk["timestamp"],
+                "version": chunk["version"],
+                "text": chunk["text"] + " edited",
+            },
+        )
+        check_status(response, "edit_asr_chunk")
+        response = client.post(
+            f"/rate_text_chunk?session_id={session_id}&language=en",
+            json={"timestamp": chunk["timestamp"], "version": chunk["version"], "rating_update": 1},
+        )
+        check_status(response, "rate_text_chunk")
+        time.sleep(0.02)
+
+
+def viewer(app, session_id: str, stop: threading.Event) -> None:
+    client = app.test_client()
+    cursor = 0
+    versions: Dict[int, int] = dict()
+    while not stop.is_set():
+        response = client.get(
+            f"/get_text_chunk_changes?session_id={session_id}&language=en&since={cursor}"
+        )
+        check_status(response, "get_text_chunk_changes")
+        data = response.get_json()
+        if data["cursor"] < cursor:
+            fail(f"{session_id}: cursor went back from {cursor} to {data['cursor']}")
+        cursor = data["cursor"]
+        for chunk in data["text_chunks"]:
+            if chunk["version"] < versions.get(chunk["timestamp"], -1):
+                fail(f"{session_id}: version of text chunk {chunk['timestamp']} went back")
+            versions[chunk["timestamp"]] = chunk["version"]
+
+        for url in (
+            f"/get_latest_text_chunk_versions?session_id={session_id}&language=en",
+            f"/get_text_chunks_window?session_id={session_id}&language=en&start=0&limit=20",
+            f"/get_subtitles?session_id={session_id}&language=en&format=vtt",
+            f"/get_correction_rules?session_id={session_id}&language=en",
+        ):
+            check_status(client.get(url), url)
+        response = client.post(
+            f"/get_latest_text_chunks?session_id={session_id}&language=en", json={"versions": {}}
+        )
+        check_status(response, "get_latest_text_chunks")
+
+
+def check_session(api, session_id: str) -> None:
+    from src.persistence import get_writer
+    from src.journal import read_journal
+    from src.text_handlers import CurrentASRText
+
+    session = api.sessions[session_id]
+    if len(set(session.transcribed_timestamps)) != len(session.transcribed_timestamps):
+        fail(f"{session_id}: an audio packet was transcribed twice")
+
+    for language, text in session.texts.current_texts.items():
+        with text.lock:
+            text.journal.flush()
+            expected = text.get_latest_text_chunks({})
+        get_writer().flush()
+
+        replayed = CurrentASRText(tempfile.mkdtemp(), language)
+        for record in read_journal(text.journal_path()):
+            replayed.replay_journal_record(record)
+        if replayed.get_latest_text_chunks({}) != expected:
+            fail(f"{session_id}/{language}: replaying the journal gives a different text")
+        if text.timestamps != sorted(set(text.timestamps)):
+            fail(f"{session_id}/{language}: timestamps are not sorted")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--viewers", type=int, default=4, help="viewers per session")
+    parser.add_argument("--seconds", type=float, default=20.0)
+    args = parser.parse_args()
+
+    from src import api
+
+    # sessions are saved into ./recordings
+    os.chdir(tempfile.mkdtemp())
+    client = api.app.test_client()
+    session_ids = [f"stress{i}" for i in range(args.sessions)]
+    for session_id in session_ids:
+        check_status(client.get(f"/create_session?session_id={session_id}"), "create_session")
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=fake_worker, args=(api.app, stop)) for _ in range(args.workers)
+    ]
+    for session_id in session_ids:
+        threads.append(threading.Thread(target=ingest, args=(api.app, session_id, stop)))
+        threads.append(threading.Thread(target=editor, args=(api.app, session_id, stop)))
+        for _ in range(args.viewers):
+            threads.append(threading.Thread(target=viewer, args=(api.app, session_id, stop)))
+
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    for session_id in session_ids:
+        check_session(api, session_id)
+        chunks = len(api.sessions[session_id].texts.current_texts["en"].timestamps)
+        print(f"{session_id}: {chunks} text chunks", file=sys.stderr)
+    for session_id in session_ids:
+        check_status(client.get(f"/end_session?session_id={session_id}"), "end_session")
+
+    print(f"{len(threads)} threads ran for {time.time() - start_time:.1f} s", file=sys.stderr)
+    if failures:
+        for message in failures[:20]:
+            print("FAILED: " + message, file=sys.stderr)
+        sys.exit(1)
+    print("OK", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
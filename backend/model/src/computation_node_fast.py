@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
+import bisect
 import json
+import signal
+import socket
 import sys
 import time
 import os
@@ -8,9 +11,14 @@ import numpy as np
 import requests
 import urllib3
 
+from .profiler import SamplingProfiler
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-API_URL = os.environ.get("COLETRA_API_URL")
+# comma separated URLs of the API nodes, the worker takes work from all of them in turn
+API_URLS = [url.rstrip("/") for url in os.environ.get("COLETRA_API_URL", "").split(",") if url]
+# name of this worker in the performance reports sent to the API
+WORKER_ID = os.environ.get("COLETRA_WORKER_ID", f"{socket.gethostname()}:{os.getpid()}")
 
 # Whisper backend
 class ASRBase:
@@ -18,9 +26,15 @@ class ASRBase:
     #  because it emits the spaces when neeeded)
     sep = " "
 
+    BEAM_SIZE = 1
+    BATCH_SIZE = 1  # packets transcribed at once
+
     def __init__(self, lan, modelsize=None, cache_dir=None, model_dir=None):
         self.transcribe_kargs = {}
         self.original_language = lan
+        # start of the audio to transcribe in the lecture, in seconds, set for every packet
+        self.audio_offset = 0.0
+        self.model_name = model_dir if model_dir is not None else modelsize
 
         self.model = self.load_model(modelsize, cache_dir, model_dir)
 
@@ -33,6 +47,10 @@ class ASRBase:
     def use_vad(self):
         raise NotImplementedError("must be implemented in the child class")
 
+    def vad_trimmed_seconds(self):
+        """Returns the seconds of audio the VAD removed in the last transcription"""
+        return 0.0
+
 
 class FasterWhisperASR(ASRBase):
     """Uses faster-whisper library as the backend. Works much faster, appx 4-times
@@ -43,6 +61,9 @@ class FasterWhisperASR(ASRBase):
     """
 
     sep = ""
+    # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC,
+    # min chunk 0.01)
+    BEAM_SIZE = 5
 
     def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
         from faster_whisper import WhisperModel
@@ -71,17 +92,16 @@ class FasterWhisperASR(ASRBase):
         return model
 
     def transcribe(self, audio, init_prompt=""):
-        # tested: beam_size=5 is faster and better than 1 (on one 200 second document from En ESIC,
-        # min chunk 0.01)
         segments, info = self.model.transcribe(
             audio,
             language=self.original_language,
             initial_prompt=init_prompt,
-            beam_size=5,
+            beam_size=self.BEAM_SIZE,
             word_timestamps=True,
             condition_on_previous_text=True,
             **self.transcribe_kargs,
         )
+        self.last_info = info
         return list(segments)
 
     def ts_words(self, segments):
@@ -100,10 +120,83 @@ class FasterWhisperASR(ASRBase):
     def use_vad(self):
         self.transcribe_kargs["vad_filter"] = True
 
+    def vad_trimmed_seconds(self):
+        info = getattr(self, "last_info", None)
+        if info is None or info.duration_after_vad is None:
+            return 0.0
+        return info.duration - info.duration_after_vad
+
     def set_translate_task(self):
         self.transcribe_kargs["task"] = "translate"
 
 
+class ReplayASR(ASRBase):
+    """Serves the transcriptions recorded by the API with `COLETRA_RECORD_ASR`, so that a lecture
+    can be replayed without a GPU. `model_dir` is the path of the recorded `asr_results.jsonl`.
+
+    A packet gets the words of the recorded packet whose audio ends closest to its own, moved to
+    its audio offset, so the replay works also when the audio is cut into other packets than in
+    the recording.
+    """
+
+    sep = ""
+    NEIGHBOURS = 4  # recorded packets on each side of the closest end that are compared
+
+    speed = 1.0
+    """1 waits the recorded inference time for every packet, 2 half of it, 0 does not wait"""
+
+    def load_model(self, modelsize=None, cache_dir=None, model_dir=None):
+        records = []
+        with open(model_dir, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+        if len(records) == 0:
+            raise ValueError("no recorded transcriptions in " + model_dir)
+        records.sort(key=lambda record: record["audio_offset"] + record["audio_seconds"])
+        self.records = records
+        self.ends = [record["audio_offset"] + record["audio_seconds"] for record in records]
+        return None
+
+    def find_record(self, offset, seconds):
+        end = offset + seconds
+        index = bisect.bisect_left(self.ends, end)
+        candidates = range(
+            max(0, index - self.NEIGHBOURS), min(len(self.ends), index + self.NEIGHBOURS)
+        )
+        best = min(
+            candidates,
+            key=lambda i: abs(self.ends[i] - end) + abs(self.records[i]["audio_offset"] - offset),
+        )
+        return self.records[best]
+
+    def transcribe(self, audio, init_prompt=""):
+        seconds = len(audio) / 16000
+        record = self.find_record(self.audio_offset, seconds)
+        if self.speed > 0 and record.get("inference_seconds"):
+            time.sleep(record["inference_seconds"] / self.speed)
+
+        # times of the recorded packet relative to the audio of this one
+        shift = record["audio_offset"] - self.audio_offset
+        tsw = [
+            (start + shift, end + shift, word)
+            for start, end, word in record["tsw"]
+            if start + shift >= -0.05 and end + shift <= seconds + 0.05
+        ]
+        ends = [end + shift for end in record["ends"] if 0 < end + shift <= seconds + 0.05]
+        return {"tsw": tsw, "ends": ends}
+
+    def ts_words(self, segments):
+        return segments["tsw"]
+
+    def segments_end_ts(self, res):
+        return res["ends"]
+
+    def use_vad(self):
+        # the recorded transcriptions were made with the VAD of the recording worker
+        pass
+
+
 class ComputationNode:
     sep = ""
 
@@ -119,6 +212,20 @@ class ComputationNode:
     def segments_end_ts(self, res):
         return self.asr_model.segments_end_ts(res)
 
+    def stats(self, audio_seconds, trace, fetch_seconds, parse_seconds):
+        """Returns the performance report sent to the API with a transcription"""
+        return {
+            "worker": WORKER_ID,
+            "model": self.asr_model.model_name,
+            "beam_size": self.asr_model.BEAM_SIZE,
+            "batch_size": self.asr_model.BATCH_SIZE,
+            "audio_seconds": audio_seconds,
+            "wall_seconds": trace["inference_end"] - trace["inference_start"],
+            "vad_trimmed_seconds": self.asr_model.vad_trimmed_seconds(),
+            "fetch_seconds": fetch_seconds,
+            "parse_seconds": parse_seconds,
+        }
+
 
 class ASRConfig:
     def __init__(self):
@@ -130,11 +237,22 @@ class ASRConfig:
         # tiny.en,tiny,base.en,base,small.en,small,medium.en,medium,large-v1,large-v2,large
         self.language = "en"  # Language code for transcription, e.g. en,de,cs.
         self.start_at = 0.0  # Start processing audio at this time.
-        self.backend = "faster-whisper"  # Load only this backend for Whisper processing.
+        # Load only this backend for Whisper processing, "faster-whisper" or "replay".
+        self.backend = os.environ.get("COLETRA_ASR_BACKEND", "faster-whisper")
+        # for the "replay" backend: the asr_results.jsonl recorded by the API and the speed of
+        # the replay, see ReplayASR
+        self.replay_path = os.environ.get("COLETRA_REPLAY_PATH", "asr_results.jsonl")
+        self.replay_speed = float(os.environ.get("COLETRA_REPLAY_SPEED", 1.0))
         self.vad = True  # Use VAD = voice activity detection, with the default parameters.
         self.SAMPLING_RATE = 16000
         self.model_cache_dir = None
         self.model_dir = None
+        # `kill -USR1 <pid>` profiles the worker for profile_seconds, only profile_fraction of
+        # the packets if it is set, see `src.profiler`
+        self.profile_dir = os.environ.get("COLETRA_PROFILE_DIR", "profiles")
+        self.profile_seconds = float(os.environ.get("COLETRA_PROFILE_SECONDS", 60.0))
+        profile_fraction = os.environ.get("COLETRA_PROFILE_FRACTION", "")
+        self.profile_fraction = float(profile_fraction) if profile_fraction else None
 
 
 def main() -> None:
@@ -143,14 +261,20 @@ def main() -> None:
     size = config.model
     language = config.language
 
+    model_dir = config.model_dir
     if config.backend == "faster-whisper":
         asr_cls = FasterWhisperASR
+    elif config.backend == "replay":
+        asr_cls = ReplayASR
+        model_dir = config.replay_path
     else:
         raise ValueError("unknown backend: " + config.backend)
 
     asr = asr_cls(
-        modelsize=size, lan=language, cache_dir=config.model_cache_dir, model_dir=config.model_dir
+        modelsize=size, lan=language, cache_dir=config.model_cache_dir, model_dir=model_dir
     )
+    if config.backend == "replay":
+        asr.speed = config.replay_speed
 
     if config.vad:
         asr.use_vad()
@@ -158,9 +282,23 @@ def main() -> None:
     # min_chunk = config.min_chunk_size
     comp_node = ComputationNode(asr)
 
+    profiler = SamplingProfiler(config.profile_dir)
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: profiler.start(config.profile_seconds, config.profile_fraction),
+    )
+
+    node_index = 0
+    idle_nodes = 0  # nodes in a row that had no work
     while True:
+        api_url = API_URLS[node_index]
+        node_index = (node_index + 1) % len(API_URLS)
+        profiled = False
         try:
-            r = requests.get(f"{API_URL}/offload_ASR", verify=False)
+            fetch_start = time.time()
+            r = requests.get(f"{api_url}/offload_ASR", verify=False)
+            # times of this worker sent back with the result, see the API's `src.tracing`
+            trace = {"received": time.time()}
             json_data = json.loads(r.text)
             timestamp = json_data["timestamp"]
             audio = json_data["audio"]
@@ -169,8 +307,13 @@ def main() -> None:
 
             if len(audio) == 0:
                 print("No audio data")
-                time.sleep(5)
+                idle_nodes += 1
+                if idle_nodes >= len(API_URLS):
+                    idle_nodes = 0
+                    time.sleep(5)
                 continue
+            idle_nodes = 0
+            profiled = profiler.begin_packet()
 
             prompt = json_data["prompt"]
             session_id = json_data["session_id"]
@@ -181,9 +324,11 @@ def main() -> None:
             if isinstance(audio[0], int):
                 audio = np.array(audio, dtype=np.float32) / 32768.0
             audio = np.array(audio, dtype=np.float32)
+            parse_seconds = time.time() - trace["received"]
 
             print(source_language, transcript_language, file=sys.stderr)
             comp_node.asr_model.original_language = source_language
+            comp_node.asr_model.audio_offset = json_data.get("audio_offset", 0.0)
             # starting_ASR_time = time.time()
             if source_language == transcript_language:
                 comp_node.asr_model.transcribe_kargs["task"] = "transcribe"
@@ -199,14 +344,16 @@ def main() -> None:
                 # # transform to [(beg,end,"word1"), ...]
                 # tsw = self.asr.ts_words(res)
                 # ends = self.asr.segments_end_ts(res)
+                trace["inference_start"] = time.time()
                 res = comp_node.transcribe(audio, init_prompt=prompt)
                 tsw = comp_node.ts_words(res)
                 ends = comp_node.segments_end_ts(res)
+                trace["inference_end"] = time.time()
 
                 # print("transcript: ", tsw, file=sys.stderr)
 
                 r = requests.post(
-                    f"{API_URL}/offload_ASR",
+                    f"{api_url}/offload_ASR",
                     json={
                         "session_id": session_id,
                         "timestamp": timestamp,
@@ -214,6 +361,13 @@ def main() -> None:
                         "ends": ends,
                         "language": transcript_language,
                         "is_file": is_file,
+                        "stats": comp_node.stats(
+                            len(audio) / config.SAMPLING_RATE,
+                            trace,
+                            trace["received"] - fetch_start,
+                            parse_seconds,
+                        ),
+                        "trace": {**trace, "posted": time.time()},
                     },
                     verify=False,
                 )
@@ -224,8 +378,13 @@ def main() -> None:
 
             # print("ASR time: ", time.time() - starting_ASR_time, file=sys.stderr)
         except Exception as e:
-            print("cannot connect to server " + str(e), file=sys.stderr)
-            time.sleep(5)
+            print("cannot connect to server " + api_url + " " + str(e), file=sys.stderr)
+            idle_nodes += 1
+            if idle_nodes >= len(API_URLS):
+                idle_nodes = 0
+                time.sleep(5)
+        if profiled:
+            profiler.end_packet()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+"""Opt-in sampling profiler of the worker, started by sending SIGUSR1 to the worker process.
+
+While it runs, a thread samples the Python stacks and counts them, either of all threads or of
+the main thread while it handles a random fraction of the packets. The result is written in the
+folded format of Brendan Gregg's FlameGraph ("frame;frame;frame count" per line). While it is
+stopped, the only cost is the check of `SamplingProfiler.packet_fraction` for every packet.
+
+The API has the same profiler for its requests, the two packages are deployed separately.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, Union
+
+
+def fold_stack(frame) -> str:
+    """Returns the stack of `frame` as "file:function;file:function", the outermost first"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    INTERVAL_SECONDS = 0.005  # between two samples
+
+    def __init__(self, output_dir: str) -> None:
+        self.output_dir: str = output_dir
+        self.packet_fraction: float = 0.0
+        """fraction of the packets to profile, 0 when not profiling packets"""
+        self.all_threads: bool = False
+        self.profiled_thread: Union[int, None] = None
+        """ID of the thread handling a profiled packet"""
+        self.stacks: Dict[str, int] = dict()
+        self.samples: int = 0
+        self.sampler: Union[threading.Thread, None] = None
+
+    def running(self) -> bool:
+        return self.sampler is not None and self.sampler.is_alive()
+
+    def start(self, seconds: float, packet_fraction: Union[float, None] = None) -> None:
+        """Starts profiling for `seconds`, only `packet_fraction` of the packets if it is given,
+        all threads otherwise"""
+        if self.running():
+            print("the profiler is already running", file=sys.stderr)
+            return
+        self.stacks = dict()
+        self.samples = 0
+        self.all_threads = packet_fraction is None
+        self.packet_fraction = packet_fraction or 0.0
+        self.sampler = threading.Thread(
+            target=self._sample, args=(time.time() + seconds,), daemon=True
+        )
+        self.sampler.start()
+
+    def begin_packet(self) -> bool:
+        """Profiles the handling of the current packet with the probability `packet_fraction`,
+        returns whether it does, then `end_packet` has to be called when it is handled"""
+        if self.packet_fraction <= 0.0 or random.random() >= self.packet_fraction:
+            return False
+        self.profiled_thread = threading.get_ident()
+        return True
+
+    def end_packet(self) -> None:
+        self.profiled_thread = None
+
+    def _sample(self, until: float) -> None:
+        own_id = threading.get_ident()
+        while time.time() < until:
+            time.sleep(self.INTERVAL_SECONDS)
+            profiled_thread = self.profiled_thread
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if not self.all_threads and thread_id != profiled_thread:
+                    continue
+                stack = fold_stack(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+        self.packet_fraction = 0.0
+        self.profiled_thread = None
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(
+            self.output_dir, time.strftime("profile-%Y%m%d-%H%M%S") + f"-{os.getpid()}.folded"
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        print(f"profile of {self.samples} samples written to {path}", file=sys.stderr)